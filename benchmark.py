@@ -0,0 +1,27 @@
+#
+#   Copyright 2013 Cisco Systems
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+
+os.environ["DJANGO_SETTINGS_MODULE"] = 'cloudslave.testsettings'
+
+
+def main():
+    from cloudslave import benchmark
+    benchmark.main(sys.argv[1:])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#
+#   Copyright 2013 Cisco Systems
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import optparse
+import StringIO
+import sys
+import time
+
+from django.db import connection
+from django.test.simple import DjangoTestSuiteRunner
+import paramiko
+
+import cloudslave.models
+from cloudslave import fakes
+from cloudslave.models import Cloud
+
+
+# Measures how the main operations scale with the number of slaves, using
+# the fake Nova client and a fake SSH server on localhost. Run it through
+# benchmark.py in the top level directory.
+
+SIZES = (1, 10, 100, 500)
+
+
+class Measurement(object):
+    def __init__(self, operation, slaves):
+        self.operation = operation
+        self.slaves = slaves
+        self.seconds = None
+        self.api_calls = None
+        self.queries = None
+        self.error = None
+
+
+class Benchmark(object):
+    def __init__(self, latency=0, boot_delay=0, failure_rate=0, error_rate=0,
+                 ssh_latency=0, poll_interval=0.1, boot_timeout=600):
+        self.latency = latency
+        self.boot_delay = boot_delay
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.poll_interval = poll_interval
+        self.boot_timeout = boot_timeout
+        self.ssh_server = fakes.FakeSSHServer(latency=ssh_latency)
+        self.private_key = None
+        self.results = []
+        self._runs = 0
+
+    def setup(self):
+        key = paramiko.RSAKey.generate(1024)
+        out = StringIO.StringIO()
+        key.write_private_key(out)
+        self.private_key = out.getvalue()
+        self.ssh_server.start()
+        self._old_ssh_port = cloudslave.models.SSH_PORT
+        cloudslave.models.SSH_PORT = self.ssh_server.port
+        self._old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+
+    def teardown(self):
+        connection.use_debug_cursor = self._old_debug_cursor
+        cloudslave.models.SSH_PORT = self._old_ssh_port
+        cloudslave.models.ssh_pool.close_all()
+        self.ssh_server.stop()
+
+    def measure(self, operation, nova, slaves, func):
+        measurement = Measurement(operation, slaves)
+        calls = nova.call_count
+        del connection.queries[:]
+        start = time.time()
+        try:
+            func()
+        except Exception, e:
+            measurement.error = e
+        measurement.seconds = time.time() - start
+        measurement.api_calls = nova.call_count - calls
+        measurement.queries = len(connection.queries)
+        self.results.append(measurement)
+        return measurement
+
+    def _wait_until_ready(self, res):
+        deadline = time.time() + self.boot_timeout
+        while res.update_state() not in (res.READY, res.FAILED_TO_START,
+                                         res.TERMINATED):
+            if time.time() > deadline:
+                raise Exception('Reservation %s did not become ready' % (res,))
+            time.sleep(self.poll_interval)
+        if res.state != res.READY:
+            raise Exception('Reservation %s failed to start' % (res,))
+
+    def run(self, count):
+        self._runs += 1
+        cloud = Cloud.objects.create(name='benchmark-%d' % (self._runs,),
+                                     endpoint='http://example.com/v2.0',
+                                     user_name='benchmark',
+                                     tenant_name='benchmark',
+                                     password='benchmark',
+                                     image_name='image',
+                                     flavor_name='flavor')
+        nova = fakes.FakeNovaClient(images=['image'], flavors=['flavor'],
+                                    latency=self.latency,
+                                    boot_delay=self.boot_delay,
+                                    failure_rate=self.failure_rate,
+                                    error_rate=self.error_rate,
+                                    address='127.0.0.1',
+                                    private_key=self.private_key)
+        cloudslave.models.nova_clients.set(cloud, nova)
+
+        res = cloud.create_reservation(count)
+        if self.measure('start', nova, count, res.start).error is None:
+            ready = self.measure('update_state', nova, count,
+                                 lambda: self._wait_until_ready(res))
+            if ready.error is None:
+                slave = res.slave_set.all()[0]
+                self.measure('run_cmd', nova, count,
+                             lambda: slave.run_cmd('hostname'))
+                self.measure('run_cmd_all', nova, count,
+                             lambda: res.run_cmd_all('hostname'))
+        self.measure('terminate', nova, count, res.terminate)
+
+    def report(self, out=sys.stdout):
+        out.write('%-14s %7s %10s %10s %8s  %s\n' %
+                  ('operation', 'slaves', 'seconds', 'api calls', 'queries',
+                   'error'))
+        for m in self.results:
+            out.write('%-14s %7d %10.3f %10d %8d  %s\n' %
+                      (m.operation, m.slaves, m.seconds, m.api_calls,
+                       m.queries, m.error or ''))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default=','.join(map(str, SIZES)),
+                      help='Comma separated reservation sizes [%default]')
+    parser.add_option('--latency', type='float', default=0,
+                      help='Seconds added to every Nova call [%default]')
+    parser.add_option('--boot-delay', type='float', default=0,
+                      help='Seconds servers take to go ACTIVE [%default]')
+    parser.add_option('--failure-rate', type='float', default=0,
+                      help='Chance of a Nova call failing [%default]')
+    parser.add_option('--error-rate', type='float', default=0,
+                      help='Chance of a server going into ERROR [%default]')
+    parser.add_option('--ssh-latency', type='float', default=0,
+                      help='Seconds added to every SSH command [%default]')
+    options, args = parser.parse_args(argv)
+
+    runner = DjangoTestSuiteRunner(verbosity=0, interactive=False)
+    runner.setup_test_environment()
+    old_config = runner.setup_databases()
+    benchmark = Benchmark(latency=options.latency,
+                          boot_delay=options.boot_delay,
+                          failure_rate=options.failure_rate,
+                          error_rate=options.error_rate,
+                          ssh_latency=options.ssh_latency)
+    benchmark.setup()
+    try:
+        for size in options.sizes.split(','):
+            benchmark.run(int(size))
+    finally:
+        benchmark.teardown()
+        runner.teardown_databases(old_config)
+        runner.teardown_test_environment()
+    benchmark.report()
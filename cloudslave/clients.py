@@ -0,0 +1,60 @@
+#
+#   Copyright 2013 Cisco Systems
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import threading
+
+
+def credentials_hash(cloud):
+    h = hashlib.sha1()
+    for value in (cloud.endpoint, cloud.user_name, cloud.tenant_name,
+                  cloud.password, cloud.region):
+        h.update(value.encode('utf-8'))
+        h.update('\0')
+    return h.hexdigest()
+
+
+# Hands out one Nova client per cloud for the whole process. Clients hold
+# on to their auth token and only go back to Keystone once it expires, so
+# sharing them saves an authentication for every Cloud instance loaded
+# from the database. A client is replaced as soon as the credentials of
+# its cloud change.
+class ClientRegistry(object):
+    def __init__(self, factory):
+        self.factory = factory
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, cloud):
+        key = credentials_hash(cloud)
+        with self._lock:
+            entry = self._clients.get(cloud.name)
+            if entry is None or entry[0] != key:
+                entry = (key, self.factory(cloud))
+                self._clients[cloud.name] = entry
+            return entry[1]
+
+    def set(self, cloud, client):
+        # Makes cloud use the given client, e.g. a fake one.
+        with self._lock:
+            self._clients[cloud.name] = (credentials_hash(cloud), client)
+
+    def invalidate(self, name):
+        with self._lock:
+            self._clients.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
@@ -0,0 +1,166 @@
+#
+#   Copyright 2013 Cisco Systems
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import heapq
+import itertools
+import logging
+import Queue
+import threading
+import time
+
+from cloudslave import exc
+from cloudslave.models import Reservation, new_lease_owner
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReservationFuture(object):
+    def __init__(self, reservation):
+        self.reservation = reservation
+        self.error = None
+        self._done = threading.Event()
+
+    def _finish(self, error=None):
+        self.error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise exc.WaitTimeout('Reservation %s is not ready yet' %
+                                  (self.reservation,))
+        if self.error is not None:
+            raise self.error
+        if self.reservation.state != Reservation.READY:
+            raise exc.ReservationFailed('Reservation %s ended up as %s' %
+                                        (self.reservation,
+                                         self.reservation.get_state_display()))
+        return self.reservation
+
+
+class ReservationDriver(object):
+    # Advances many reservations concurrently. Each reservation is polled
+    # on its own schedule by a pool of worker threads, so a slow cloud or
+    # SSH probe only holds up the reservation it belongs to.
+    # A reservation left SHUTTING_DOWN has failed all the same. Finishing
+    # its teardown is up to terminate(), e.g. through a reconciler.
+    FINAL_STATES = (Reservation.READY, Reservation.FAILED_TO_START,
+                    Reservation.SHUTTING_DOWN, Reservation.TERMINATED)
+
+    def __init__(self, max_workers=16, max_per_cloud=4, poll_interval=5):
+        self.max_workers = max_workers
+        self.max_per_cloud = max_per_cloud
+        self.poll_interval = poll_interval
+        self._schedule = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._work = Queue.Queue()
+        self._limits = {}
+        self._threads = []
+        self._running = False
+        self.owner = new_lease_owner()
+
+    def submit(self, reservation):
+        future = ReservationFuture(reservation)
+        self._schedule_at(time.time(), future)
+        return future
+
+    def _schedule_at(self, when, future):
+        with self._cond:
+            heapq.heappush(self._schedule, (when, next(self._seq), future))
+            self._cond.notify()
+
+    def _limit(self, cloud_id):
+        with self._cond:
+            if cloud_id not in self._limits:
+                self._limits[cloud_id] = threading.Semaphore(
+                                             self.max_per_cloud)
+            return self._limits[cloud_id]
+
+    def _dispatch(self):
+        with self._cond:
+            while self._running:
+                now = time.time()
+                while self._schedule and self._schedule[0][0] <= now:
+                    self._work.put(heapq.heappop(self._schedule)[2])
+                if self._schedule:
+                    self._cond.wait(self._schedule[0][0] - now)
+                else:
+                    self._cond.wait()
+
+    def _worker(self):
+        while True:
+            future = self._work.get()
+            if future is None:
+                return
+            self._advance(future)
+
+    def _advance(self, future):
+        res = future.reservation
+        limit = self._limit(res.cloud_id)
+        if not limit.acquire(False):
+            # This cloud is busy. Don't tie up a worker waiting for it.
+            self._schedule_at(time.time() + self.poll_interval / 10.0,
+                              future)
+            return
+
+        try:
+            with Reservation.leased(self.owner, [res.pk]) as leased:
+                if leased:
+                    # Whoever held the lease before may have moved it on
+                    res.state = leased[0].state
+                    if res.state == Reservation.NEW:
+                        res.start()
+                    state = res.update_state()
+        except Exception, e:
+            logger.error('Failed to advance reservation %s' % (res,),
+                         exc_info=e)
+            future._finish(e)
+            return
+        finally:
+            limit.release()
+
+        if not leased:
+            # Someone else, e.g. a reconciler, is working on it
+            self._schedule_at(time.time() + self.poll_interval, future)
+        elif state in self.FINAL_STATES:
+            future._finish()
+        else:
+            self._schedule_at(time.time() + self.poll_interval, future)
+
+    def start(self):
+        self._running = True
+        self._threads = [threading.Thread(target=self._dispatch)]
+        self._threads += [threading.Thread(target=self._worker)
+                          for x in range(self.max_workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        for x in range(self.max_workers):
+            self._work.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
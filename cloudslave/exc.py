@@ -6,3 +6,22 @@ class NoMatchingImage(Exception):
 
 class NoMatchingFlavor(Exception):
     pass
+
+class IncompleteBoot(CloudSlaveException):
+    pass
+
+class CommandFailed(CloudSlaveException):
+    def __init__(self, message, results=None, exit_status=None, output=None):
+        super(CommandFailed, self).__init__(message)
+        self.results = results
+        self.exit_status = exit_status
+        self.output = output
+
+class ReservationFailed(CloudSlaveException):
+    pass
+
+class WaitTimeout(CloudSlaveException):
+    pass
+
+class NoCapacity(CloudSlaveException):
+    pass
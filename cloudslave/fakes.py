@@ -0,0 +1,353 @@
+#
+#   Copyright 2013 Cisco Systems
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import collections
+import datetime
+import logging
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+
+from novaclient import exceptions as novaclient_exceptions
+import paramiko
+
+
+logger = logging.getLogger(__name__)
+
+# Readiness probes connect and hang up without saying a word, which the
+# server side of paramiko complains loudly about.
+transport_logger = logging.getLogger(__name__ + '.transport')
+transport_logger.addHandler(logging.NullHandler())
+
+# A small in-process stand-in for the parts of the Nova API that
+# cloudslave uses. Servers start out in BUILD and are moved along by
+# calling set_status(), or on their own if the client has a boot_delay.
+# Every API call is counted, and can be made slow or flaky for
+# benchmarking.
+
+CHANGES_SINCE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def api_call(func):
+    def wrapper(self, *args, **kwargs):
+        self.client._call('%s.%s' % (self.name, func.__name__))
+        return func(self, *args, **kwargs)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+class FakeResource(object):
+    def __init__(self, manager, **kwargs):
+        self.manager = manager
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    def delete(self):
+        self.manager.delete(self)
+
+
+class FakeServer(FakeResource):
+    def add_floating_ip(self, address):
+        self.manager.add_floating_ip(self, address)
+
+    def remove_floating_ip(self, address):
+        self.manager.remove_floating_ip(self, address)
+
+
+class FakeManager(object):
+    resource_class = FakeResource
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.resources = []
+
+    def add(self, **kwargs):
+        kwargs.setdefault('id', str(uuid.uuid4()))
+        resource = self.resource_class(self, **kwargs)
+        self.resources.append(resource)
+        return resource
+
+    def _get(self, id):
+        for resource in self.resources:
+            if resource.id == id:
+                return resource
+        raise novaclient_exceptions.NotFound(404)
+
+    @api_call
+    def list(self):
+        return list(self.resources)
+
+    @api_call
+    def get(self, id):
+        return self._get(id)
+
+    @api_call
+    def find(self, **kwargs):
+        for resource in self.resources:
+            if all(getattr(resource, k) == v for k, v in kwargs.items()):
+                return resource
+        raise novaclient_exceptions.NotFound(404)
+
+    @api_call
+    def delete(self, resource):
+        self.resources.remove(self._get(getattr(resource, 'id', resource)))
+
+
+class FakeKeyPairManager(FakeManager):
+    @api_call
+    def create(self, name):
+        private_key = self.client.private_key or 'private key of %s' % (name,)
+        return self.add(id=name, name=name,
+                        private_key=private_key,
+                        public_key='public key of %s' % (name,))
+
+
+class FakeFloatingIPManager(FakeManager):
+    @api_call
+    def create(self):
+        return self.add(ip='172.16.0.%d' % (len(self.resources) + 1,),
+                        instance_id=None)
+
+
+class FakeServerManager(FakeManager):
+    resource_class = FakeServer
+
+    @api_call
+    def create(self, name, image, flavor, key_name=None,
+               min_count=1, max_count=None, **kwargs):
+        max_count = max_count or min_count
+        servers = []
+        for x in range(max_count):
+            if max_count > 1:
+                server_name = '%s-%d' % (name, x + 1)
+            else:
+                server_name = name
+            servers.append(self.add(name=server_name, status='BUILD',
+                                    image=image, flavor=flavor,
+                                    key_name=key_name, networks={},
+                                    updated=self.client.now(),
+                                    boot_at=self.client._boot_at()))
+        return servers[0]
+
+    def _advance(self):
+        # Finishes the boot of servers whose boot_delay has passed
+        now = time.time()
+        for server in self.resources:
+            if (server.status == 'BUILD' and server.boot_at is not None
+                    and server.boot_at <= now):
+                if self.client.random.random() < self.client.error_rate:
+                    self.set_status(server, 'ERROR')
+                else:
+                    self.set_status(server, 'ACTIVE',
+                                    {'private': [self.client._address()]})
+
+    @api_call
+    def get(self, id):
+        self._advance()
+        return self._get(id)
+
+    @api_call
+    def list(self, detailed=True, search_opts=None):
+        self._advance()
+        search_opts = search_opts or {}
+        servers = self.resources + self.client.deleted_servers
+        if 'name' in search_opts:
+            rx = re.compile(search_opts['name'])
+            servers = [srv for srv in servers if rx.match(srv.name)]
+        if 'changes-since' in search_opts:
+            since = datetime.datetime.strptime(search_opts['changes-since'],
+                                               CHANGES_SINCE_FORMAT)
+            servers = [srv for srv in servers if srv.updated >= since]
+        else:
+            servers = [srv for srv in servers if srv.status != 'DELETED']
+        return servers
+
+    def set_status(self, server, status, networks=None):
+        server = self._get(getattr(server, 'id', server))
+        server.status = status
+        if networks is not None:
+            server.networks = networks
+        server.updated = self.client.now()
+
+    @api_call
+    def delete(self, server):
+        server = self._get(getattr(server, 'id', server))
+        self.resources.remove(server)
+        server.status = 'DELETED'
+        server.updated = self.client.now()
+        self.client.deleted_servers.append(server)
+
+    @api_call
+    def add_floating_ip(self, server, address):
+        server.networks.setdefault('private', []).append(address)
+
+    @api_call
+    def remove_floating_ip(self, server, address):
+        server.networks['private'].remove(address)
+
+
+class FakeNovaClient(object):
+    # latency is added to every API call and failure_rate is the chance
+    # that one fails. With a boot_delay, servers go ACTIVE (or ERROR, with
+    # a chance of error_rate) that many seconds after being created, with
+    # address as their IP (unique private addresses by default).
+    def __init__(self, images=(), flavors=(), latency=0, boot_delay=None,
+                 failure_rate=0, error_rate=0, address=None,
+                 private_key=None, seed=None):
+        self.images = FakeManager(self, 'images')
+        self.flavors = FakeManager(self, 'flavors')
+        self.keypairs = FakeKeyPairManager(self, 'keypairs')
+        self.servers = FakeServerManager(self, 'servers')
+        self.floating_ips = FakeFloatingIPManager(self, 'floating_ips')
+        self.deleted_servers = []
+        self.latency = latency
+        self.boot_delay = boot_delay
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.address = address
+        self.private_key = private_key
+        self.random = random.Random(seed)
+        self.calls = collections.defaultdict(int)
+        self._addresses = 0
+        self._lock = threading.Lock()
+        for name in images:
+            self.images.add(name=name)
+        for name in flavors:
+            self.flavors.add(name=name)
+
+    def now(self):
+        return datetime.datetime.utcnow()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+            failed = self.random.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise novaclient_exceptions.ClientException(500, 'Injected failure')
+
+    @property
+    def call_count(self):
+        return sum(self.calls.values())
+
+    def _boot_at(self):
+        if self.boot_delay is None:
+            return None
+        return time.time() + self.boot_delay
+
+    def _address(self):
+        if self.address is not None:
+            return self.address
+        with self._lock:
+            self._addresses += 1
+            return '10.%d.%d.%d' % (self._addresses >> 16 & 255,
+                                    self._addresses >> 8 & 255,
+                                    self._addresses & 255)
+
+
+class _SSHServerInterface(paramiko.ServerInterface):
+    def __init__(self, server):
+        self.server = server
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.server._exec,
+                                  args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class FakeSSHServer(object):
+    # An SSH server on localhost that accepts any key. Commands aren't run;
+    # handler(command) returns the (output, exit status) to send back after
+    # latency seconds. By default the command line is echoed back.
+    def __init__(self, latency=0, handler=None, host_key=None):
+        self.latency = latency
+        self.handler = handler or (lambda command: (command + '\n', 0))
+        self.host_key = host_key or paramiko.RSAKey.generate(1024)
+        self.connections = 0
+        self.commands = 0
+        self._sock = None
+        self._transports = []
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self._sock.getsockname()[1]
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(128)
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._sock.close()
+        with self._lock:
+            for transport in self._transports:
+                transport.close()
+            self._transports = []
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        transport = paramiko.Transport(conn)
+        transport.set_log_channel(transport_logger.name)
+        transport.add_server_key(self.host_key)
+        with self._lock:
+            self.connections += 1
+            self._transports.append(transport)
+        try:
+            transport.start_server(server=_SSHServerInterface(self))
+        except (paramiko.SSHException, EOFError, socket.error), e:
+            logger.debug('SSH negotiation failed: %s' % (e,))
+
+    def _exec(self, channel, command):
+        with self._lock:
+            self.commands += 1
+        if self.latency:
+            time.sleep(self.latency)
+        output, status = self.handler(command)
+        # Closing the channel could beat paramiko's reply to the exec
+        # request, so only send EOF and leave the closing to the client.
+        channel.sendall(output)
+        channel.send_exit_status(status)
+        channel.shutdown_write()
@@ -0,0 +1,145 @@
+#
+#   Copyright 2013 Cisco Systems
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import Queue
+import threading
+
+from cloudslave import exc
+from cloudslave import sshpool
+
+
+logger = logging.getLogger(__name__)
+
+
+class CommandResult(object):
+    def __init__(self, slave):
+        self.slave = slave
+        self.exit_status = None
+        self.error = None
+        self.chunks = []
+
+    @property
+    def output(self):
+        return ''.join(self.chunks)
+
+    @property
+    def succeeded(self):
+        return self.error is None and self.exit_status == 0
+
+
+def run_concurrently(func, items, max_workers):
+    # Calls func on every item using at most max_workers threads. Returns
+    # a dict mapping each item that failed to the exception it raised.
+    work = Queue.Queue()
+    for item in items:
+        work.put(item)
+
+    errors = {}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                item = work.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                func(item)
+            except Exception, e:
+                with lock:
+                    errors[item] = e
+
+    threads = [threading.Thread(target=worker)
+               for x in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def _open_channels(slaves, cmd, input, results, max_workers):
+    # Returns a dict mapping each channel to its result and the pooled
+    # connection it was opened on.
+    channels = {}
+    lock = threading.Lock()
+
+    def open_channel(slave):
+        ssh, chan = slave._open_session(pooled=True)
+        try:
+            chan.set_combine_stderr(True)
+            chan.exec_command(cmd)
+            if input:
+                chan.sendall(input)
+                chan.shutdown_write()
+        except Exception:
+            slave._close_session(ssh, chan, pooled=True)
+            raise
+        with lock:
+            channels[chan] = (results[slave.name], ssh)
+
+    errors = run_concurrently(open_channel, slaves, max_workers)
+    for slave, e in errors.items():
+        logger.error('Failed to run %s on %s' % (cmd, slave), exc_info=e)
+        results[slave.name].error = e
+    return channels
+
+
+def _close_channel(channels, chan):
+    result, ssh = channels.pop(chan)
+    result.slave._close_session(ssh, chan, pooled=True)
+
+
+def _read_channels(channels, fail_fast, read_size):
+    poller = sshpool.Poller(channels)
+    while channels:
+        for chan in poller.ready():
+            result = channels[chan][0]
+            data = chan.recv(read_size)
+            if data:
+                result.chunks.append(data)
+                continue
+
+            result.exit_status = chan.recv_exit_status()
+            poller.unregister(chan)
+            _close_channel(channels, chan)
+            for line in result.output.splitlines():
+                logger.info('%-15s: %s' % (result.slave.name, line))
+            if fail_fast and result.exit_status != 0:
+                return False
+    return True
+
+
+def run_cmd_all(slaves, cmd, input=None, max_workers=10, fail_fast=False,
+                read_size=32768):
+    slaves = list(slaves)
+    results = dict((slave.name, CommandResult(slave)) for slave in slaves)
+    channels = _open_channels(slaves, cmd, input, results, max_workers)
+
+    ok = True
+    try:
+        if fail_fast and len(channels) < len(slaves):
+            ok = False
+        else:
+            ok = _read_channels(channels, fail_fast, read_size)
+    finally:
+        for chan in channels.keys():
+            _close_channel(channels, chan)
+
+    if not ok:
+        raise exc.CommandFailed('Command %s failed' % (cmd,), results)
+    return results
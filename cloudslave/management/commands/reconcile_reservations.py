@@ -0,0 +1,61 @@
+#
+#   Copyright 2013 Cisco Systems
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from cloudslave.reconciler import Reconciler
+
+
+class Command(BaseCommand):
+    help = ('Starts, advances, times out and cleans up reservations until '
+            'interrupted.')
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='float', default=5,
+                    help='Seconds between passes [default: %default]'),
+        make_option('--max-per-cloud', type='int', default=4,
+                    help='Reservations per cloud handled at once '
+                         '[default: %default]'),
+        make_option('--no-start', action='store_false', dest='start_new',
+                    default=True,
+                    help="Don't start new reservations, only advance and "
+                         "clean up"),
+        make_option('--batch-size', type='int', default=None,
+                    help='Most reservations per cloud to lease per pass, '
+                         'so other workers get a share '
+                         '[default: 4 x --max-per-cloud]'),
+        make_option('--lease-ttl', type='int', default=300,
+                    help='Seconds a lease lasts without being renewed '
+                         '[default: %default]'),
+        make_option('--once', action='store_true', default=False,
+                    help='Do a single pass and exit'),
+    )
+
+    def handle(self, *args, **options):
+        reconciler = Reconciler(max_per_cloud=options['max_per_cloud'],
+                                interval=options['interval'],
+                                start_new=options['start_new'],
+                                batch_size=options['batch_size'],
+                                lease_ttl=options['lease_ttl'])
+        if options['once']:
+            count = reconciler.run_once()
+            self.stdout.write('Reconciled %d reservations' % (count,))
+            return
+
+        try:
+            reconciler.run()
+        except KeyboardInterrupt:
+            reconciler.stop()
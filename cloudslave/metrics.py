@@ -0,0 +1,140 @@
+#
+#   Copyright 2013 Cisco Systems
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the histogram buckets. They cover
+# everything from a quick API call to a slow boot.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+           60, 120, 300, 600, 1800)
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, p):
+        # Returns the upper bound of the bucket the p-th percentile falls
+        # in, which is as precise as a bucketed histogram gets.
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if idx < len(self.buckets):
+                    return min(self.buckets[idx], self.max)
+                return self.max
+        return self.max
+
+
+class HistogramCollector(object):
+    # Keeps a histogram for every combination of metric name and tags.
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, value, tags):
+        key = (name, tuple(sorted(tags.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(self.buckets)
+                self._histograms[key] = histogram
+            histogram.add(value)
+
+    def histogram(self, name, **tags):
+        with self._lock:
+            return self._histograms.get((name, tuple(sorted(tags.items()))))
+
+    def series(self, name=None):
+        # Returns a list of (name, tags, histogram)
+        with self._lock:
+            return [(key[0], dict(key[1]), histogram)
+                    for key, histogram in sorted(self._histograms.items())
+                    if name is None or key[0] == name]
+
+    def calls(self, prefix='nova.', tag='cloud'):
+        # Number of recorded operations per value of tag, e.g. the
+        # number of Nova API calls made to each cloud.
+        counts = {}
+        for name, tags, histogram in self.series():
+            if name.startswith(prefix) and tag in tags:
+                counts[tags[tag]] = counts.get(tags[tag], 0) + histogram.count
+        return counts
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+# Anything with a record(name, value, tags) method can be added here to
+# send measurements elsewhere, e.g. to statsd.
+default_collector = HistogramCollector()
+collectors = [default_collector]
+
+
+def add_collector(collector):
+    collectors.append(collector)
+
+
+def remove_collector(collector):
+    collectors.remove(collector)
+
+
+def record(name, value, **tags):
+    for collector in list(collectors):
+        try:
+            collector.record(name, value, tags)
+        except Exception, e:
+            logger.error('Collector %r failed' % (collector,), exc_info=e)
+
+
+@contextlib.contextmanager
+def timed(name, **tags):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start, **tags)
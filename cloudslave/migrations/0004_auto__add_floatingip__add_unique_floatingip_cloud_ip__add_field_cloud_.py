@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'FloatingIP'
+        db.create_table(u'cloudslave_floatingip', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('cloud', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['cloudslave.Cloud'])),
+            ('ip', self.gf('django.db.models.fields.IPAddressField')(max_length=15)),
+            ('nova_id', self.gf('django.db.models.fields.CharField')(max_length=200)),
+            ('in_use', self.gf('django.db.models.fields.BooleanField')(default=False)),
+        ))
+        db.send_create_signal(u'cloudslave', ['FloatingIP'])
+
+        # Adding unique constraint on 'FloatingIP', fields ['cloud', 'ip']
+        db.create_unique(u'cloudslave_floatingip', ['cloud_id', 'ip'])
+
+        # Adding field 'Cloud.floating_ip_pool_size'
+        db.add_column(u'cloudslave_cloud', 'floating_ip_pool_size',
+                      self.gf('django.db.models.fields.IntegerField')(default=0),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'FloatingIP', fields ['cloud', 'ip']
+        db.delete_unique(u'cloudslave_floatingip', ['cloud_id', 'ip'])
+
+        # Deleting model 'FloatingIP'
+        db.delete_table(u'cloudslave_floatingip')
+
+        # Deleting field 'Cloud.floating_ip_pool_size'
+        db.delete_column(u'cloudslave_cloud', 'floating_ip_pool_size')
+
+
+    models = {
+        u'cloudslave.cloud': {
+            'Meta': {'object_name': 'Cloud'},
+            'endpoint': ('django.db.models.fields.URLField', [], {'max_length': '200'}),
+            'flavor_name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'floating_ip_mode': ('django.db.models.fields.SmallIntegerField', [], {'default': '0'}),
+            'floating_ip_pool_size': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'image_name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200', 'primary_key': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'region': ('django.db.models.fields.CharField', [], {'max_length': '200', 'blank': 'True'}),
+            'tenant_name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'user_name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'warm_pool_floor': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'warm_pool_size': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        },
+        u'cloudslave.floatingip': {
+            'Meta': {'unique_together': "(('cloud', 'ip'),)", 'object_name': 'FloatingIP'},
+            'cloud': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['cloudslave.Cloud']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'in_use': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'ip': ('django.db.models.fields.IPAddressField', [], {'max_length': '15'}),
+            'nova_id': ('django.db.models.fields.CharField', [], {'max_length': '200'})
+        },
+        u'cloudslave.keypair': {
+            'Meta': {'unique_together': "(('cloud', 'name'),)", 'object_name': 'KeyPair'},
+            'cloud': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['cloudslave.Cloud']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'private_key': ('django.db.models.fields.TextField', [], {}),
+            'public_key': ('django.db.models.fields.TextField', [], {})
+        },
+        u'cloudslave.reservation': {
+            'Meta': {'object_name': 'Reservation'},
+            'cloud': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['cloudslave.Cloud']"}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'number_of_slaves': ('django.db.models.fields.IntegerField', [], {}),
+            'pool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'state': ('django.db.models.fields.SmallIntegerField', [], {'default': '0'}),
+            'timeout': ('django.db.models.fields.DateTimeField', [], {})
+        },
+        u'cloudslave.slave': {
+            'Meta': {'object_name': 'Slave'},
+            'cloud_node_id': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'floating_ip': ('django.db.models.fields.IPAddressField', [], {'max_length': '15', 'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200', 'primary_key': 'True'}),
+            'reservation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['cloudslave.Reservation']"}),
+            'state': ('django.db.models.fields.CharField', [], {'max_length': '15', 'null': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['cloudslave']
\ No newline at end of file
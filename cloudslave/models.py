@@ -13,18 +13,32 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import collections
+import contextlib
 import datetime
-import errno
 import logging
+import os.path
 import random
 import re
-import select
 import socket
 import string
 import StringIO
-
-from django.db import models
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import F, Q, Sum
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from cloudslave import cache
+from cloudslave import clients
 from cloudslave import exc
+from cloudslave import fanout
+from cloudslave import metrics
+from cloudslave import placement
+from cloudslave import sshpool
 
 from novaclient.v1_1 import client
 from novaclient import exceptions as novaclient_exceptions
@@ -33,6 +47,80 @@ import paramiko
 
 logger = logging.getLogger(__name__)
 
+# Image and flavor catalogs rarely change, so resolved names are shared
+# between all Cloud instances in the process for this many seconds.
+catalog_cache = cache.TTLCache(getattr(settings, 'CLOUDSLAVE_CATALOG_TTL',
+                                       3600))
+
+# Keypairs are looked up for every SSH connection, so they're shared
+# between Cloud instances too. Saving or deleting a KeyPair drops the
+# entry of its cloud.
+keypair_cache = cache.TTLCache(getattr(settings, 'CLOUDSLAVE_KEYPAIR_TTL',
+                                       3600))
+
+# SystemRandom reads from os.urandom, so forked workers don't end up
+# generating the same sequence of names.
+_name_random = random.SystemRandom()
+
+# Slaves that have answered over SSH once aren't probed again.
+ssh_ready_cache = cache.TTLCache(getattr(settings, 'CLOUDSLAVE_SSH_READY_TTL',
+                                         3600))
+
+WARM_POOL_DEMAND_WINDOW = datetime.timedelta(
+    seconds=getattr(settings, 'CLOUDSLAVE_WARM_POOL_DEMAND_WINDOW', 3600))
+
+# A fetched Nova server is reused for this many seconds, so one
+# operation on a slave doesn't GET the same server over and over.
+SERVER_TTL = getattr(settings, 'CLOUDSLAVE_SERVER_TTL', 10)
+
+
+class CloudBootStats(placement.BootStats):
+    # Keeps the averages on the Cloud rows as well. Whoever picks a cloud
+    # is rarely the process that saw the reservations through, e.g. when
+    # a reconciler advances them, so each pick starts from the database.
+    def _persist(self, name, field, value):
+        # The first sample is taken as is. After that the update is done
+        # by the database, so concurrent samples don't overwrite each other.
+        if not Cloud.objects.filter(pk=name, **{field: None}).update(
+                **{field: value}):
+            Cloud.objects.filter(pk=name).update(
+                **{field: F(field) * (1 - self.alpha) + self.alpha * value})
+
+    def record_ready(self, name, seconds):
+        super(CloudBootStats, self).record_ready(name, seconds)
+        self._persist(name, 'average_boot_time', float(seconds))
+        self._persist(name, 'boot_failure_rate', 0.0)
+
+    def record_failure(self, name):
+        super(CloudBootStats, self).record_failure(name)
+        self._persist(name, 'boot_failure_rate', 1.0)
+
+    def load_clouds(self, clouds):
+        for cloud in clouds:
+            self.load(cloud.name, cloud.average_boot_time,
+                      cloud.boot_failure_rate)
+
+
+# Boot statistics steer where new reservations go
+boot_stats = CloudBootStats()
+scheduler = placement.PlacementScheduler(
+    boot_stats, quota_ttl=getattr(settings, 'CLOUDSLAVE_QUOTA_TTL', 60))
+
+# Seconds a worker leases a reservation for, see Reservation.acquire_leases
+LEASE_TTL = getattr(settings, 'CLOUDSLAVE_LEASE_TTL', 300)
+
+SSH_PORT = getattr(settings, 'CLOUDSLAVE_SSH_PORT', 22)
+
+SSH_READ_SIZE = getattr(settings, 'CLOUDSLAVE_SSH_READ_SIZE', 32768)
+
+# How many slaves of a reservation are checked over SSH at once
+SSH_READY_WORKERS = getattr(settings, 'CLOUDSLAVE_SSH_READY_WORKERS', 10)
+
+ssh_pool = sshpool.SSHPool(
+    max_connections=getattr(settings, 'CLOUDSLAVE_SSH_MAX_CONNECTIONS', 100),
+    idle_timeout=getattr(settings, 'CLOUDSLAVE_SSH_IDLE_TIMEOUT', 300),
+    keepalive=getattr(settings, 'CLOUDSLAVE_SSH_KEEPALIVE', 30))
+
 
 class Cloud(models.Model):
     DOES_NOT_NEED_FLOATING_IP = 0
@@ -54,6 +142,12 @@ class Cloud(models.Model):
     image_name = models.CharField(max_length=200)
     floating_ip_mode = models.SmallIntegerField(choices=FLOATING_IP_MODES,
                                                 default=0)
+    warm_pool_size = models.IntegerField(default=0)
+    warm_pool_floor = models.IntegerField(default=0)
+    floating_ip_pool_size = models.IntegerField(default=0)
+    # Moving averages kept up to date by CloudBootStats
+    average_boot_time = models.FloatField(blank=True, null=True)
+    boot_failure_rate = models.FloatField(blank=True, null=True)
 
     def __init__(self, *args, **kwargs):
         self._client = None
@@ -63,77 +157,347 @@ class Cloud(models.Model):
         return self.name
 
     @classmethod
-    def get_random(cls):
-        return random.choice(cls.objects.all())
+    def get_random(cls, count=1):
+        # Despite the name, this is a weighted choice: see
+        # placement.PlacementScheduler.
+        active = Reservation.objects.active()
+        active_slaves = dict(
+            (row['cloud'], row['slaves']) for row in
+            active.values('cloud').annotate(slaves=Sum('number_of_slaves')))
+        clouds = list(cls.objects.all())
+        boot_stats.load_clouds(clouds)
+        return scheduler.choose(clouds, active_slaves, count)
+
+    def _create_client(self):
+        kwargs = {}
+        if self.region:
+            kwargs['region_name'] = self.region
+
+        nova = client.Client(self.user_name,
+                             self.password,
+                             self.tenant_name,
+                             self.endpoint,
+                             service_type="compute",
+                             **kwargs)
+        return nova
 
     @property
     def client(self):
         if self._client is None:
-            kwargs = {}
-            if self.region:
-                kwargs['region_name'] = self.region
-
-            self._client = client.Client(self.user_name,
-                                         self.password,
-                                         self.tenant_name,
-                                         self.endpoint,
-                                         service_type="compute",
-                                         **kwargs)
-            self._client.cloud = self
-
+            self._client = nova_clients.get(self)
         return self._client
 
-    def _random_string(self, length=8):
+    def _random_string(self, length=12):
         alphabet = string.lowercase + string.digits
-        return ''.join([random.choice(alphabet) for x in range(length)])
+        return ''.join([_name_random.choice(alphabet) for x in range(length)])
 
-    def _get_unique_name(self, mgr):
-        existing_names = set(kp.name for kp in mgr.list())
+    def _get_unique_name(self, model):
+        # 12 characters from urandom make collisions between concurrent
+        # workers vanishingly unlikely, and the local check catches the
+        # rest without listing everything in the tenant.
         while True:
             name = 'cloudslave-%s' % (self._random_string(),)
-            if name not in existing_names:
+            if not model.objects.filter(name__startswith=name).exists():
                 return name
 
     def _get_unique_slave_name(self):
-        return self._get_unique_name(self.client.servers)
+        return self._get_unique_name(Slave)
 
     def _get_unique_keypair_name(self):
-        return self._get_unique_name(self.client.keypairs)
+        return self._get_unique_name(KeyPair)
 
-    @property
-    def image(self):
+    def _find_image(self):
         rx = re.compile(self.image_name)
-        for image in self.client.images.list():
+        with metrics.timed('nova.images.list', cloud=self.name):
+            images = self.client.images.list()
+        for image in images:
             if rx.match(image.name):
                 return image
         raise exc.NoMatchingImage(self.image_name)
 
-    @property
-    def flavor(self):
-        for flavor in self.client.flavors.list():
+    def _find_flavor(self):
+        with metrics.timed('nova.flavors.list', cloud=self.name):
+            flavors = self.client.flavors.list()
+        for flavor in flavors:
             if flavor.name == self.flavor_name:
                 return flavor
         raise exc.NoMatchingFlavor(self.flavor_name)
 
     @property
-    def keypair(self):
-        if self.keypair_set.count() < 1:
-            logger.info('Cloud %s does not have a keypair yet. '
-                        'Creating' % (self,))
-            name = self._get_unique_keypair_name()
+    def image(self):
+        return catalog_cache.get_or_create((self.name, 'image',
+                                            self.image_name),
+                                           self._find_image)
+
+    @property
+    def flavor(self):
+        return catalog_cache.get_or_create((self.name, 'flavor',
+                                            self.flavor_name),
+                                           self._find_flavor)
+
+    def invalidate_catalog(self):
+        catalog_cache.invalidate((self.name, 'image', self.image_name))
+        catalog_cache.invalidate((self.name, 'flavor', self.flavor_name))
+
+    def _get_or_create_keypair(self):
+        keypairs = self.keypair_set.all()[:1]
+        if keypairs:
+            return keypairs[0]
+
+        logger.info('Cloud %s does not have a keypair yet. '
+                    'Creating' % (self,))
+        name = self._get_unique_keypair_name()
+        with metrics.timed('nova.keypairs.create', cloud=self.name):
             kp = self.client.keypairs.create(name=name)
-            keypair = KeyPair(cloud=self, name=name,
-                              private_key=kp.private_key,
-                              public_key=kp.public_key)
-            keypair.save()
-            logger.info('KeyPair %s created' % (keypair,))
-        return self.keypair_set.all()[0]
-
-    def create_reservation(self, count=1):
-        res = Reservation(cloud=self, number_of_slaves=count)
+        keypair = KeyPair(cloud=self, name=name,
+                          private_key=kp.private_key,
+                          public_key=kp.public_key)
+        keypair.save()
+        logger.info('KeyPair %s created' % (keypair,))
+        return keypair
+
+    @property
+    def keypair(self):
+        return keypair_cache.get_or_create(self.name,
+                                           self._get_or_create_keypair)
+
+    def create_reservation(self, count=1, pool=False, lease_owner=None):
+        # With lease_owner the reservation is created leased to it, so no
+        # reconciler can pick it up before the owner is done with it.
+        res = Reservation(cloud=self, number_of_slaves=count, pool=pool)
+        if lease_owner is not None:
+            res.lease_owner = lease_owner
+            res.lease_expires = (datetime.datetime.now() +
+                                 datetime.timedelta(seconds=LEASE_TTL))
         res.save()
         return res
 
+    def _pooled_slaves(self):
+        return Slave.objects.filter(reservation__cloud=self,
+                                    reservation__pool=True)
+
+    def claim_slaves(self, reservation, count):
+        # Moves up to count ready slaves from the warm pool over to
+        # reservation. The conditional update makes sure that a slave is
+        # only ever handed out once, even with several processes claiming.
+        ready = self._pooled_slaves().filter(
+                    reservation__state=Reservation.READY)
+        claimed = []
+        tried = set()
+        while len(claimed) < count:
+            candidates = list(ready.exclude(pk__in=tried)
+                                   .values_list('pk', 'reservation')
+                                   [:count - len(claimed)])
+            if not candidates:
+                break
+            for pk, pool_res in candidates:
+                tried.add(pk)
+                if Slave.objects.filter(pk=pk, reservation=pool_res).update(
+                        reservation=reservation):
+                    claimed.append(pk)
+
+        if claimed:
+            logger.info('Claimed %d slave(s) from the warm pool of %s for '
+                        'reservation %s' % (len(claimed), self, reservation))
+        return claimed
+
+    def return_slaves(self, slave_pks):
+        # Puts slaves claimed from the warm pool back into it, under a new
+        # pool reservation that's ready right away.
+        pool = Reservation(cloud=self, number_of_slaves=len(slave_pks),
+                           pool=True, state=Reservation.READY)
+        pool.save()
+        Slave.objects.filter(pk__in=slave_pks).update(reservation=pool)
+        logger.info('Returned %d slave(s) to the warm pool of %s' %
+                    (len(slave_pks), self))
+
+    def warm_pool_target(self):
+        # The pool grows with the number of slaves recently asked for, up
+        # to warm_pool_size, and shrinks back to warm_pool_floor when
+        # demand drops.
+        since = datetime.datetime.now() - WARM_POOL_DEMAND_WINDOW
+        demand = (self.reservation_set.filter(pool=False, created__gte=since)
+                      .aggregate(models.Sum('number_of_slaves'))
+                      ['number_of_slaves__sum'] or 0)
+        return max(self.warm_pool_floor, min(self.warm_pool_size, demand))
+
+    def maintain_warm_pool(self):
+        # The reservations created here are leased until they've been
+        # dealt with, or a reconciler would start them a second time.
+        owner = new_lease_owner()
+        pools = self.reservation_set.filter(pool=True)
+        ids = list(pools.filter(state__in=[Reservation.NEW,
+                                           Reservation.BOOTING])
+                        .values_list('pk', flat=True))
+        with Reservation.leased(owner, ids) as reservations:
+            for res in reservations:
+                res.update_state()
+
+        target = self.warm_pool_target()
+        pooled = self._pooled_slaves().filter(
+                     reservation__state__in=[Reservation.BOOTING,
+                                             Reservation.READY])
+        available = pooled.count()
+        if available < target:
+            logger.info('Adding %d slave(s) to the warm pool of %s' %
+                        (target - available, self))
+            res = self.create_reservation(target - available, pool=True,
+                                          lease_owner=owner)
+            try:
+                res.start()
+            finally:
+                Reservation.release_leases(owner, [res.pk])
+        elif available > target:
+            logger.info('Removing %d slave(s) from the warm pool of %s' %
+                        (available - target, self))
+            # Claim the excess slaves first, so they can't be handed out
+            # while we're tearing them down.
+            drain = self.create_reservation(available - target, pool=True,
+                                            lease_owner=owner)
+            try:
+                self.claim_slaves(drain, available - target)
+                drain.terminate()
+            finally:
+                Reservation.release_leases(owner, [drain.pk])
+
+        # Pool reservations that have handed out all their slaves
+        pools.filter(slave__isnull=True).exclude(
+            state__in=[Reservation.NEW, Reservation.BOOTING]).delete()
+        return target
+
+    def acquire_floating_ip(self):
+        idle = FloatingIP.objects.filter(cloud=self, in_use=False)
+        for fip in idle[:5]:
+            # Only one process gets to flip in_use on a given address
+            if not FloatingIP.objects.filter(pk=fip.pk, in_use=False).update(
+                    in_use=True):
+                continue
+            if self._floating_ip_is_free(fip):
+                logger.debug('Reusing floating IP %s' % (fip.ip,))
+                return fip.ip
+            fip.delete()
+
+        with metrics.timed('nova.floating_ips.create', cloud=self.name):
+            floating_ip = self.client.floating_ips.create()
+        if self.floating_ip_pool_size > 0:
+            FloatingIP.objects.create(cloud=self, ip=floating_ip.ip,
+                                      nova_id=floating_ip.id, in_use=True)
+        return floating_ip.ip
+
+    def _floating_ip_is_free(self, fip):
+        # The address may have been released or attached to something else
+        # behind our back while it sat in the pool.
+        try:
+            with metrics.timed('nova.floating_ips.get', cloud=self.name):
+                nova_fip = self.client.floating_ips.get(fip.nova_id)
+        except novaclient_exceptions.NotFound:
+            logger.info('Floating IP %s is gone from Nova' % (fip.ip,))
+            return False
+        if getattr(nova_fip, 'instance_id', None):
+            logger.info('Floating IP %s is attached to something we '
+                        'don\'t know about. Forgetting it.' % (fip.ip,))
+            return False
+        return True
+
+    def release_floating_ip(self, ip, floating_ips=None):
+        tracked = list(FloatingIP.objects.filter(cloud=self, ip=ip))
+        if not tracked:
+            if floating_ips is None:
+                with metrics.timed('nova.floating_ips.find', cloud=self.name):
+                    ref = self.client.floating_ips.find(ip=ip)
+            else:
+                ref = floating_ips.get(ip)
+            if ref is not None:
+                with metrics.timed('nova.floating_ips.delete',
+                                   cloud=self.name):
+                    ref.delete()
+            return
+
+        fip = tracked[0]
+        with transaction.commit_on_success():
+            # Locking the cloud's row keeps concurrent releases from all
+            # seeing room in the pool and overfilling it.
+            list(Cloud.objects.select_for_update().filter(pk=self.pk))
+            idle = FloatingIP.objects.filter(cloud=self, in_use=False).count()
+            if idle < self.floating_ip_pool_size:
+                FloatingIP.objects.filter(pk=fip.pk).update(in_use=False)
+                return
+
+        try:
+            with metrics.timed('nova.floating_ips.delete', cloud=self.name):
+                self.client.floating_ips.delete(fip.nova_id)
+        except novaclient_exceptions.NotFound:
+            pass
+        fip.delete()
+
+    def reconcile_floating_ips(self):
+        # Brings the floating IP pool in line with what Nova and the Slave
+        # table say. Meant to be run at startup, e.g. after a crash.
+        with metrics.timed('nova.floating_ips.list', cloud=self.name):
+            nova_ips = dict((fip.ip, fip)
+                            for fip in self.client.floating_ips.list())
+        used_ips = set(Slave.objects.filter(reservation__cloud=self)
+                                    .exclude(floating_ip=None)
+                                    .values_list('floating_ip', flat=True))
+        for fip in FloatingIP.objects.filter(cloud=self):
+            nova_fip = nova_ips.get(fip.ip)
+            if nova_fip is None:
+                logger.info('Floating IP %s is gone from Nova' % (fip.ip,))
+                fip.delete()
+            elif fip.ip in used_ips:
+                if not fip.in_use:
+                    fip.in_use = True
+                    fip.save()
+            elif getattr(nova_fip, 'instance_id', None):
+                logger.info('Floating IP %s is attached to something we '
+                            'don\'t know about. Forgetting it.' % (fip.ip,))
+                fip.delete()
+            elif fip.in_use:
+                logger.info('Returning leaked floating IP %s to the pool' %
+                            (fip.ip,))
+                fip.in_use = False
+                fip.save()
+
+        idle = FloatingIP.objects.filter(cloud=self, in_use=False)
+        for fip in idle[self.floating_ip_pool_size:]:
+            with metrics.timed('nova.floating_ips.delete', cloud=self.name):
+                self.client.floating_ips.delete(fip.nova_id)
+            fip.delete()
+
+    def servers_by_id(self, slaves=None):
+        search_opts = {}
+        if slaves is not None:
+            # Slaves booted together share their name prefix, which lets
+            # Nova do the filtering for us.
+            prefix = os.path.commonprefix([slave.name for slave in slaves])
+            if prefix:
+                search_opts['name'] = '^%s' % (prefix,)
+        with metrics.timed('nova.servers.list', cloud=self.name):
+            servers = self.client.servers.list(search_opts=search_opts)
+        return dict((srv.id, srv) for srv in servers)
+
+    def update_reservations(self):
+        # Reservations somebody else holds a lease on are skipped
+        ids = list(self.reservation_set.filter(state=Reservation.BOOTING)
+                                       .values_list('pk', flat=True))
+        with Reservation.leased(new_lease_owner(), ids) as reservations:
+            if reservations:
+                servers = self.servers_by_id()
+                for res in reservations:
+                    res.update_state(servers)
+        return reservations
+
+
+# Authenticated clients are shared by all Cloud instances in the process.
+# Changed credentials are picked up through the key of the registry, so
+# saving a Cloud doesn't throw away a perfectly good token.
+nova_clients = clients.ClientRegistry(Cloud._create_client)
+
+
+@receiver(post_delete, sender=Cloud)
+def _cloud_deleted(sender, instance, **kwargs):
+    nova_clients.invalidate(instance.name)
+
 
 class KeyPair(models.Model):
     cloud = models.ForeignKey(Cloud)
@@ -148,6 +512,85 @@ class KeyPair(models.Model):
         verbose_name_plural = "series"
         unique_together = ('cloud', 'name')
 
+    @property
+    def paramiko_key(self):
+        cached = _parsed_keys.get(self.pk)
+        if cached is None or cached[0] != self.private_key:
+            priv_key_file = StringIO.StringIO(self.private_key)
+            pkey = paramiko.RSAKey.from_private_key(priv_key_file)
+            cached = (self.private_key, pkey)
+            _parsed_keys[self.pk] = cached
+        return cached[1]
+
+
+# Parsing RSA keys is expensive, so keep the parsed version around, keyed
+# by KeyPair and the private key it was parsed from.
+_parsed_keys = {}
+
+
+@receiver(post_save, sender=KeyPair)
+@receiver(post_delete, sender=KeyPair)
+def _keypair_changed(sender, instance, **kwargs):
+    _parsed_keys.pop(instance.pk, None)
+    keypair_cache.invalidate(instance.cloud_id)
+
+
+class FloatingIP(models.Model):
+    cloud = models.ForeignKey(Cloud)
+    ip = models.IPAddressField()
+    nova_id = models.CharField(max_length=200)
+    in_use = models.BooleanField(default=False)
+
+    def __unicode__(self):
+        return '%s@%s' % (self.ip, self.cloud)
+
+    class Meta:
+        unique_together = ('cloud', 'ip')
+
+
+def new_lease_owner():
+    return '%s:%d:%s' % (socket.gethostname(), os.getpid(),
+                         uuid.uuid4().hex[:8])
+
+
+class LeaseRenewer(threading.Thread):
+    # Keeps extending leases for as long as the work they cover goes on,
+    # so they don't run out in the middle of a long pass.
+    def __init__(self, owner, ids, ttl):
+        super(LeaseRenewer, self).__init__()
+        self.daemon = True
+        self.owner = owner
+        self.ids = ids
+        self.ttl = ttl
+        self._stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stopped.wait(self.ttl / 3.0):
+                try:
+                    Reservation.renew_leases(self.owner, self.ids, self.ttl)
+                except Exception, e:
+                    logger.error('Failed to renew leases of %s' %
+                                 (self.owner,), exc_info=e)
+        finally:
+            connection.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class ReservationManager(models.Manager):
+    def active(self):
+        return self.filter(state__in=(self.model.NEW, self.model.BOOTING,
+                                      self.model.READY,
+                                      self.model.SHUTTING_DOWN))
+
+    def expired(self, now=None):
+        # Reservations that should have been ready by now
+        return self.filter(state__in=(self.model.NEW, self.model.BOOTING),
+                           timeout__lt=now or datetime.datetime.now())
+
 
 class Reservation(models.Model):
     DEFAULT_TIMEOUT = 180  # 3 minutes
@@ -172,88 +615,622 @@ class Reservation(models.Model):
     state = models.SmallIntegerField(default=NEW,
                                      choices=RESERVATION_STATES)
     timeout = models.DateTimeField(blank=False, null=False)
+    created = models.DateTimeField(auto_now_add=True)
+    pool = models.BooleanField(default=False)
+    group = models.ForeignKey('ReservationGroup', blank=True, null=True)
+    lease_owner = models.CharField(max_length=200, blank=True, null=True)
+    lease_expires = models.DateTimeField(blank=True, null=True)
+    # When all of the slaves were first seen ACTIVE, for measuring how long
+    # they then take to answer over SSH. Stored rather than kept in memory
+    # since the next process to advance the reservation may not be this one.
+    active_since = models.DateTimeField(blank=True, null=True)
+
+    objects = ReservationManager()
+
+    class Meta:
+        index_together = [['state', 'timeout']]
 
     def __unicode__(self):
         return '%s' % self.pk
 
+    @classmethod
+    def acquire_leases(cls, owner, ids, ttl, limit=None):
+        # Leases up to limit of the given reservations to owner for ttl
+        # seconds and returns the ones it got. The conditional UPDATE is
+        # atomic per row, so competing workers never lease the same one.
+        now = datetime.datetime.now()
+        available = (Q(lease_owner=None) | Q(lease_expires__lt=now) |
+                     Q(lease_owner=owner))
+        ids = list(cls.objects.filter(available, pk__in=ids)
+                              .order_by('pk')
+                              .values_list('pk', flat=True)[:limit])
+        cls.objects.filter(available, pk__in=ids).update(
+            lease_owner=owner,
+            lease_expires=now + datetime.timedelta(seconds=ttl))
+        return list(cls.objects.filter(pk__in=ids, lease_owner=owner)
+                               .select_related('cloud'))
+
+    @classmethod
+    def release_leases(cls, owner, ids):
+        cls.objects.filter(pk__in=ids, lease_owner=owner).update(
+            lease_owner=None, lease_expires=None)
+
+    @classmethod
+    def renew_leases(cls, owner, ids, ttl):
+        cls.objects.filter(pk__in=ids, lease_owner=owner).update(
+            lease_expires=(datetime.datetime.now() +
+                           datetime.timedelta(seconds=ttl)))
+
+    @classmethod
+    @contextlib.contextmanager
+    def leased(cls, owner, ids, ttl=None, limit=None):
+        # Leases what it can of the given reservations for the duration of
+        # the with block, which gets the leased ones. Reservations leased
+        # to someone else are left out.
+        ttl = ttl or LEASE_TTL
+        reservations = cls.acquire_leases(owner, ids, ttl, limit)
+        ids = [res.pk for res in reservations]
+        renewer = LeaseRenewer(owner, ids, ttl)
+        renewer.start()
+        try:
+            yield reservations
+        finally:
+            renewer.stop()
+            cls.release_leases(owner, ids)
+
     def save(self, **kwargs):
         if self.timeout is None:
             self.timeout = (datetime.datetime.now()
                             + datetime.timedelta(seconds=self.DEFAULT_TIMEOUT))
         return super(Reservation, self).save(**kwargs)
 
+    def _boot_servers(self, name, image, flavor, key_name, count):
+        client = self.cloud.client
+        try:
+            with metrics.timed('nova.servers.create', cloud=self.cloud_id):
+                srv = client.servers.create(name, image, flavor,
+                                            key_name=key_name,
+                                            min_count=count, max_count=count)
+        except novaclient_exceptions.BadRequest:
+            # The cached image or flavor may have been deleted in the
+            # meantime. Look them up again and retry once if they changed.
+            self.cloud.invalidate_catalog()
+            fresh_image, fresh_flavor = self.cloud.image, self.cloud.flavor
+            if (fresh_image.id, fresh_flavor.id) == (image.id, flavor.id):
+                raise
+            logger.info('Image or flavor on cloud %s changed. Retrying.' %
+                        (self.cloud,))
+            with metrics.timed('nova.servers.create', cloud=self.cloud_id):
+                srv = client.servers.create(name, fresh_image, fresh_flavor,
+                                            key_name=key_name,
+                                            min_count=count, max_count=count)
+        if count == 1:
+            return [srv]
+        return self._list_booted(name)
+
+    def _list_booted(self, name):
+        # Nova derives the names of a multi-create request from the name we
+        # passed in, so a single filtered listing finds all of them.
+        with metrics.timed('nova.servers.list', cloud=self.cloud_id):
+            return self.cloud.client.servers.list(
+                       search_opts={'name': '^%s' % (name,)})
+
+    def _prepare_boot(self):
+        # Does everything start() needs the database for, so the boot
+        # itself only has to talk to Nova. Returns the arguments for
+        # _boot_servers, or None if the warm pool covered everything.
+        cloud = self.cloud
+        # Slaves already here, e.g. claimed by a start that didn't get to
+        # finish, count towards the reservation.
+        wanted = self.number_of_slaves - self.slave_set.count()
+        claimed = []
+        if not self.pool and cloud.warm_pool_size > 0 and wanted > 0:
+            claimed = cloud.claim_slaves(self, wanted)
+        # Kept around so a failed start can hand them back
+        self._claimed = claimed
+        count = wanted - len(claimed)
+        if count <= 0:
+            logger.info('Reservation %s needs no new servers' % (self,))
+            return None
+
+        image = cloud.image
+        flavor = cloud.flavor
+        key_name = cloud.keypair.name
+        name = cloud._get_unique_slave_name()
+        return (name, image, flavor, key_name, count)
+
+    def _record_boot(self, name, count, servers):
+        if len(servers) < count:
+            # The listing can lag behind the create request. Look once more
+            # so every server Nova did create gets recorded, and with that
+            # deleted when the reservation is torn down.
+            servers = self._list_booted(name)
+
+        slaves = []
+        for idx, srv in enumerate(servers):
+            slave_name = srv.name
+            if slave_name == name and len(servers) > 1:
+                slave_name = '%s-%d' % (name, idx + 1)
+            slaves.append(Slave(name=slave_name, reservation=self,
+                                cloud_node_id=srv.id))
+        Slave.objects.bulk_create(slaves)
+        if len(slaves) != count:
+            raise exc.IncompleteBoot('Expected %d servers named %s*, found %d'
+                                     % (count, name, len(slaves)))
+
     def start(self):
+        with metrics.timed('reservation.start', cloud=self.cloud_id):
+            self._start()
+
+    def _start(self):
         try:
-            for x in range(self.number_of_slaves):
-                name = self.cloud._get_unique_slave_name()
-                logger.info('Creating server %s on cloud %s' %
-                            (name, self.cloud))
-                srv = self.cloud.client.servers.create(name, self.cloud.image,
-                                                       self.cloud.flavor,
-                                                       key_name=self.cloud.keypair.name)
-                slave = Slave(name=name, reservation=self, cloud_node_id=srv.id)
-                slave.save()
-        except novaclient_exceptions.ClientException, e1:
+            boot = self._prepare_boot()
+            if boot is None:
+                self._start_without_boot()
+                return
+
+            name, image, flavor, key_name, count = boot
+            logger.info('Creating %d server(s) named %s on cloud %s' %
+                        (count, name, self.cloud))
+            servers = self._boot_servers(name, image, flavor, key_name, count)
+            self._record_boot(name, count, servers)
+        except exc.IncompleteBoot, e1:
+            logger.error("Failed to start one or more slaves", exc_info=e1)
+            self._return_claimed()
+            self._discard_incomplete_boot(name)
+            self.set_state(self.FAILED_TO_START)
+            raise
+        except Exception, e1:
+            # Lookups like the image and flavor can fail too, after slaves
+            # were claimed from the warm pool.
             logger.error("Failed to start one or more slaves", exc_info=e1)
+            self._return_claimed()
             self.set_state(self.FAILED_TO_START)
             raise
 
         self.set_state(self.BOOTING)
 
-    def terminate(self):
-        for slave in self.slave_set.all():
+    def _start_without_boot(self):
+        # Slaves just claimed from the warm pool are ready to go. Any left
+        # by an earlier start that didn't finish may still be booting, so
+        # those are followed through update_state() like a fresh boot.
+        if len(self._claimed) == self.number_of_slaves:
+            self.set_state(self.READY, booted=False)
+        else:
+            self.set_state(self.BOOTING)
+
+    def _return_claimed(self):
+        # Hands the slaves _prepare_boot took from the warm pool back to it,
+        # so tearing down a failed start doesn't take them along.
+        claimed = getattr(self, '_claimed', None)
+        if claimed:
+            self.cloud.return_slaves(claimed)
+        self._claimed = []
+
+    def _discard_incomplete_boot(self, name):
+        # Deletes the servers that did show up. Anything Nova created that
+        # still isn't listed can only be found by its name.
+        if not self.terminate():
+            self._delete_leftovers(name)
+
+    def _delete_leftovers(self, name):
+        try:
+            leftovers = self._list_booted(name)
+        except novaclient_exceptions.ClientException, e:
+            logger.error('Failed to look for leftover servers named %s*' %
+                         (name,), exc_info=e)
+            return
+        for srv in leftovers:
+            logger.warning('Deleting leftover server %s' % (srv.name,))
             try:
-                slave.delete()
-            except Exception, e2:
-                logger.error("Failed to delete slave %s" % slave, exc_info=e2)
+                with metrics.timed('nova.servers.delete',
+                                   cloud=self.cloud_id):
+                    srv.delete()
+            except novaclient_exceptions.ClientException, e:
+                logger.error('Failed to delete leftover server %s' %
+                             (srv.name,), exc_info=e)
+
+    def terminate(self, max_workers=10, retries=1):
+        cloud = self.cloud
+        floating_ips = None
+        if (cloud.floating_ip_mode == Cloud.NEEDS_FLOATING_IP_ASSIGNED and
+                cloud.floating_ip_pool_size == 0):
+            with metrics.timed('nova.floating_ips.list', cloud=cloud.name):
+                floating_ips = dict((fip.ip, fip)
+                                    for fip in cloud.client.floating_ips.list())
+
+        remaining = list(self.slave_set.all())
+        for attempt in range(retries + 1):
+            errors = fanout.run_concurrently(
+                         lambda slave: slave._delete_server(floating_ips),
+                         remaining, max_workers)
+            deleted = [slave for slave in remaining if slave not in errors]
+            if floating_ips is None:
+                # Pooled floating IPs go back to the pool, which involves
+                # the database, so that happens here and not in the workers.
+                for slave in deleted:
+                    slave._release_floating_ip()
+            Slave.objects.filter(pk__in=[slave.pk for slave in deleted]).delete()
+            remaining = errors.keys()
+            if not remaining:
+                break
 
-        self.set_state(self.TERMINATED)
+        failures = dict((slave.name, e) for slave, e in errors.items())
+        for name, e2 in failures.items():
+            logger.error("Failed to delete slave %s" % name, exc_info=e2)
+
+        if failures:
+            self.set_state(self.SHUTTING_DOWN)
+        else:
+            self.set_state(self.TERMINATED)
+        return failures
+
+    def _ssh_ready(self, slaves):
+        unknown = [slave for slave in slaves
+                   if not ssh_ready_cache.get(slave.name)]
+        if unknown:
+            # Only bother with a full SSH handshake once sshd is listening.
+            listening = sshpool.probe([slave.external_ip
+                                       for slave in unknown], port=SSH_PORT)
+            candidates = [slave for slave in unknown
+                          if slave.external_ip in listening]
+            errors = fanout.run_concurrently(
+                         lambda slave: slave.run_cmd('true'),
+                         candidates, SSH_READY_WORKERS)
+            for slave in candidates:
+                e = errors.get(slave)
+                if e is None:
+                    ssh_ready_cache.set(slave.name, True)
+                elif isinstance(e, (socket.error, EOFError,
+                                    paramiko.SSHException)):
+                    logger.debug('%s is not ready yet: %s' % (slave, e))
+                else:
+                    raise e
+
+        return [slave for slave in slaves if ssh_ready_cache.get(slave.name)]
+
+    def _command_slaves(self):
+        slaves = list(self.slave_set.select_related('reservation__cloud'))
+        servers = {}
+        if any(slave.external_address is None for slave in slaves):
+            # Only slaves whose address isn't stored yet need Nova
+            servers = self.cloud.servers_by_id(slaves)
+        for slave in slaves:
+            server = servers.get(slave.cloud_node_id)
+            if server is not None:
+                slave.set_server(server)
+            # Resolve everything that needs the database or Nova up front,
+            # so the workers only have to deal with SSH.
+            slave.external_ip
+            slave.paramiko_private_key
+        return slaves
+
+    def run_cmd_all(self, cmd, **kwargs):
+        kwargs.setdefault('read_size', SSH_READ_SIZE)
+        return fanout.run_cmd_all(self._command_slaves(), cmd, **kwargs)
+
+    def refresh_state(self):
+        self.state = Reservation.objects.filter(pk=self.pk).values_list(
+                         'state', flat=True)[0]
+        return self.state
 
-    def set_state(self, state):
+    def wait(self, timeout=None, interval=1):
+        # Waits for whoever advances reservations, e.g. the
+        # reconcile_reservations command, to get this one past booting.
+        # Only reads the state from the database.
+        deadline = timeout is not None and time.time() + timeout
+        while self.refresh_state() in (self.NEW, self.BOOTING):
+            if deadline and time.time() >= deadline:
+                raise exc.WaitTimeout('Reservation %s is not ready yet' %
+                                      (self,))
+            time.sleep(interval)
+        return self.state
+
+    def set_state(self, state, booted=True):
+        # Pass booted=False when nothing was booted, e.g. when the warm
+        # pool covered the whole reservation. Those, like the pool's own
+        # reservations, say nothing about how fast the cloud boots.
+        if state != self.state:
+            if state == self.READY:
+                if booted and not self.pool:
+                    boot_stats.record_ready(self.cloud_id,
+                                            _seconds_since(self.created))
+            elif state == self.FAILED_TO_START:
+                boot_stats.record_failure(self.cloud_id)
         self.state = state
         self.save(update_fields=['state'])
 
-    def update_state(self):
-        active_count = 0
-        for slave in self.slave_set.all():
-            slave.update_state()
-            if slave.state == 'ERROR':
-                logger.info("%r went into ERROR state. Terminating reservation.")
+    def update_state(self, servers=None, changes_only=False):
+        if self.state in (self.SHUTTING_DOWN, self.TERMINATED,
+                          self.FAILED_TO_START):
+            # There's no coming back from these. Whatever is left to tear
+            # down is for terminate() to retry.
+            return self.state
+
+        slaves = list(self.slave_set.all())
+        if servers is None:
+            servers = self.cloud.servers_by_id(slaves)
+
+        for slave in slaves:
+            server = servers.get(slave.cloud_node_id)
+            if server is not None or not changes_only:
+                slave.update_state(server)
+
+        for slave in slaves:
+            if slave.state in ('ERROR', 'DELETED'):
+                logger.info("%r went into %s state. Terminating reservation." %
+                            (slave, slave.state))
                 self.set_state(self.FAILED_TO_START)
                 self.terminate()
-                break
-            elif slave.state == 'BUILD':
-                if datetime.datetime.now() > self.timeout:
-                    self.set_state(self.FAILED_TO_START)
-                    self.terminate()
-                    break
-                self.set_state(self.BOOTING)
-                break
-            elif slave.state == 'ACTIVE':
-                try:
-                    slave.run_cmd('true')
-                except socket.error, e:
-                    if e.errno == errno.ECONNREFUSED:
-                        continue
-                active_count += 1
+                return self.state
 
-        if active_count == self.number_of_slaves:
+        if any(slave.state == 'BUILD' for slave in slaves):
+            if datetime.datetime.now() > self.timeout:
+                self.set_state(self.FAILED_TO_START)
+                self.terminate()
+            else:
+                self.set_state(self.BOOTING)
+            return self.state
+
+        active = [slave for slave in slaves if slave.state == 'ACTIVE']
+        if (len(active) == self.number_of_slaves and
+                self.active_since is None):
+            self.active_since = datetime.datetime.now()
+            self.save(update_fields=['active_since'])
+            metrics.record('reservation.boot_to_active',
+                           _seconds_since(self.created), cloud=self.cloud_id)
+
+        if len(self._ssh_ready(active)) == self.number_of_slaves:
+            if self.active_since is not None and self.state != self.READY:
+                metrics.record('reservation.active_to_ready',
+                               _seconds_since(self.active_since),
+                               cloud=self.cloud_id)
             self.set_state(self.READY)
 
         return self.state
 
 
+class ReservationGroup(models.Model):
+    # Spreads one batch of slaves over several clouds. Each cloud gets its
+    # own Reservation, but the group boots, advances and terminates them
+    # as one unit.
+
+    number_of_slaves = models.IntegerField()
+    state = models.SmallIntegerField(default=Reservation.NEW,
+                                     choices=Reservation.RESERVATION_STATES)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return '%s' % self.pk
+
+    @classmethod
+    def create_across(cls, clouds, count):
+        clouds = list(clouds)
+        if not clouds:
+            raise exc.NoCapacity('No clouds to spread %d slaves over' %
+                                 (count,))
+        group = cls(number_of_slaves=count)
+        group.save()
+        share, extra = divmod(count, len(clouds))
+        for idx, cloud in enumerate(clouds):
+            number = share + (idx < extra and 1 or 0)
+            if number:
+                Reservation.objects.create(cloud=cloud, group=group,
+                                           number_of_slaves=number)
+        return group
+
+    def _reservations(self):
+        return list(self.reservation_set.select_related('cloud'))
+
+    @property
+    def slaves(self):
+        return Slave.objects.filter(reservation__group=self)
+
+    def set_state(self, state):
+        self.state = state
+        self.save(update_fields=['state'])
+
+    def start(self, max_workers=10):
+        reservations = self._reservations()
+        boots = {}
+        errors = {}
+        for res in reservations:
+            try:
+                boot = res._prepare_boot()
+            except Exception, e:
+                errors[res] = e
+                continue
+            if boot is None:
+                res._start_without_boot()
+            else:
+                boots[res] = boot
+        if errors:
+            # Don't boot anything for a group that has already failed
+            boots = {}
+
+        # The clouds boot in parallel. Only the Nova calls happen in the
+        # workers; the database is dealt with here.
+        servers = {}
+
+        def boot_servers(res):
+            name, image, flavor, key_name, count = boots[res]
+            logger.info('Creating %d server(s) named %s on cloud %s' %
+                        (count, name, res.cloud))
+            servers[res] = res._boot_servers(name, image, flavor,
+                                             key_name, count)
+
+        errors.update(fanout.run_concurrently(boot_servers, boots.keys(),
+                                              max_workers))
+        incomplete = {}
+        for res, (name, image, flavor, key_name, count) in boots.items():
+            if res in errors:
+                continue
+            try:
+                res._record_boot(name, count, servers[res])
+            except exc.IncompleteBoot, e:
+                errors[res] = e
+                incomplete[res] = name
+                continue
+            res.set_state(res.BOOTING)
+
+        if errors:
+            for res in reservations:
+                res._return_claimed()
+            for res, e in errors.items():
+                logger.error("Failed to start slaves on cloud %s" %
+                             (res.cloud,), exc_info=e)
+                res.set_state(res.FAILED_TO_START)
+            self.set_state(Reservation.FAILED_TO_START)
+            self.terminate()
+            # Like Reservation._discard_incomplete_boot, go after servers
+            # Nova created but didn't list, once the rest are gone.
+            for res, name in incomplete.items():
+                if Reservation.objects.filter(
+                        pk=res.pk, state=Reservation.TERMINATED).exists():
+                    res._delete_leftovers(name)
+            raise errors.values()[0]
+
+        if all(res.state == Reservation.READY for res in reservations):
+            self.set_state(Reservation.READY)
+        else:
+            self.set_state(Reservation.BOOTING)
+
+    def update_state(self, refresh=True):
+        # Without refresh the group only follows the states its
+        # reservations are already in, for when something else, like a
+        # reconciler, is advancing them.
+        if self.state in (Reservation.FAILED_TO_START,
+                          Reservation.SHUTTING_DOWN,
+                          Reservation.TERMINATED):
+            return self.state
+
+        reservations = self._reservations()
+        if refresh:
+            for res in reservations:
+                if res.state in (res.NEW, res.BOOTING):
+                    res.update_state()
+
+        states = set(res.state for res in reservations)
+        if states & set([Reservation.FAILED_TO_START,
+                         Reservation.SHUTTING_DOWN,
+                         Reservation.TERMINATED]):
+            logger.info("Part of reservation group %s failed. Terminating "
+                        "all of it." % (self,))
+            self.set_state(Reservation.FAILED_TO_START)
+            self.terminate()
+        elif states == set([Reservation.READY]):
+            self.set_state(Reservation.READY)
+        elif Reservation.BOOTING in states:
+            self.set_state(Reservation.BOOTING)
+        return self.state
+
+    def terminate(self, max_workers=10, retries=1):
+        failures = {}
+        for res in self._reservations():
+            if res.state != res.TERMINATED:
+                failures.update(res.terminate(max_workers, retries))
+
+        if failures:
+            self.set_state(Reservation.SHUTTING_DOWN)
+        else:
+            self.set_state(Reservation.TERMINATED)
+        return failures
+
+    def run_cmd_all(self, cmd, **kwargs):
+        kwargs.setdefault('read_size', SSH_READ_SIZE)
+        slaves = []
+        for res in self._reservations():
+            slaves.extend(res._command_slaves())
+        return fanout.run_cmd_all(slaves, cmd, **kwargs)
+
+
+def _seconds_since(when):
+    return (datetime.datetime.now() - when).total_seconds()
+
+
+class OutputBuffer(object):
+    # Collects command output. If max_size is set, only (roughly) the last
+    # max_size bytes are kept.
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.chunks = collections.deque()
+        self.size = 0
+
+    def append(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.max_size is not None:
+            while (len(self.chunks) > 1 and
+                   self.size - len(self.chunks[0]) >= self.max_size):
+                self.size -= len(self.chunks.popleft())
+
+    def getvalue(self):
+        value = ''.join(self.chunks)
+        if self.max_size is not None:
+            value = value[-self.max_size:]
+        return value
+
+
+class LineBuffer(object):
+    # Splits command output into lines. The unfinished line is kept as a
+    # list of chunks, and handed out as is once it grows to max_line bytes,
+    # so output without newlines can't pile up.
+    def __init__(self, max_line=65536):
+        self.max_line = max_line
+        self.chunks = []
+        self.size = 0
+
+    def feed(self, data):
+        # Returns the lines completed by data, newlines included
+        parts = data.split('\n')
+        lines = []
+        for part in parts[:-1]:
+            self.chunks.append(part + '\n')
+            lines.append(self.flush())
+        if parts[-1]:
+            self.chunks.append(parts[-1])
+            self.size += len(parts[-1])
+            if self.size >= self.max_line:
+                lines.append(self.flush())
+        return lines
+
+    def flush(self):
+        line = ''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return line
+
+
+class SlaveManager(models.Manager):
+    def by_node_id(self, node_id, cloud=None):
+        return self.by_node_ids([node_id], cloud)
+
+    def by_node_ids(self, node_ids, cloud=None):
+        slaves = self.filter(cloud_node_id__in=node_ids)
+        if cloud is not None:
+            slaves = slaves.filter(reservation__cloud=cloud)
+        return slaves
+
+
 class Slave(models.Model):
     name = models.CharField(max_length=200, primary_key=True)
     reservation = models.ForeignKey(Reservation)
-    cloud_node_id = models.CharField(max_length=200)
+    cloud_node_id = models.CharField(max_length=200, db_index=True)
     state = models.CharField(max_length=15, blank=True, null=True)
     floating_ip = models.IPAddressField(blank=True, null=True)
+    internal_address = models.IPAddressField(blank=True, null=True)
+    external_address = models.IPAddressField(blank=True, null=True)
+
+    objects = SlaveManager()
+
+    class Meta:
+        index_together = [['reservation', 'state']]
 
     def __init__(self, *args, **kwargs):
         self.state = None
-        self._internal_ip = None
-        self._external_ip = None
+        self._networks = None
+        self._server = None
+        self._server_fetched = None
         return super(Slave, self).__init__(*args, **kwargs)
 
     def __unicode__(self):
@@ -261,127 +1238,244 @@ class Slave(models.Model):
 
     @property
     def cloud_server(self):
+        if (self._server is None or
+                time.time() - self._server_fetched > SERVER_TTL):
+            self.refresh_server()
+        return self._server
+
+    def refresh_server(self):
         cloud = self.reservation.cloud
-        client = cloud.client
-        return client.servers.get(self.cloud_node_id)
+        with metrics.timed('nova.servers.get', cloud=cloud.name):
+            self.set_server(cloud.client.servers.get(self.cloud_node_id))
+        return self._server
 
-    def delete(self):
+    def set_server(self, server):
+        self._server = server
+        self._server_fetched = time.time()
+        self._networks = server.networks or None
+
+    def forget_server(self):
+        self._server = None
+        self._server_fetched = None
+
+    def _delete_server(self, floating_ips=None):
         logger.info('Deleting server %s on cloud %s.' % (self, self.reservation.cloud))
         try:
-            self._release_floating_ip()
-            self.cloud_server.delete()
+            server = self.cloud_server
+            cloud_name = self.reservation.cloud_id
+            if (self.reservation.cloud.floating_ip_mode == Cloud.NEEDS_FLOATING_IP_ASSIGNED
+                    and self.floating_ip):
+                with metrics.timed('nova.servers.remove_floating_ip',
+                                   cloud=cloud_name):
+                    server.remove_floating_ip(self.floating_ip)
+                if floating_ips is not None and self.floating_ip in floating_ips:
+                    with metrics.timed('nova.floating_ips.delete',
+                                       cloud=cloud_name):
+                        floating_ips.pop(self.floating_ip).delete()
+            with metrics.timed('nova.servers.delete', cloud=cloud_name):
+                server.delete()
         except novaclient_exceptions.NotFound:
             logger.info('Node already gone, unable to delete it')
 
+        self.forget_server()
+        ssh_pool.discard(self.name)
+        ssh_ready_cache.invalidate(self.name)
+
+    def _release_floating_ip(self):
+        if (self.reservation.cloud.floating_ip_mode == Cloud.NEEDS_FLOATING_IP_ASSIGNED
+                and self.floating_ip):
+            self.reservation.cloud.release_floating_ip(self.floating_ip)
+
+    def delete(self):
+        self._delete_server()
+        self._release_floating_ip()
         super(Slave, self).delete()
 
     def _fetch_current_state(self):
-        return self.cloud_server.status
+        return self.refresh_server().status
 
     def _assign_floating_ip(self):
         if self.reservation.cloud.floating_ip_mode == Cloud.NEEDS_FLOATING_IP_ASSIGNED:
-            floating_ip = self.reservation.cloud.client.floating_ips.create()
-            self.floating_ip = floating_ip.ip
-            self.cloud_server.add_floating_ip(floating_ip.ip)
-            self._external_ip = floating_ip.ip
-
-    def _release_floating_ip(self):
-        if self.reservation.cloud.floating_ip_mode == Cloud.NEEDS_FLOATING_IP_ASSIGNED:
-            ref = self.reservation.cloud.client.floating_ips.find(ip=self.floating_ip)
-            self.cloud_server.remove_floating_ip(self.floating_ip)
-            ref.delete()
-
-    def update_state(self):
-        new_state = self._fetch_current_state()
-        if new_state != self.state:
-            if new_state == 'ACTIVE':
-                self._assign_floating_ip()
+            self.floating_ip = self.reservation.cloud.acquire_floating_ip()
+            server = self.cloud_server
+            with metrics.timed('nova.servers.add_floating_ip',
+                               cloud=self.reservation.cloud_id):
+                server.add_floating_ip(self.floating_ip)
+            self.external_address = self.floating_ip
+
+    def update_state(self, server=None):
+        if server is None:
+            new_state = self._fetch_current_state()
+        else:
+            self.set_server(server)
+            new_state = server.status
+
+        changed = new_state != self.state
+        if changed and new_state == 'ACTIVE':
+            metrics.record('slave.boot_to_active',
+                           _seconds_since(self.reservation.created),
+                           cloud=self.reservation.cloud_id)
+            self._assign_floating_ip()
+
+        if (new_state == 'ACTIVE' and self.networks and
+                (self.internal_address is None or
+                 self.external_address is None)):
+            # Addresses don't change for the life of the instance, so
+            # they're stored with the slave and Nova isn't asked again.
+            # The external one may already be set, e.g. to the floating IP.
+            known = (self.internal_address, self.external_address)
+            self.internal_ip
+            self.external_ip
+            changed = (changed or
+                       (self.internal_address, self.external_address) != known)
+
+        if changed:
+            self.state = new_state
+            self.save()
 
-        self.state = new_state
-        self.save()
+    @property
+    def networks(self):
+        if self._networks is None:
+            self._networks = self.cloud_server.networks
+        return self._networks
 
     @property
     def internal_ip(self):
-        if self._internal_ip is None:
-            self._internal_ip = self.cloud_server.networks.values()[0][0]
-        return self._internal_ip
+        if self.internal_address is None:
+            self.internal_address = self.networks.values()[0][0]
+        return self.internal_address
 
     @property
     def external_ip(self):
-        if self._external_ip is None:
+        if self.external_address is None:
             if self.reservation.cloud.floating_ip_mode > 0:
-                external_ip = self.cloud_server.networks.values()[0][-1]
+                addresses = self.networks.values()[0]
+                if len(addresses) < 2:
+                    # The floating IP hasn't shown up yet, so don't hang
+                    # on to the private address.
+                    return addresses[-1]
+                external_ip = addresses[-1]
             else:
                 external_ip = self.internal_ip
 
-            self._external_ip = external_ip
+            self.external_address = external_ip
 
-        return self._external_ip
+        return self.external_address
 
     @property
     def paramiko_private_key(self):
-        private_key = self.reservation.cloud.keypair.private_key
-        priv_key_file = StringIO.StringIO(private_key)
-        return paramiko.RSAKey.from_private_key(priv_key_file)
+        return self.reservation.cloud.keypair.paramiko_key
 
     def ssh_client(self, username='ubuntu'):
         ssh = paramiko.SSHClient()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(self.external_ip, username='ubuntu', pkey=self.paramiko_private_key)
+        with metrics.timed('ssh.connect', cloud=self.reservation.cloud_id):
+            ssh.connect(self.external_ip, port=SSH_PORT, username='ubuntu',
+                        pkey=self.paramiko_private_key)
         return ssh
 
-    def _run_cmd(self, cmd, input=None):
-        logger.debug('Running: %s' % (cmd,))
+    def _open_session(self, pooled):
+        if not pooled:
+            ssh = self.ssh_client()
+            return ssh, ssh.get_transport().open_session()
 
-        ssh = self.ssh_client()
-        transport = ssh.get_transport()
+        ssh = ssh_pool.get(self.name, self.ssh_client)
+        try:
+            return ssh, ssh.get_transport().open_session()
+        except (paramiko.SSHException, EOFError, socket.error):
+            # The pooled connection went away under us. Try a fresh one.
+            ssh_pool.discard(self.name, ssh)
+        except Exception:
+            ssh_pool.release(self.name, ssh)
+            raise
 
-        chan = transport.open_session()
-        chan.exec_command(cmd)
+        ssh = ssh_pool.get(self.name, self.ssh_client)
+        try:
+            return ssh, ssh.get_transport().open_session()
+        except Exception:
+            ssh_pool.release(self.name, ssh)
+            raise
+
+    def _close_session(self, ssh, chan, pooled):
+        try:
+            chan.close()
+        finally:
+            if pooled:
+                ssh_pool.release(self.name, ssh)
+            else:
+                ssh.close()
+
+    def _run_cmd(self, cmd, input=None, pooled=True, read_size=None):
+        logger.debug('Running: %s' % (cmd,))
+
+        ssh, chan = self._open_session(pooled)
+        start = time.time()
+        try:
+            for data in self._read_channel(cmd, chan, input,
+                                           read_size or SSH_READ_SIZE):
+                yield data
+        finally:
+            self._close_session(ssh, chan, pooled)
+            metrics.record('ssh.exec', time.time() - start,
+                           cloud=self.reservation.cloud_id)
+
+    def _read_channel(self, cmd, chan, input, read_size):
         chan.set_combine_stderr(True)
+        chan.exec_command(cmd)
         if input:
             chan.sendall(input)
             chan.shutdown_write()
 
+        # recv() blocks until data arrives or the remote end closes the
+        # channel, so there's no need to poll.
         while True:
-            r, _, __ = select.select([chan], [], [], 1)
-            if r:
-                if chan in r:
-                    if chan.recv_ready():
-                        s = chan.recv(4096)
-                        if len(s) == 0:
-                            break
-                        yield s
-                    else:
-                        status = chan.recv_exit_status()
-                        if status != 0:
-                            raise Exception('Command %s failed' % cmd)
-                        break
-
-        ssh.close()
+            data = chan.recv(read_size)
+            if not data:
+                break
+            yield data
+
+        status = chan.recv_exit_status()
+        if status != 0:
+            raise exc.CommandFailed('Command %s failed' % cmd,
+                                    exit_status=status)
+
+    def stream_cmd(self, cmd, input=None, lines=False):
+        if not lines:
+            for data in self._run_cmd(cmd, input):
+                yield data
+            return
+
+        lbuf = LineBuffer()
+        for data in self._run_cmd(cmd, input):
+            for line in lbuf.feed(data):
+                yield line
+        rest = lbuf.flush()
+        if rest:
+            yield rest
 
     def run_cmd(self, cmd, *args, **kwargs):
         def log(s):
             logger.info('%-15s: %s' % (self.name, s))
 
-        def log_whole_lines(lbuf):
-            while '\n' in lbuf:
-                line, lbuf = lbuf.split('\n', 1)
-                log(line)
-            return lbuf
-
         output_callback = kwargs.pop('output_callback', lambda _: None)
+        output_file = kwargs.pop('output_file', None)
+        max_output = kwargs.pop('max_output', None)
 
-        out = ''
-        lbuf = ''
-        for data in self._run_cmd(cmd, *args, **kwargs):
-            output_callback(data)
-            out += data
-            lbuf += data
-            lbuf = log_whole_lines(lbuf)
-
-        lbuf = log_whole_lines(lbuf)
-        log(lbuf)
-        return out
+        out = OutputBuffer(max_output)
+        lbuf = LineBuffer()
+        try:
+            for data in self._run_cmd(cmd, *args, **kwargs):
+                output_callback(data)
+                if output_file is not None:
+                    output_file.write(data)
+                out.append(data)
+                for line in lbuf.feed(data):
+                    log(line.rstrip('\n'))
+        except exc.CommandFailed, e:
+            e.output = out.getvalue()
+            raise
+        finally:
+            log(lbuf.flush())
+        return out.getvalue()
 
 
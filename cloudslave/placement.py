@@ -0,0 +1,146 @@
+#
+#   Copyright 2013 Cisco Systems
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import random
+import threading
+
+from cloudslave import cache
+from cloudslave import exc
+from cloudslave import metrics
+
+from novaclient import exceptions as novaclient_exceptions
+
+
+logger = logging.getLogger(__name__)
+
+# Used for clouds we haven't seen boot anything yet
+DEFAULT_BOOT_TIME = 300.0
+
+# Even a cloud that failed every recent boot gets picked now and then, so
+# it gets a chance to prove it has recovered.
+MIN_SUCCESS_RATE = 0.05
+
+
+class BootStats(object):
+    # Exponentially weighted moving averages of how long reservations on
+    # each cloud took to become ready and how often they failed to start.
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self._boot_time = {}
+        self._failure_rate = {}
+        self._lock = threading.Lock()
+
+    def _update(self, averages, name, value):
+        old = averages.get(name)
+        if old is None:
+            averages[name] = value
+        else:
+            averages[name] = old + self.alpha * (value - old)
+
+    def record_ready(self, name, seconds):
+        with self._lock:
+            self._update(self._boot_time, name, seconds)
+            self._update(self._failure_rate, name, 0.0)
+
+    def record_failure(self, name):
+        with self._lock:
+            self._update(self._failure_rate, name, 1.0)
+
+    def load(self, name, boot_time, failure_rate):
+        # Replaces the averages for name with ones kept elsewhere. None
+        # means there's nothing to go on yet.
+        with self._lock:
+            for averages, value in ((self._boot_time, boot_time),
+                                    (self._failure_rate, failure_rate)):
+                if value is None:
+                    averages.pop(name, None)
+                else:
+                    averages[name] = value
+
+    def boot_time(self, name):
+        with self._lock:
+            return self._boot_time.get(name, DEFAULT_BOOT_TIME)
+
+    def failure_rate(self, name):
+        with self._lock:
+            return self._failure_rate.get(name, 0.0)
+
+    def clear(self):
+        with self._lock:
+            self._boot_time.clear()
+            self._failure_rate.clear()
+
+
+class PlacementScheduler(object):
+    # Picks the cloud to boot on, favouring clouds with quota to spare,
+    # few failed boots and quick boots.
+    def __init__(self, stats, quota_ttl=60):
+        self.stats = stats
+        self.quota_cache = cache.TTLCache(quota_ttl)
+
+    def _fetch_quota(self, cloud):
+        try:
+            with metrics.timed('nova.limits.get', cloud=cloud.name):
+                limits = cloud.client.limits.get()
+            limits = dict((limit.name, limit.value)
+                          for limit in limits.absolute)
+        except novaclient_exceptions.ClientException, e:
+            logger.warning('Could not get the limits of %s: %s' % (cloud, e))
+            return None
+        try:
+            return (limits['maxTotalInstances'], limits['totalInstancesUsed'])
+        except KeyError:
+            return None
+
+    def quota(self, cloud):
+        return self.quota_cache.get_or_create(
+                   cloud.name, lambda: self._fetch_quota(cloud))
+
+    def weight(self, cloud, active_slaves, count):
+        headroom = 1.0
+        quota = self.quota(cloud)
+        if quota is not None:
+            max_instances, used = quota
+            if max_instances >= 0:
+                # Nova's usage may be a minute old and doesn't know about
+                # reservations that haven't booted yet, so trust whichever
+                # is larger.
+                free = max_instances - max(used, active_slaves)
+                if free < count:
+                    return 0.0
+                headroom = float(free) / max_instances
+
+        success_rate = max(1.0 - self.stats.failure_rate(cloud.name),
+                           MIN_SUCCESS_RATE)
+        return headroom * success_rate / self.stats.boot_time(cloud.name)
+
+    def choose(self, clouds, active_slaves, count=1):
+        weights = [(cloud, self.weight(cloud, active_slaves.get(cloud.pk, 0),
+                                       count))
+                   for cloud in clouds]
+        total = sum(weight for cloud, weight in weights)
+        if total <= 0:
+            raise exc.NoCapacity('No cloud has room for %d slaves' % (count,))
+
+        pick = random.random() * total
+        for cloud, weight in weights:
+            pick -= weight
+            if pick < 0:
+                return cloud
+        return [cloud for cloud, weight in weights if weight > 0][-1]
+
+    def invalidate_quota(self, name):
+        self.quota_cache.invalidate(name)
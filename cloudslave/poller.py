@@ -0,0 +1,79 @@
+#
+#   Copyright 2013 Cisco Systems
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+
+from cloudslave import metrics
+from cloudslave.models import Reservation, Slave, new_lease_owner
+
+
+class ChangesSincePoller(object):
+    # Nova's changes-since filter has one second resolution and our clock
+    # may be off from Nova's, so look back a bit further than the last
+    # poll. Seeing the same change twice is harmless.
+    OVERLAP = datetime.timedelta(seconds=10)
+    TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self.last_poll = None
+        self.owner = new_lease_owner()
+
+    def changed_servers(self):
+        search_opts = {}
+        if self.last_poll is not None:
+            since = self.last_poll - self.OVERLAP
+            search_opts['changes-since'] = since.strftime(self.TIME_FORMAT)
+
+        started = datetime.datetime.utcnow()
+        with metrics.timed('nova.servers.list', cloud=self.cloud.name):
+            servers = self.cloud.client.servers.list(search_opts=search_opts)
+        self.last_poll = started
+        return dict((srv.id, srv) for srv in servers)
+
+    def poll(self):
+        first_poll = self.last_poll is None
+        if first_poll and self.cloud.floating_ip_pool_size > 0:
+            # Bring the floating IP pool in line with Nova before the
+            # first poll, in case a crash left it out of step.
+            self.cloud.reconcile_floating_ips()
+        servers = self.changed_servers()
+        booting = self.cloud.reservation_set.filter(state=Reservation.BOOTING)
+        if not first_poll:
+            # The first poll lists every server. After that, only
+            # reservations with a server that changed need a look, plus
+            # the ones that ran past their timeout and the ones whose
+            # slaves are all ACTIVE but not answering over SSH yet, which
+            # Nova has no more changes to report for.
+            ids = set(Slave.objects.by_node_ids(servers.keys(), self.cloud)
+                                   .values_list('reservation', flat=True))
+            ids.update(Reservation.objects.expired()
+                                  .filter(cloud=self.cloud)
+                                  .values_list('pk', flat=True))
+            not_active = set(
+                Slave.objects.filter(reservation__cloud=self.cloud,
+                                     reservation__state=Reservation.BOOTING)
+                             .exclude(state='ACTIVE')
+                             .values_list('reservation', flat=True))
+            ids.update(pk for pk in booting.values_list('pk', flat=True)
+                       if pk not in not_active)
+            booting = booting.filter(pk__in=ids)
+
+        # Reservations a reconciler is working on are left to it
+        ids = list(booting.values_list('pk', flat=True))
+        with Reservation.leased(self.owner, ids) as reservations:
+            for res in reservations:
+                res.update_state(servers, changes_only=True)
+        return reservations
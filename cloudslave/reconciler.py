@@ -0,0 +1,191 @@
+#
+#   Copyright 2013 Cisco Systems
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import threading
+
+from cloudslave import fanout
+from cloudslave.models import Cloud, LeaseRenewer, Reservation
+from cloudslave.models import ReservationGroup
+from cloudslave.models import new_lease_owner
+
+
+logger = logging.getLogger(__name__)
+
+
+class Reconciler(object):
+    # Owns every reservation that isn't done yet: starts new ones, advances
+    # booting ones, fails the ones that run past their timeout and finishes
+    # terminating what's left over. Clouds are handled in parallel, with at
+    # most max_per_cloud reservations of a cloud being worked on at once.
+    #
+    # Any number of reconcilers can share a database. Each pass leases up
+    # to batch_size reservations per cloud for lease_ttl seconds, so every
+    # reservation is only worked on by one of them at a time. The leases
+    # are renewed while the pass runs. By default a pass takes on a few
+    # rounds' worth of max_per_cloud, leaving the rest to other workers.
+    BATCH_FACTOR = 4
+
+    def __init__(self, max_per_cloud=4, interval=5, start_new=True,
+                 owner=None, lease_ttl=300, batch_size=None):
+        self.max_per_cloud = max_per_cloud
+        self.interval = interval
+        self.start_new = start_new
+        self.owner = owner or new_lease_owner()
+        self.lease_ttl = lease_ttl
+        self.batch_size = batch_size or self.BATCH_FACTOR * max_per_cloud
+        self._stopped = threading.Event()
+        self._floating_ips_reconciled = False
+
+    def reconcile_floating_ips(self):
+        # A crash may have left pooled floating IPs out of step with Nova,
+        # so bring every pool in line once before the first pass.
+        for cloud in Cloud.objects.filter(floating_ip_pool_size__gt=0):
+            try:
+                cloud.reconcile_floating_ips()
+            except Exception, e:
+                logger.error('Failed to reconcile the floating IPs of %s' %
+                             (cloud,), exc_info=e)
+        self._floating_ips_reconciled = True
+
+    def pending(self):
+        states = [Reservation.BOOTING, Reservation.SHUTTING_DOWN]
+        if self.start_new:
+            states.append(Reservation.NEW)
+        rows = list(Reservation.objects.filter(state__in=states)
+                                       .values_list('pk', 'cloud'))
+        # Failed reservations are terminated right away, but that may not
+        # have worked out.
+        rows += list(Reservation.objects.filter(
+                         state=Reservation.FAILED_TO_START,
+                         slave__isnull=False)
+                     .distinct().values_list('pk', 'cloud'))
+
+        by_cloud = {}
+        for pk, cloud in rows:
+            by_cloud.setdefault(cloud, []).append(pk)
+        pending = []
+        for ids in by_cloud.values():
+            pending += Reservation.acquire_leases(self.owner, ids,
+                                                  self.lease_ttl,
+                                                  self.batch_size)
+        return pending
+
+    def _fail(self, res):
+        logger.info('Reservation %s timed out' % (res,))
+        res.set_state(res.FAILED_TO_START)
+        res.terminate()
+
+    def reconcile(self, res, servers=None, expired=None):
+        if expired is None:
+            expired = Reservation.objects.expired().filter(pk=res.pk).exists()
+        if res.state == res.NEW:
+            if expired:
+                self._fail(res)
+            else:
+                res.start()
+        elif res.state == res.BOOTING:
+            if expired:
+                self._fail(res)
+            else:
+                res.update_state(servers)
+        else:
+            res.terminate()
+        return res.state
+
+    def reconcile_cloud(self, cloud, reservations, expired=()):
+        servers = None
+        if any(res.state == res.BOOTING for res in reservations):
+            # One listing serves every reservation on the cloud
+            servers = cloud.servers_by_id()
+
+        errors = fanout.run_concurrently(
+                     lambda res: self.reconcile(res, servers,
+                                                res.pk in expired),
+                     reservations, self.max_per_cloud)
+        for res, e in errors.items():
+            logger.error('Failed to reconcile reservation %s' % (res,),
+                         exc_info=e)
+        return errors
+
+    def reconcile_groups(self, reservations):
+        # A group follows its reservations: when one part fails, the rest
+        # is terminated along with it. That takes a lease on every part.
+        pending = set(res.pk for res in reservations)
+        groups = ReservationGroup.objects.filter(
+                     pk__in=set(res.group_id for res in reservations
+                                if res.group_id is not None)
+                 ).exclude(state__in=[Reservation.FAILED_TO_START,
+                                      Reservation.SHUTTING_DOWN,
+                                      Reservation.TERMINATED])
+        for group in groups:
+            ids = list(group.reservation_set.values_list('pk', flat=True))
+            leased = Reservation.acquire_leases(self.owner, ids,
+                                                self.lease_ttl)
+            try:
+                if len(leased) == len(ids):
+                    group.update_state(refresh=False)
+            except Exception, e:
+                logger.error('Failed to reconcile reservation group %s' %
+                             (group,), exc_info=e)
+            finally:
+                Reservation.release_leases(
+                    self.owner, [res.pk for res in leased
+                                 if res.pk not in pending])
+
+    def run_once(self):
+        if not self._floating_ips_reconciled:
+            self.reconcile_floating_ips()
+
+        pending = self.pending()
+        # One query finds everything in the batch that ran past its timeout
+        expired = set(Reservation.objects.expired()
+                                 .filter(pk__in=[res.pk for res in pending])
+                                 .values_list('pk', flat=True))
+        by_cloud = {}
+        clouds = {}
+        for res in pending:
+            by_cloud.setdefault(res.cloud_id, []).append(res)
+            clouds[res.cloud_id] = res.cloud
+
+        renewer = LeaseRenewer(self.owner, [res.pk for res in pending],
+                               self.lease_ttl)
+        renewer.start()
+        try:
+            errors = fanout.run_concurrently(
+                         lambda name: self.reconcile_cloud(clouds[name],
+                                                           by_cloud[name],
+                                                           expired),
+                         by_cloud.keys(), len(by_cloud))
+            self.reconcile_groups(pending)
+        finally:
+            renewer.stop()
+            Reservation.release_leases(self.owner,
+                                       [res.pk for res in pending])
+        for name, e in errors.items():
+            logger.error('Failed to reconcile cloud %s' % (name,),
+                         exc_info=e)
+        return len(pending)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except Exception, e:
+                logger.error('Reconciliation failed', exc_info=e)
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,204 @@
+#
+#   Copyright 2013 Cisco Systems
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import errno
+import logging
+import select
+import socket
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class SSHPool(object):
+    # Connections are checked out by get() and handed back with release().
+    # Only connections nobody has checked out are ever closed to make
+    # room, so the pool goes over max_connections rather than close a
+    # connection that is in use.
+    def __init__(self, max_connections=100, idle_timeout=300, keepalive=30):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        # key -> [ssh, last_used, number of checkouts]
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _is_alive(self, ssh):
+        transport = ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _close(self, key):
+        ssh = self._clients.pop(key)[0]
+        try:
+            ssh.close()
+        except Exception, e:
+            logger.debug('Failed to close connection to %s' % (key,),
+                         exc_info=e)
+
+    def _idle(self):
+        return [key for key, (_, __, users) in self._clients.items()
+                if users == 0]
+
+    def _evict_idle(self, now):
+        for key in self._idle():
+            if now - self._clients[key][1] >= self.idle_timeout:
+                logger.debug('Closing idle connection to %s' % (key,))
+                self._close(key)
+
+    def _evict(self, now):
+        self._evict_idle(now)
+        # Trimming only happens as connections are handed back. Doing it in
+        # get() would close idle connections a batch of commands is about
+        # to check out next, only to open them again.
+        idle = sorted(self._idle(), key=lambda k: self._clients[k][1])
+        while idle and len(self._clients) > self.max_connections:
+            lru = idle.pop(0)
+            logger.debug('Closing least recently used connection to %s' %
+                         (lru,))
+            self._close(lru)
+
+    def get(self, key, connect):
+        now = time.time()
+        with self._lock:
+            if key in self._clients:
+                entry = self._clients[key]
+                if self._is_alive(entry[0]):
+                    entry[1] = now
+                    entry[2] += 1
+                    return entry[0]
+                # Closing a dead connection can't hurt whoever still has
+                # it checked out.
+                logger.debug('Connection to %s died. Reconnecting.' % (key,))
+                self._close(key)
+            self._evict_idle(now)
+
+        ssh = connect()
+        ssh.get_transport().set_keepalive(self.keepalive)
+
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is not None:
+                # Someone else connected in the meantime. Use theirs.
+                ssh.close()
+                entry[1] = now
+                entry[2] += 1
+                return entry[0]
+            self._clients[key] = [ssh, now, 1]
+        return ssh
+
+    def release(self, key, ssh):
+        # Hands back a connection returned by get(). Connections that were
+        # discarded or replaced while checked out are simply ignored.
+        now = time.time()
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is None or entry[0] is not ssh:
+                return
+            entry[1] = now
+            entry[2] = max(entry[2] - 1, 0)
+            self._evict(now)
+
+    def discard(self, key, ssh=None):
+        # With ssh, only that connection goes, e.g. one that just failed.
+        # If someone already replaced it in the pool, theirs is left alone.
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is not None and (ssh is None or entry[0] is ssh):
+                self._close(key)
+                return
+        if ssh is not None:
+            try:
+                ssh.close()
+            except Exception, e:
+                logger.debug('Failed to close connection to %s' % (key,),
+                             exc_info=e)
+
+    def close_all(self):
+        with self._lock:
+            for key in self._clients.keys():
+                self._close(key)
+
+
+class Poller(object):
+    # Waits for any of a set of sockets or channels to become readable, or
+    # writable with write=True. select() can't watch descriptors past
+    # FD_SETSIZE (usually 1024), so poll() is used wherever the platform
+    # has it.
+    def __init__(self, socks, write=False):
+        self._socks = dict((sock.fileno(), sock) for sock in socks)
+        self._write = write
+        self._poll = None
+        if hasattr(select, 'poll'):
+            self._poll = select.poll()
+            events = write and select.POLLOUT or select.POLLIN
+            for fd in self._socks:
+                self._poll.register(fd, events)
+
+    def unregister(self, sock):
+        fd = sock.fileno()
+        del self._socks[fd]
+        if self._poll is not None:
+            self._poll.unregister(fd)
+
+    def ready(self, timeout=None):
+        if self._poll is None:
+            socks = self._socks.values()
+            if self._write:
+                _, ready, __ = select.select([], socks, [], timeout)
+            else:
+                ready, _, __ = select.select(socks, [], [], timeout)
+            return ready
+        if timeout is not None:
+            timeout *= 1000
+        return [self._socks[fd] for fd, _ in self._poll.poll(timeout)
+                if fd in self._socks]
+
+
+def probe(hosts, port=22, timeout=2):
+    # Starts a non-blocking connect to every host at once and returns the
+    # ones that accepted the connection within timeout seconds.
+    reachable = set()
+    pending = {}
+    for host in set(hosts):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        err = sock.connect_ex((host, port))
+        if err == 0:
+            reachable.add(host)
+            sock.close()
+        elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            pending[sock] = host
+        else:
+            sock.close()
+
+    deadline = time.time() + timeout
+    poller = Poller(pending.keys(), write=True)
+    try:
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            for sock in poller.ready(remaining):
+                host = pending.pop(sock)
+                poller.unregister(sock)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    reachable.add(host)
+                sock.close()
+    finally:
+        for sock in pending:
+            sock.close()
+    return reachable
@@ -13,16 +13,82 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import collections
+import contextlib
 import datetime
 import mock
 import re
+import resource
+import socket
+import StringIO
+import threading
+import time
 
+from django.core.management import call_command
 from django.test import TestCase
 import novaclient.exceptions
+import paramiko
 
 import cloudslave.models
+from cloudslave import benchmark
 from cloudslave import exc
-from cloudslave.models import Cloud, KeyPair, Reservation, Slave
+from cloudslave import fakes
+from cloudslave import fanout
+from cloudslave import metrics
+from cloudslave.driver import ReservationDriver
+from cloudslave import sshpool
+from cloudslave.poller import ChangesSincePoller
+import cloudslave.reconciler
+from cloudslave.reconciler import Reconciler
+from cloudslave.warmpool import WarmPoolMaintainer
+from cloudslave.models import Cloud, FloatingIP, KeyPair, Reservation, Slave
+from cloudslave.models import ReservationGroup
+
+def clear_caches():
+    cloudslave.models.catalog_cache.clear()
+    cloudslave.models.keypair_cache.clear()
+    cloudslave.models.nova_clients.clear()
+    cloudslave.models.boot_stats.clear()
+    cloudslave.models.scheduler.quota_cache.clear()
+    metrics.default_collector.reset()
+    cloudslave.models.ssh_ready_cache.clear()
+
+
+def patch_probe(testcase):
+    # Pretend sshd is listening on every slave
+    patch = mock.patch('cloudslave.sshpool.probe',
+                       side_effect=lambda hosts, port=22: set(hosts))
+    testcase.addCleanup(patch.stop)
+    return patch.start()
+
+
+class FakeCloudMixin(object):
+    # Sets up test_cloud with a fake Nova client and slaves that are
+    # reachable over SSH without running anything.
+    fixtures = ['test_cloud.yaml']
+
+    # Fields to change on test_cloud before the tests run
+    cloud_fields = {}
+
+    def setUp(self):
+        super(FakeCloudMixin, self).setUp()
+        clear_caches()
+        patch_probe(self)
+        self.cloud = Cloud.objects.get(pk='test_cloud')
+        if self.cloud_fields:
+            for field, value in self.cloud_fields.items():
+                setattr(self.cloud, field, value)
+            self.cloud.save()
+        self.nova = self._fake_nova(self.cloud)
+        patch = mock.patch.object(Slave, 'run_cmd')
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def _fake_nova(self, cloud):
+        nova = fakes.FakeNovaClient(images=['foo'], flavors=['bar'])
+        cloudslave.models.nova_clients.set(cloud, nova)
+        return nova
+
 
 class CloudTests(TestCase):
     test_user = 'testuser1'
@@ -30,6 +96,9 @@ class CloudTests(TestCase):
     test_password = 'testpassword1'
     test_endpoint = 'http://example.com/v2.0'
 
+    def setUp(self):
+        clear_caches()
+
     def _create(self, name='testcloud1', **kwargs):
         cloud = Cloud(name=name,
                       endpoint=self.test_endpoint,
@@ -52,9 +121,121 @@ class CloudTests(TestCase):
         self._create(name='cloud3')
         # There's a 0.03% chance this test will fail. I'm OK with those
         # odds.
-        them_all = set([Cloud.get_random() for x in range(20)])
+        with mock.patch.object(cloudslave.models.scheduler, 'quota') as quota:
+            quota.return_value = None
+            them_all = set([Cloud.get_random() for x in range(20)])
         self.assertEqual(len(them_all), 3)
 
+    def _quotas(self, quotas):
+        patch = mock.patch.object(cloudslave.models.scheduler, 'quota',
+                                  side_effect=lambda cloud: quotas[cloud.name])
+        self.addCleanup(patch.stop)
+        return patch.start()
+
+    def test_get_random_skips_full_clouds(self):
+        self._create(name='cloud1')
+        self._create(name='cloud2')
+        self._quotas({'cloud1': (10, 10), 'cloud2': (10, 2)})
+        for x in range(20):
+            self.assertEqual(Cloud.get_random().name, 'cloud2')
+
+    def test_get_random_counts_active_reservations(self):
+        cloud1 = self._create(name='cloud1')
+        self._create(name='cloud2')
+        self._quotas({'cloud1': (10, 0), 'cloud2': (10, 5)})
+        cloud1.create_reservation(8)
+        Reservation.objects.create(cloud=cloud1, number_of_slaves=20,
+                                   state=Reservation.TERMINATED)
+        for x in range(20):
+            self.assertEqual(Cloud.get_random(count=4).name, 'cloud2')
+
+    def test_get_random_no_capacity(self):
+        self._create(name='cloud1')
+        self._quotas({'cloud1': (10, 8)})
+        self.assertRaises(exc.NoCapacity, Cloud.get_random, count=3)
+
+    def test_get_random_query_count(self):
+        for x in range(5):
+            self._create(name='cloud%d' % (x,))
+        self._quotas(collections.defaultdict(lambda: None))
+        with self.assertNumQueries(2):
+            Cloud.get_random()
+
+    def test_placement_weights(self):
+        cloud1 = self._create(name='cloud1')
+        cloud2 = self._create(name='cloud2')
+        self._quotas({'cloud1': None, 'cloud2': None})
+        stats = cloudslave.models.boot_stats
+        scheduler = cloudslave.models.scheduler
+        stats.record_ready('cloud1', 60)
+        stats.record_ready('cloud2', 60)
+        self.assertEqual(scheduler.weight(cloud1, 0, 1),
+                         scheduler.weight(cloud2, 0, 1))
+
+        stats.record_ready('cloud2', 600)
+        self.assertTrue(scheduler.weight(cloud1, 0, 1) >
+                        scheduler.weight(cloud2, 0, 1))
+
+        for x in range(5):
+            stats.record_failure('cloud1')
+        self.assertTrue(scheduler.weight(cloud1, 0, 1) <
+                        scheduler.weight(cloud2, 0, 1))
+
+    def test_quota_is_cached(self):
+        cloud = self._create()
+        with mock.patch.object(cloud, '_client') as client:
+            maxi = mock.Mock(value=10)
+            maxi.name = 'maxTotalInstances'
+            used = mock.Mock(value=4)
+            used.name = 'totalInstancesUsed'
+            client.limits.get.return_value.absolute = [maxi, used]
+            scheduler = cloudslave.models.scheduler
+            self.assertEqual(scheduler.quota(cloud), (10, 4))
+            self.assertEqual(scheduler.quota(cloud), (10, 4))
+            self.assertEqual(client.limits.get.call_count, 1)
+
+    def test_reservation_outcome_is_recorded(self):
+        cloud = self._create()
+        res = cloud.create_reservation(2)
+        res.set_state(res.BOOTING)
+        res.set_state(res.READY)
+        res.set_state(res.READY)
+        res = cloud.create_reservation(2)
+        res.set_state(res.FAILED_TO_START)
+        stats = cloudslave.models.boot_stats
+        self.assertTrue(stats.boot_time('testcloud1') < 5)
+        self.assertAlmostEqual(stats.failure_rate('testcloud1'), 0.2)
+
+    def test_boot_stats_are_shared_through_the_database(self):
+        cloud1 = self._create(name='cloud1')
+        self._create(name='cloud2')
+        self._quotas({'cloud1': None, 'cloud2': None})
+        stats = cloudslave.models.boot_stats
+        stats.record_ready('cloud1', 60)
+        stats.record_ready('cloud1', 600)
+        stats.record_failure('cloud1')
+        cloud1 = Cloud.objects.get(pk='cloud1')
+        self.assertAlmostEqual(cloud1.average_boot_time, 168)
+        self.assertAlmostEqual(cloud1.boot_failure_rate, 0.2)
+
+        # Another process only knows what's in the database
+        stats.clear()
+        Cloud.get_random()
+        self.assertAlmostEqual(stats.boot_time('cloud1'), 168)
+        self.assertAlmostEqual(stats.failure_rate('cloud1'), 0.2)
+        self.assertEquals(stats.boot_time('cloud2'),
+                          cloudslave.placement.DEFAULT_BOOT_TIME)
+
+    def test_pool_served_reservations_are_not_recorded(self):
+        cloud = self._create()
+        pool = cloud.create_reservation(2, pool=True)
+        pool.set_state(pool.READY)
+        res = cloud.create_reservation(2)
+        res.set_state(res.READY, booted=False)
+        stats = cloudslave.models.boot_stats
+        self.assertEquals(stats.boot_time('testcloud1'),
+                          cloudslave.placement.DEFAULT_BOOT_TIME)
+
     def test_cloud_client_without_region(self):
         cloud = self._create()
         with mock.patch('cloudslave.models.client') as client:
@@ -83,6 +264,51 @@ class CloudTests(TestCase):
             cloud.client
             self.assertEquals(client.Client.call_count, 1)
 
+    def test_cloud_client_is_shared(self):
+        self._create()
+        with mock.patch('cloudslave.models.client') as client:
+            Cloud.objects.get(pk='testcloud1').client
+            Cloud.objects.get(pk='testcloud1').client
+            self.assertEquals(client.Client.call_count, 1)
+
+    def test_cloud_client_changed_credentials(self):
+        cloud = self._create()
+        with mock.patch('cloudslave.models.client') as client:
+            cloud.client
+            cloud.password = 'newpassword'
+            cloud.save()
+            Cloud.objects.get(pk='testcloud1').client
+            self.assertEquals(client.Client.call_count, 2)
+            self.assertEquals(client.Client.call_args[0][1], 'newpassword')
+
+    def test_cloud_client_is_dropped_on_delete(self):
+        cloud = self._create()
+        with mock.patch('cloudslave.models.client') as client:
+            cloud.client
+            cloud.delete()
+            self._create().client
+            self.assertEquals(client.Client.call_count, 2)
+
+    def test_cloud_client_threads(self):
+        self._create()
+        clients = []
+
+        def get_client():
+            clients.append(Cloud(name='testcloud1',
+                                 endpoint=self.test_endpoint,
+                                 user_name=self.test_user,
+                                 tenant_name=self.test_tenant,
+                                 password=self.test_password).client)
+
+        with mock.patch('cloudslave.models.client') as client:
+            threads = [threading.Thread(target=get_client) for x in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEquals(client.Client.call_count, 1)
+            self.assertEquals(len(set(map(id, clients))), 1)
+
     def test_unicode(self):
         cloud = self._create()
         self.assertEquals('%s' % (cloud,), 'testcloud1')
@@ -92,6 +318,7 @@ class CloudTests(TestCase):
         with mock.patch('cloudslave.models.client') as client:
             name = getattr(cloud, method_name)()
             self.assertTrue(re.match('cloudslave-[a-zA-Z0-9]*', name) is not None)
+            self.assertEquals(client.mock_calls, [])
 
     def test_get_unique_slave_name(self):
         self._test_get_unique_name('_get_unique_slave_name')
@@ -99,6 +326,16 @@ class CloudTests(TestCase):
     def test_get_unique_keypair_name(self):
         self._test_get_unique_name('_get_unique_keypair_name')
 
+    def test_get_unique_slave_name_avoids_existing(self):
+        cloud = self._create()
+        res = cloud.create_reservation()
+        Slave(name='cloudslave-taken-1', reservation=res,
+              cloud_node_id='taken').save()
+        with mock.patch.object(cloud, '_random_string') as random_string:
+            random_string.side_effect = ['taken', 'free']
+            self.assertEquals(cloud._get_unique_slave_name(),
+                              'cloudslave-free')
+
     def _test_image(self, name):
         cloud = self._create(image_name=name)
 
@@ -136,6 +373,48 @@ class CloudTests(TestCase):
             flavors_mock.list.return_value = flavors
             return cloud.flavor
 
+    def _images_mock(self, images_mock, *names):
+        images = []
+        for name in names:
+            image = mock.MagicMock()
+            image.name = name
+            images.append(image)
+        images_mock.list.return_value = images
+
+    def test_image_is_cached(self):
+        cloud = self._create(image_name='foo')
+        with mock.patch.object(cloud.client, 'images') as images_mock:
+            self._images_mock(images_mock, 'foo')
+            self.assertEquals(cloud.image, cloud.image)
+            # Other instances of the same cloud share the cache
+            self.assertEquals(Cloud.objects.get(pk=cloud.pk).image,
+                              cloud.image)
+            self.assertEquals(images_mock.list.call_count, 1)
+
+    def test_image_cache_invalidate(self):
+        cloud = self._create(image_name='foo')
+        with mock.patch.object(cloud.client, 'images') as images_mock:
+            self._images_mock(images_mock, 'foo')
+            cloud.image
+            cloud.invalidate_catalog()
+            cloud.image
+            self.assertEquals(images_mock.list.call_count, 2)
+
+    def test_image_cache_expires(self):
+        cloud = self._create(image_name='foo')
+        ttl = cloudslave.models.catalog_cache.ttl
+        with mock.patch.object(cloud.client, 'images') as images_mock:
+            self._images_mock(images_mock, 'foo')
+            with mock.patch('time.time') as time_mock:
+                time_mock.return_value = 1000
+                cloud.image
+                time_mock.return_value = 1000 + ttl - 1
+                cloud.image
+                self.assertEquals(images_mock.list.call_count, 1)
+                time_mock.return_value = 1000 + ttl
+                cloud.image
+                self.assertEquals(images_mock.list.call_count, 2)
+
     def test_flavor_not_found(self):
         self.assertRaises(exc.NoMatchingFlavor, self._test_flavor, 'frob')
 
@@ -153,6 +432,22 @@ class CloudTests(TestCase):
             stored_keypair = cloud.keypair
             self.assertEquals(cloud.keypair, stored_keypair)
 
+    def test_keypair_is_cached(self):
+        cloud = self._create()
+        with mock.patch.object(cloud.client, 'keypairs') as keypairs_mock:
+            keypair = cloud.keypair
+            other = Cloud.objects.get(pk=cloud.pk)
+            with self.assertNumQueries(0):
+                self.assertEquals(other.keypair, keypair)
+
+    def test_keypair_cache_is_invalidated(self):
+        cloud = self._create()
+        with mock.patch.object(cloud.client, 'keypairs') as keypairs_mock:
+            keypair = cloud.keypair
+            keypair.delete()
+            self.assertNotEquals(cloud.keypair.pk, keypair.pk)
+            self.assertEquals(keypairs_mock.create.call_count, 2)
+
     def test_create_reservation(self):
         cloud = self._create()
         res = cloud.create_reservation()
@@ -192,6 +487,26 @@ class KeyPairTests(TestCase):
         keypair = self._create()
         self.assertEquals('%s' % (keypair,), 'keypair1@test_cloud')
 
+    def test_paramiko_key_is_cached(self):
+        keypair = self._create()
+        with mock.patch('paramiko.RSAKey.from_private_key',
+                        wraps=paramiko.RSAKey.from_private_key) as parse:
+            pkey = keypair.paramiko_key
+            self.assertEquals(KeyPair.objects.get(pk=keypair.pk).paramiko_key,
+                              pkey)
+            self.assertEquals(parse.call_count, 1)
+
+    def test_paramiko_key_is_reparsed_on_change(self):
+        keypair = self._create()
+        with mock.patch('paramiko.RSAKey.from_private_key') as parse:
+            parse.side_effect = lambda f: f.read()
+            keypair.paramiko_key
+            keypair.private_key = 'new key'
+            keypair.save()
+            self.assertEquals(KeyPair.objects.get(pk=keypair.pk).paramiko_key,
+                              'new key')
+            self.assertEquals(parse.call_count, 2)
+
 
 class ReservationTests(TestCase):
     fixtures = ['test_cloud.yaml']
@@ -200,6 +515,10 @@ class ReservationTests(TestCase):
         cloud = Cloud.objects.get(pk='test_cloud')
         return cloud.create_reservation(*args, **kwargs)
 
+    def setUp(self):
+        clear_caches()
+        self.probe = patch_probe(self)
+
     def test_unicode(self):
         res = self._create()
 
@@ -209,8 +528,35 @@ class ReservationTests(TestCase):
         client_mock = mock.MagicMock()
         client_mock.images = self._image_manager_fake()
         client_mock.flavors = self._flavor_manager_fake()
+        self._server_manager_fake(client_mock.servers)
         return client_mock
 
+    def _server_manager_fake(self, servers_mock):
+        servers = []
+
+        def create(name, image, flavor, key_name=None,
+                   min_count=1, max_count=1, **kwargs):
+            created = []
+            for x in range(max_count):
+                srv = mock.MagicMock()
+                srv.id = 'id-%s-%d' % (name, x)
+                if max_count > 1:
+                    srv.name = '%s-%d' % (name, x + 1)
+                else:
+                    srv.name = name
+                created.append(srv)
+            servers.extend(created)
+            return created[0]
+
+        def list(detailed=True, search_opts=None):
+            search_opts = search_opts or {}
+            rx = re.compile(search_opts.get('name', ''))
+            return [srv for srv in servers if rx.match(srv.name)]
+
+        servers_mock.create.side_effect = create
+        servers_mock.list.side_effect = list
+        return servers
+
     def _flavor_manager_fake(self):
         class Flavor(object):
             def __init__(self, name):
@@ -270,29 +616,111 @@ class ReservationTests(TestCase):
             self.assertRaises(novaclient.exceptions.ClientException, res.start)
             self.assertEquals(res.state, res.FAILED_TO_START)
 
-    def test_start_many_with_single_failure(self):
+    def test_start_many_is_batched(self):
         res = self._create(10)
 
         with mock.patch.object(res.cloud, '_client',
                                new_callable=self._fake_novaclient) as client:
-            global counter
-            counter = 0
-            def side_effect(name, image, flavor, key_name, seen_names=set(), *args, **kwargs):
-                global counter
-                self.assertNotIn(name, seen_names, "Same name seen more than once")
-                seen_names.add(name)
-
-                counter += 1
-                if counter < 6:
-                    return mock.MagicMock()
-                if counter == 6:
-                    raise novaclient.exceptions.ClientException('Did not work')
-                self.assertTrue(False, "Should not be called after one failure")
+            res.start()
+            self.assertEquals(client.servers.create.call_count, 1)
+            kwargs = client.servers.create.call_args[1]
+            self.assertEquals(kwargs['min_count'], 10)
+            self.assertEquals(kwargs['max_count'], 10)
+            self.assertEquals(res.slave_set.count(), 10)
+            self.assertEquals(len(set(s.cloud_node_id
+                                      for s in res.slave_set.all())), 10)
+            self.assertEquals(res.state, res.BOOTING)
 
-            client.servers.create.side_effect = side_effect
+    def test_start_many_failed(self):
+        res = self._create(10)
+
+        with mock.patch.object(res.cloud, '_client',
+                               new_callable=self._fake_novaclient) as client:
+            client.servers.create.side_effect = novaclient.exceptions.ClientException('Did not work')
             self.assertRaises(novaclient.exceptions.ClientException, res.start)
+            self.assertEquals(client.servers.create.call_count, 1)
+            self.assertEquals(res.slave_set.count(), 0)
             self.assertEquals(res.state, res.FAILED_TO_START)
 
+    def test_start_many_incomplete(self):
+        res = self._create(10)
+
+        with mock.patch.object(res.cloud, '_client',
+                               new_callable=self._fake_novaclient) as client:
+            srv = mock.MagicMock()
+            srv.name = 'cloudslave-lonely'
+            client.servers.list.side_effect = None
+            client.servers.list.return_value = [srv]
+            self.assertRaises(exc.IncompleteBoot, res.start)
+            # The server that was found is torn down along with anything
+            # else carrying the reservation's name.
+            self.assertEquals(res.slave_set.count(), 0)
+            self.assertEquals(client.servers.list.call_count, 3)
+            self.assertTrue(srv.delete.called)
+            self.assertEquals(res.state, res.FAILED_TO_START)
+
+    def test_start_many_lagging_listing(self):
+        res = self._create(10)
+
+        with mock.patch.object(res.cloud, '_client',
+                               new_callable=self._fake_novaclient) as client:
+            list_servers = client.servers.list.side_effect
+            listings = []
+
+            def side_effect(*args, **kwargs):
+                listings.append(None)
+                servers = list_servers(*args, **kwargs)
+                if len(listings) == 1:
+                    return servers[:7]
+                return servers
+            client.servers.list.side_effect = side_effect
+
+            res.start()
+            self.assertEquals(len(listings), 2)
+            self.assertEquals(res.slave_set.count(), 10)
+            self.assertEquals(res.state, res.BOOTING)
+
+    def test_start_lookup_failure(self):
+        res = self._create(3)
+
+        with mock.patch.object(res.cloud, '_client',
+                               new_callable=self._fake_novaclient) as client:
+            with mock.patch.object(client.images, 'list', side_effect=
+                    novaclient.exceptions.ClientException('Did not work')):
+                self.assertRaises(novaclient.exceptions.ClientException,
+                                  res.start)
+            self.assertFalse(client.servers.create.called)
+            self.assertEquals(res.state, res.FAILED_TO_START)
+
+    def test_start_retries_with_fresh_image(self):
+        res = self._create(3)
+
+        with mock.patch.object(res.cloud, '_client',
+                               new_callable=self._fake_novaclient) as client:
+            for x, flavor in enumerate(client.flavors.list()):
+                flavor.id = 'flavor-%d' % (x,)
+            stale_image = client.images.list()[0]
+            stale_image.id = 'stale'
+            res.cloud.image
+
+            # The image gets replaced by one with the same name
+            fresh_image = mock.MagicMock()
+            fresh_image.name = 'foo'
+            fresh_image.id = 'fresh'
+            client.images.images = [fresh_image]
+
+            create = client.servers.create.side_effect
+            def side_effect(name, image, *args, **kwargs):
+                if image.id == 'stale':
+                    raise novaclient.exceptions.BadRequest(400)
+                return create(name, image, *args, **kwargs)
+            client.servers.create.side_effect = side_effect
+
+            res.start()
+            self.assertEquals(client.servers.create.call_count, 2)
+            self.assertEquals(client.servers.create.call_args[0][1], fresh_image)
+            self.assertEquals(res.state, res.BOOTING)
+
     def test_terminate(self):
         res = self._create(10)
 
@@ -304,29 +732,87 @@ class ReservationTests(TestCase):
             res.terminate()
             self.assertEquals(Slave.objects.filter(pk__in=slave_pks).count(), 0)
 
+    def _failing_servers(self, client, fail_from):
+        lock = threading.Lock()
+        deletes = []
+
+        class Server(object):
+            networks = {}
+
+            def __init__(self, *args, **kwargs):
+                pass
+
+            def delete(self):
+                with lock:
+                    deletes.append(self)
+                    if len(deletes) >= fail_from:
+                        raise novaclient.exceptions.ClientException('Did not work')
+
+        client.servers.get.side_effect = Server
+        return deletes
+
     def test_terminate_fails(self):
         res = self._create(10)
 
         with mock.patch.object(res.cloud, '_client',
                                new_callable=self._fake_novaclient) as client:
-            global counter
-            counter = 0
-
-            class Server(object):
-                def __init__(self, *args, **kwargs):
-                    pass
-
-                def delete(self):
-                    global counter
-                    counter += 1
-                    # Fail the last four times
-                    if counter >= 6:
-                        raise novaclient.exceptions.ClientException('Did not work')
+            # Fail everything from the sixth delete onwards, retries included
+            deletes = self._failing_servers(client, 6)
+            res.start()
+            failures = res.terminate()
+            self.assertEquals(len(deletes), 15)
+            self.assertEquals(len(failures), 5)
+            self.assertEquals(res.slave_set.count(), 5)
+            self.assertEquals(res.state, res.SHUTTING_DOWN)
 
-            client.servers.get.side_effect = Server
+    def test_terminate_retries(self):
+        res = self._create(10)
+
+        with mock.patch.object(res.cloud, '_client',
+                               new_callable=self._fake_novaclient) as client:
+            deletes = self._failing_servers(client, 6)
             res.start()
-            res.terminate()
-            self.assertEquals(counter, 10)
+            self.assertEquals(len(res.terminate(retries=0)), 5)
+
+            del deletes[:]
+            self.assertEquals(res.terminate(), {})
+            self.assertEquals(res.slave_set.count(), 0)
+            self.assertEquals(res.state, res.TERMINATED)
+
+    def test_terminate_lists_floating_ips_once(self):
+        res = self._create(3)
+        res.cloud.floating_ip_mode = Cloud.NEEDS_FLOATING_IP_ASSIGNED
+
+        # The deletes happen in worker threads, where a MagicMock's call
+        # counts aren't reliable, so record the calls in plain lists.
+        calls = []
+
+        def recorder(name, return_value=None):
+            def record(*args, **kwargs):
+                calls.append(name)
+                return return_value
+            return record
+
+        with mock.patch.object(res.cloud, '_client',
+                               new_callable=self._fake_novaclient) as client:
+            res.start()
+            fips = []
+            for x, slave in enumerate(res.slave_set.all()):
+                slave.floating_ip = '172.16.0.%d' % (x,)
+                slave.save()
+                fip = mock.MagicMock()
+                fip.ip = slave.floating_ip
+                fip.delete.side_effect = recorder(('delete', fip.ip))
+                fips.append(fip)
+            client.floating_ips.list.side_effect = recorder('list', fips)
+            client.floating_ips.find.side_effect = recorder('find')
+            client.servers.get.side_effect = recorder('get', mock.MagicMock())
+            self.assertEquals(res.terminate(), {})
+        self.assertEquals(calls.count('list'), 1)
+        self.assertEquals(calls.count('find'), 0)
+        self.assertEquals(calls.count('get'), 3)
+        self.assertEquals(sorted(c for c in calls if c[0] == 'delete'),
+                          [('delete', fip.ip) for fip in fips])
 
     def _create_res(self):
         res = Reservation(cloud=Cloud.objects.get(), number_of_slaves=10)
@@ -339,11 +825,21 @@ class ReservationTests(TestCase):
             slave.save()
         return res
 
+    def _servers(self, *states):
+        servers = {}
+        for x, state in enumerate(states):
+            srv = mock.MagicMock()
+            srv.id = 'slave-%d' % (x,)
+            srv.status = state
+            srv.networks = {'private': ['10.0.0.%d' % (x,)]}
+            servers[srv.id] = srv
+        return servers
+
     def test_update_status_still_building(self):
         res = self._create_res()
 
-        with mock.patch.object(cloudslave.models.Slave, '_fetch_current_state') as _fetch_current_state:
-            _fetch_current_state.side_effect = ['BUILD'] * 10
+        with mock.patch.object(cloudslave.models.Cloud, 'servers_by_id') as servers_by_id:
+            servers_by_id.return_value = self._servers(*['BUILD'] * 10)
             res.update_state()
             self.assertEquals(res.state, res.BOOTING)
 
@@ -351,8 +847,8 @@ class ReservationTests(TestCase):
         res = self._create_res()
         res.terminate = lambda: None
 
-        with mock.patch.object(cloudslave.models.Slave, '_fetch_current_state') as _fetch_current_state:
-            _fetch_current_state.side_effect = ['ERROR', Exception("Don't keep polling after you've seen a failure")]
+        with mock.patch.object(cloudslave.models.Cloud, 'servers_by_id') as servers_by_id:
+            servers_by_id.return_value = self._servers(*['ERROR'] * 10)
             res.update_state()
             self.assertEquals(res.state, res.FAILED_TO_START)
 
@@ -360,18 +856,1748 @@ class ReservationTests(TestCase):
         res = self._create_res()
         res.terminate = lambda: None
 
-        with mock.patch.object(cloudslave.models.Slave, '_fetch_current_state') as _fetch_current_state:
+        with mock.patch.object(cloudslave.models.Cloud, 'servers_by_id') as servers_by_id:
             res.timeout = datetime.datetime.now()
-            _fetch_current_state.side_effect = ['BUILD'] * 10
+            servers_by_id.return_value = self._servers(*['BUILD'] * 10)
             res.update_state()
             self.assertEquals(res.state, res.FAILED_TO_START)
 
+    def test_update_status_leaves_failed_reservation_alone(self):
+        res = self._create_res()
+        for state in (res.FAILED_TO_START, res.SHUTTING_DOWN,
+                      res.TERMINATED):
+            res.set_state(state)
+            with mock.patch.object(cloudslave.models.Slave, 'run_cmd'):
+                with mock.patch.object(cloudslave.models.Cloud,
+                                       'servers_by_id') as servers_by_id:
+                    servers_by_id.return_value = self._servers(
+                                                     *['ACTIVE'] * 10)
+                    self.assertEquals(res.update_state(), state)
+            self.assertEquals(Reservation.objects.get(pk=res.pk).state, state)
+
     def test_update_status_active(self):
         res = self._create_res()
         res.terminate = lambda: None
 
         with mock.patch.object(cloudslave.models.Slave, 'run_cmd') as run_cmd:
-            with mock.patch.object(cloudslave.models.Slave, '_fetch_current_state') as _fetch_current_state:
-                _fetch_current_state.side_effect = ['ACTIVE'] * 10
+            with mock.patch.object(cloudslave.models.Cloud, 'servers_by_id') as servers_by_id:
+                servers_by_id.return_value = self._servers(*['ACTIVE'] * 10)
+                res.update_state()
+                self.assertEquals(res.state, res.READY)
+                self.assertEquals(servers_by_id.call_count, 1)
+
+    def _check_serially(self):
+        # MagicMock's call counts aren't safe to update from several
+        # threads at once
+        patch = mock.patch('cloudslave.fanout.run_concurrently',
+                           side_effect=run_serially)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_update_status_port_closed(self):
+        res = self._create_res()
+        self._check_serially()
+        self.probe.side_effect = None
+        self.probe.return_value = set(['10.0.0.1'])
+
+        with mock.patch.object(cloudslave.models.Slave, 'run_cmd') as run_cmd:
+            with mock.patch.object(cloudslave.models.Cloud, 'servers_by_id') as servers_by_id:
+                servers_by_id.return_value = self._servers(*['ACTIVE'] * 10)
+                res.update_state()
+                self.assertEquals(run_cmd.call_count, 1)
+                self.assertEquals(res.state, res.NEW)
+
+    def test_update_status_ssh_not_ready(self):
+        res = self._create_res()
+        self._check_serially()
+
+        with mock.patch.object(cloudslave.models.Slave, 'run_cmd') as run_cmd:
+            with mock.patch.object(cloudslave.models.Cloud, 'servers_by_id') as servers_by_id:
+                run_cmd.side_effect = [None] * 9 + [socket.error(111, 'Connection refused')]
+                servers_by_id.return_value = self._servers(*['ACTIVE'] * 10)
                 res.update_state()
+                self.assertEquals(res.state, res.NEW)
+
+                # Only the slave that wasn't ready gets probed again
+                run_cmd.side_effect = None
+                res.update_state()
+                self.assertEquals(run_cmd.call_count, 11)
+                self.assertEquals(len(self.probe.call_args[0][0]), 1)
                 self.assertEquals(res.state, res.READY)
+
+    def test_update_status_checks_ssh_concurrently(self):
+        res = self._create_res()
+        lock = threading.Lock()
+        running = []
+        seen = []
+
+        def run_cmd(slave, cmd):
+            with lock:
+                running.append(slave)
+                seen.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.remove(slave)
+
+        with mock.patch.object(cloudslave.models, 'SSH_READY_WORKERS', 4):
+            with mock.patch.object(cloudslave.models.Slave, 'run_cmd',
+                                   run_cmd):
+                with mock.patch.object(cloudslave.models.Cloud,
+                                       'servers_by_id') as servers_by_id:
+                    servers_by_id.return_value = self._servers(
+                                                     *['ACTIVE'] * 10)
+                    res.update_state()
+        self.assertEquals(res.state, res.READY)
+        self.assertEquals(len(seen), 10)
+        self.assertTrue(1 < max(seen) <= 4)
+
+    def test_update_status_fetches_missing_servers(self):
+        res = self._create_res()
+        res.terminate = lambda: None
+
+        with mock.patch.object(cloudslave.models.Slave, 'run_cmd') as run_cmd:
+            with mock.patch.object(cloudslave.models.Cloud, 'servers_by_id') as servers_by_id:
+                with mock.patch.object(cloudslave.models.Slave, '_fetch_current_state') as _fetch_current_state:
+                    servers_by_id.return_value = self._servers(*['ACTIVE'] * 9)
+                    _fetch_current_state.return_value = 'ACTIVE'
+                    with mock.patch.object(cloudslave.models.Slave, 'cloud_server') as cloud_server:
+                        cloud_server.networks = {'private': ['10.0.0.9']}
+                        res.update_state()
+                    self.assertEquals(_fetch_current_state.call_count, 1)
+                    self.assertEquals(res.state, res.READY)
+
+    def test_servers_by_id_filters_on_prefix(self):
+        res = self._create_res()
+
+        with mock.patch.object(res.cloud, '_client') as client:
+            srv = mock.MagicMock()
+            srv.id = 'slave-0'
+            client.servers.list.return_value = [srv]
+            servers = res.cloud.servers_by_id(res.slave_set.all())
+            client.servers.list.assert_called_once_with(search_opts={'name': '^slave-'})
+            self.assertEquals(servers, {'slave-0': srv})
+
+    def test_update_reservations(self):
+        res = self._create_res()
+        res.set_state(res.BOOTING)
+        cloud = res.cloud
+
+        with mock.patch.object(cloudslave.models.Slave, 'run_cmd') as run_cmd:
+            with mock.patch.object(cloudslave.models.Cloud, 'servers_by_id') as servers_by_id:
+                servers_by_id.return_value = self._servers(*['ACTIVE'] * 10)
+                updated = cloud.update_reservations()
+                servers_by_id.assert_called_once_with()
+                self.assertEquals([r.pk for r in updated], [res.pk])
+                self.assertEquals(Reservation.objects.get(pk=res.pk).state,
+                                  res.READY)
+
+    def test_update_reservations_skips_leased(self):
+        res = self._create_res()
+        res.set_state(res.BOOTING)
+        Reservation.acquire_leases('someone else', [res.pk], 60)
+
+        with mock.patch.object(Cloud, 'servers_by_id') as servers_by_id:
+            self.assertEquals(res.cloud.update_reservations(), [])
+            self.assertFalse(servers_by_id.called)
+        self.assertEquals(Reservation.objects.get(pk=res.pk).lease_owner,
+                          'someone else')
+
+
+class SlaveTests(TestCase):
+    fixtures = ['test_cloud.yaml']
+
+    def setUp(self):
+        clear_caches()
+        res = Reservation(cloud=Cloud.objects.get(), number_of_slaves=1)
+        res.save()
+        self.slave = Slave(name='slave', reservation=res, cloud_node_id='id-1')
+        self.slave.save()
+
+    def test_cloud_server_is_cached(self):
+        with mock.patch.object(self.slave.reservation.cloud, '_client') as client:
+            self.assertEquals(self.slave.cloud_server,
+                              client.servers.get.return_value)
+            self.slave.cloud_server
+            client.servers.get.assert_called_once_with('id-1')
+
+    def test_cloud_server_expires(self):
+        with mock.patch.object(self.slave.reservation.cloud, '_client') as client:
+            with mock.patch('time.time') as time_:
+                time_.return_value = 1000
+                self.slave.cloud_server
+                time_.return_value += cloudslave.models.SERVER_TTL + 1
+                self.slave.cloud_server
+            self.assertEquals(client.servers.get.call_count, 2)
+
+    def test_refresh_server(self):
+        with mock.patch.object(self.slave.reservation.cloud, '_client') as client:
+            self.slave.cloud_server
+            self.slave.refresh_server()
+            self.assertEquals(client.servers.get.call_count, 2)
+
+    def test_update_state_populates_cache(self):
+        cloud = self.slave.reservation.cloud
+        cloud.floating_ip_mode = Cloud.NEEDS_FLOATING_IP_ASSIGNED
+        server = mock.MagicMock()
+        server.status = 'ACTIVE'
+        server.networks = {'private': ['10.0.0.1']}
+
+        with mock.patch.object(cloud, '_client') as client:
+            client.floating_ips.create.return_value.ip = '172.16.0.1'
+            self.slave.update_state(server)
+            self.slave.delete()
+            server.add_floating_ip.assert_called_once_with('172.16.0.1')
+            server.remove_floating_ip.assert_called_once_with('172.16.0.1')
+            server.delete.assert_called_once_with()
+            self.assertEquals(client.servers.get.call_count, 0)
+
+    def test_delete_fetches_server_once(self):
+        cloud = self.slave.reservation.cloud
+        cloud.floating_ip_mode = Cloud.NEEDS_FLOATING_IP_ASSIGNED
+        self.slave.floating_ip = '172.16.0.1'
+
+        with mock.patch.object(cloud, '_client') as client:
+            self.slave.delete()
+            client.servers.get.assert_called_once_with('id-1')
+
+
+    def test_addresses_are_stored_when_active(self):
+        server = mock.MagicMock()
+        server.status = 'ACTIVE'
+        server.networks = {'private': ['10.0.0.1']}
+        self.slave.update_state(server)
+
+        slave = Slave.objects.get(pk='slave')
+        with mock.patch.object(slave.reservation.cloud, '_client') as client:
+            self.assertEquals(slave.internal_ip, '10.0.0.1')
+            self.assertEquals(slave.external_ip, '10.0.0.1')
+            self.assertEquals(client.servers.get.call_count, 0)
+
+    def test_internal_address_is_stored_with_assigned_floating_ip(self):
+        cloud = self.slave.reservation.cloud
+        cloud.floating_ip_mode = Cloud.NEEDS_FLOATING_IP_ASSIGNED
+        server = mock.MagicMock()
+        server.status = 'ACTIVE'
+        server.networks = {'private': ['10.0.0.1']}
+
+        with mock.patch.object(cloud, '_client') as client:
+            client.floating_ips.create.return_value.ip = '172.16.0.1'
+            self.slave.update_state(server)
+        slave = Slave.objects.get(pk='slave')
+        self.assertEquals(slave.internal_address, '10.0.0.1')
+        self.assertEquals(slave.external_address, '172.16.0.1')
+
+    def test_external_address_waits_for_floating_ip(self):
+        cloud = self.slave.reservation.cloud
+        cloud.floating_ip_mode = Cloud.AUTOMATICALLY_ASSIGNS_FLOATING_IP
+        server = mock.MagicMock()
+        server.status = 'ACTIVE'
+        server.networks = {'private': ['10.0.0.1']}
+        self.slave.update_state(server)
+        self.assertEquals(self.slave.external_address, None)
+
+        server.networks = {'private': ['10.0.0.1', '172.16.0.1']}
+        self.slave.update_state(server)
+        self.assertEquals(Slave.objects.get(pk='slave').external_address,
+                          '172.16.0.1')
+
+class RunCmdTests(TestCase):
+    fixtures = ['test_cloud.yaml']
+
+    def setUp(self):
+        res = Reservation(cloud=Cloud.objects.get(), number_of_slaves=1)
+        res.save()
+        self.slave = Slave(name='slave-0', reservation=res,
+                           cloud_node_id='slave-0')
+        self.slave.save()
+
+    def _run_cmd(self, chunks, exit_status=0):
+        def _run_cmd(cmd, input=None):
+            for chunk in chunks:
+                yield chunk
+            if exit_status != 0:
+                raise exc.CommandFailed('Command %s failed' % (cmd,),
+                                        exit_status=exit_status)
+        return mock.patch.object(self.slave, '_run_cmd', side_effect=_run_cmd)
+
+    def test_run_cmd(self):
+        with self._run_cmd(['foo\nb', 'ar\n', 'baz']):
+            self.assertEquals(self.slave.run_cmd('true'), 'foo\nbar\nbaz')
+
+    def test_run_cmd_max_output(self):
+        with self._run_cmd(['a' * 10, 'b' * 10, 'c' * 10]):
+            self.assertEquals(self.slave.run_cmd('true', max_output=15),
+                              'b' * 5 + 'c' * 10)
+
+    def test_run_cmd_output_file(self):
+        output_file = StringIO.StringIO()
+        with self._run_cmd(['a' * 10, 'b' * 10, 'c' * 10]):
+            self.slave.run_cmd('true', output_file=output_file, max_output=5)
+        self.assertEquals(output_file.getvalue(),
+                          'a' * 10 + 'b' * 10 + 'c' * 10)
+
+    def test_run_cmd_failure(self):
+        with self._run_cmd(['a' * 10, 'b' * 10], exit_status=2):
+            try:
+                self.slave.run_cmd('false', max_output=5)
+            except exc.CommandFailed, e:
+                self.assertEquals(e.exit_status, 2)
+                self.assertEquals(e.output, 'b' * 5)
+            else:
+                self.fail('CommandFailed not raised')
+
+    def test_read_channel(self):
+        chan = FakeChannel('x' * 50000, 0)
+        with mock.patch.object(self.slave, '_open_session',
+                               return_value=(None, chan)):
+            with mock.patch.object(chan, 'recv', wraps=chan.recv) as recv:
+                output = ''.join(self.slave._run_cmd('yes', read_size=65536))
+                self.assertEquals(output, 'x' * 50000)
+                self.assertEquals(recv.call_args[0], (65536,))
+        self.assertEquals(chan.commands, ['yes'])
+
+    def test_run_cmd_releases_pooled_connection(self):
+        chan = FakeChannel('x', 0)
+        ssh = mock.MagicMock()
+        ssh.get_transport.return_value.open_session.return_value = chan
+        with mock.patch('cloudslave.models.ssh_pool') as pool:
+            pool.get.return_value = ssh
+            self.slave.run_cmd('true')
+            pool.release.assert_called_once_with('slave-0', ssh)
+        self.assertFalse(ssh.close.called)
+
+    def test_read_channel_failure(self):
+        chan = FakeChannel('oops', 3)
+        with mock.patch.object(self.slave, '_open_session',
+                               return_value=(None, chan)):
+            try:
+                self.slave.run_cmd('false')
+            except exc.CommandFailed, e:
+                self.assertEquals(e.exit_status, 3)
+                self.assertEquals(e.output, 'oops')
+            else:
+                self.fail('CommandFailed not raised')
+
+    def test_stream_cmd(self):
+        with self._run_cmd(['foo\nb', 'ar\n', 'baz']):
+            self.assertEquals(list(self.slave.stream_cmd('true')),
+                              ['foo\nb', 'ar\n', 'baz'])
+
+    def test_stream_cmd_lines(self):
+        with self._run_cmd(['foo\nb', 'ar\n', 'baz']):
+            self.assertEquals(list(self.slave.stream_cmd('true', lines=True)),
+                              ['foo\n', 'bar\n', 'baz'])
+
+    def test_stream_cmd_flushes_long_lines(self):
+        with self._run_cmd(['x' * 40000] * 3 + ['\ny']):
+            self.assertEquals(list(self.slave.stream_cmd('true', lines=True)),
+                              ['x' * 80000, 'x' * 40000 + '\n', 'y'])
+
+    def test_run_cmd_logs_long_lines_in_pieces(self):
+        with self._run_cmd(['x' * 40000] * 3):
+            with mock.patch.object(cloudslave.models.logger, 'info') as info:
+                self.assertEquals(self.slave.run_cmd('yes'), 'x' * 120000)
+        self.assertEquals([len(c[0][0]) for c in info.call_args_list],
+                          [17 + 80000, 17 + 40000])
+
+    def test_line_buffer(self):
+        lbuf = cloudslave.models.LineBuffer(max_line=5)
+        self.assertEquals(lbuf.feed('ab\ncd'), ['ab\n'])
+        self.assertEquals(lbuf.feed('e\n\nfg'), ['cde\n', '\n'])
+        self.assertEquals(lbuf.feed('hij'), ['fghij'])
+        self.assertEquals(lbuf.feed('k'), [])
+        self.assertEquals(lbuf.flush(), 'k')
+        self.assertEquals(lbuf.flush(), '')
+
+
+class FakeChannel(object):
+    def __init__(self, output, exit_status):
+        self._sock, self._peer = socket.socketpair()
+        self.output = output
+        self.exit_status = exit_status
+        self.commands = []
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def set_combine_stderr(self, combine):
+        pass
+
+    def exec_command(self, cmd):
+        self.commands.append(cmd)
+        self._peer.sendall(self.output)
+        self._peer.close()
+
+    def recv(self, nbytes):
+        return self._sock.recv(nbytes)
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def close(self):
+        self._sock.close()
+
+
+class RunCmdAllTests(TestCase):
+    fixtures = ['test_cloud.yaml']
+
+    def setUp(self):
+        clear_caches()
+        self.res = Reservation(cloud=Cloud.objects.get(), number_of_slaves=3)
+        self.res.save()
+        servers = {}
+        for x in range(3):
+            Slave(name='slave-%d' % (x,), reservation=self.res,
+                  cloud_node_id='slave-%d' % (x,)).save()
+            srv = mock.MagicMock()
+            srv.networks = {'private': ['10.0.0.%d' % (x,)]}
+            servers['slave-%d' % (x,)] = srv
+
+        patches = [mock.patch.object(Cloud, 'servers_by_id',
+                                     return_value=servers),
+                   mock.patch.object(Slave, 'paramiko_private_key',
+                                     new_callable=mock.PropertyMock),
+                   mock.patch.object(Slave, '_open_session', autospec=True,
+                                     side_effect=self._open_session)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.channels = {}
+        self.failing = set()
+        self.unreachable = set()
+
+    def _open_session(self, slave, pooled):
+        if slave.name in self.unreachable:
+            raise socket.error('Connection refused')
+        exit_status = slave.name in self.failing and 1 or 0
+        chan = FakeChannel('hello from %s\n' % (slave.external_ip,),
+                           exit_status)
+        self.channels[slave.name] = chan
+        return None, chan
+
+    def test_collect_all(self):
+        self.failing.add('slave-1')
+        results = self.res.run_cmd_all('hostname')
+        self.assertEquals(sorted(results), ['slave-0', 'slave-1', 'slave-2'])
+        self.assertEquals(results['slave-0'].output, 'hello from 10.0.0.0\n')
+        self.assertEquals(results['slave-0'].exit_status, 0)
+        self.assertTrue(results['slave-0'].succeeded)
+        self.assertEquals(results['slave-1'].exit_status, 1)
+        self.assertFalse(results['slave-1'].succeeded)
+        self.assertEquals(results['slave-2'].output, 'hello from 10.0.0.2\n')
+        for chan in self.channels.values():
+            self.assertEquals(chan.commands, ['hostname'])
+
+    def test_collect_all_with_unreachable_slave(self):
+        self.unreachable.add('slave-2')
+        results = self.res.run_cmd_all('hostname')
+        self.assertTrue(results['slave-0'].succeeded)
+        self.assertTrue(isinstance(results['slave-2'].error, socket.error))
+        self.assertEquals(results['slave-2'].exit_status, None)
+
+    def test_fail_fast(self):
+        self.failing.add('slave-1')
+        try:
+            self.res.run_cmd_all('false', fail_fast=True)
+        except exc.CommandFailed, e:
+            self.assertEquals(e.results['slave-1'].exit_status, 1)
+        else:
+            self.fail('CommandFailed not raised')
+
+    def test_fail_fast_with_unreachable_slave(self):
+        self.unreachable.add('slave-2')
+        self.assertRaises(exc.CommandFailed, self.res.run_cmd_all, 'true',
+                          fail_fast=True, max_workers=1)
+
+    def test_connections_are_released(self):
+        with mock.patch.object(Slave, '_close_session',
+                               autospec=True) as close_session:
+            self.res.run_cmd_all('hostname')
+        self.assertEquals(sorted(c[0][0].name
+                                 for c in close_session.call_args_list),
+                          ['slave-0', 'slave-1', 'slave-2'])
+
+    def test_more_channels_than_fd_setsize(self):
+        # Two descriptors per channel puts most of them past the 1024
+        # that select() can handle.
+        count = 1100
+        if resource.getrlimit(resource.RLIMIT_NOFILE)[0] < 2 * count + 100:
+            self.skipTest('Not enough file descriptors')
+
+        slaves = []
+        for x in range(count):
+            slave = mock.Mock()
+            slave.name = 'slave-%d' % (x,)
+            chan = FakeChannel('%d\n' % (x,), 0)
+            slave._open_session.return_value = (None, chan)
+            slaves.append(slave)
+
+        results = fanout.run_cmd_all(slaves, 'hostname', max_workers=50)
+        self.assertEquals(len(results), count)
+        self.assertEquals(results['slave-1099'].output, '1099\n')
+        self.assertTrue(all(r.succeeded for r in results.values()))
+        for slave in slaves:
+            self.assertEquals(slave._close_session.call_count, 1)
+
+
+class ChangesSincePollerTests(FakeCloudMixin, TestCase):
+    def setUp(self):
+        super(ChangesSincePollerTests, self).setUp()
+        self.poller = ChangesSincePoller(self.cloud)
+
+    def _start(self, count, updated=None):
+        if updated is not None:
+            self.nova.now = lambda: updated
+        res = self.cloud.create_reservation(count)
+        res.start()
+        if updated is not None:
+            del self.nova.now
+        return res
+
+    def test_first_poll_lists_everything(self):
+        self._start(3)
+        with mock.patch.object(self.nova.servers, 'list',
+                               wraps=self.nova.servers.list) as list_mock:
+            self.assertEquals(len(self.poller.changed_servers()), 3)
+            list_mock.assert_called_once_with(search_opts={})
+
+    def test_only_changes_are_fetched(self):
+        long_ago = datetime.datetime(2013, 1, 1)
+        res = self._start(5, updated=long_ago)
+        self.poller.poll()
+
+        changed = self.nova.servers.list()[0]
+        self.nova.servers.set_status(changed, 'ACTIVE')
+        self.assertEquals(self.poller.changed_servers().keys(), [changed.id])
+
+    def test_poll_advances_reservation(self):
+        res = self._start(3)
+        self.poller.poll()
+        self.assertEquals(Slave.objects.filter(state='BUILD').count(), 3)
+
+        for srv in self.nova.servers.list():
+            self.nova.servers.set_status(srv, 'ACTIVE',
+                                         {'private': ['10.0.0.1']})
+        with mock.patch.object(cloudslave.models.Slave, 'run_cmd') as run_cmd:
+            self.assertEquals([r.pk for r in self.poller.poll()], [res.pk])
+        self.assertEquals(Reservation.objects.get(pk=res.pk).state, res.READY)
+
+    def test_first_poll_reconciles_floating_ips(self):
+        self.cloud.floating_ip_pool_size = 2
+        with mock.patch.object(self.cloud,
+                               'reconcile_floating_ips') as reconcile:
+            self.poller.poll()
+            self.poller.poll()
+            self.assertEquals(reconcile.call_count, 1)
+
+    def test_poll_only_looks_at_changed_reservations(self):
+        long_ago = datetime.datetime(2013, 1, 1)
+        res1 = self._start(2, updated=long_ago)
+        res2 = self._start(2, updated=long_ago)
+        self.poller.poll()
+
+        changed = res1.slave_set.all()[0].cloud_node_id
+        self.nova.servers.set_status(changed, 'ACTIVE')
+        with mock.patch.object(Reservation, 'update_state') as update_state:
+            self.assertEquals([r.pk for r in self.poller.poll()], [res1.pk])
+            self.assertEquals(update_state.call_count, 1)
+
+    def test_poll_looks_at_expired_reservations(self):
+        long_ago = datetime.datetime(2013, 1, 1)
+        res1 = self._start(2, updated=long_ago)
+        res2 = self._start(2, updated=long_ago)
+        self.poller.poll()
+
+        Reservation.objects.filter(pk=res2.pk).update(
+            timeout=datetime.datetime.now())
+        self.assertEquals([r.pk for r in self.poller.poll()], [res2.pk])
+        self.assertEquals(Reservation.objects.get(pk=res2.pk).state,
+                          Reservation.TERMINATED)
+        self.assertEquals(Reservation.objects.get(pk=res1.pk).state,
+                          Reservation.BOOTING)
+
+    def test_poll_looks_at_active_reservations_until_ssh_answers(self):
+        long_ago = datetime.datetime(2013, 1, 1)
+        res1 = self._start(2, updated=long_ago)
+        res2 = self._start(2, updated=long_ago)
+        self.nova.now = lambda: long_ago
+        for srv in res1.slave_set.all():
+            self.nova.servers.set_status(srv.cloud_node_id, 'ACTIVE',
+                                         {'private': ['10.0.0.1']})
+        del self.nova.now
+        with mock.patch('cloudslave.sshpool.probe', return_value=set()):
+            self.poller.poll()
+        self.assertEquals(Reservation.objects.get(pk=res1.pk).state,
+                          Reservation.BOOTING)
+
+        # Nova has nothing new to say about either reservation
+        self.assertEquals([r.pk for r in self.poller.poll()], [res1.pk])
+        self.assertEquals(Reservation.objects.get(pk=res1.pk).state,
+                          Reservation.READY)
+        self.assertEquals(Reservation.objects.get(pk=res2.pk).state,
+                          Reservation.BOOTING)
+
+    def test_poll_skips_leased_reservations(self):
+        res = self._start(3)
+        Reservation.acquire_leases('someone else', [res.pk], 60)
+        self.assertEquals(self.poller.poll(), [])
+        self.assertEquals(Slave.objects.filter(state='BUILD').count(), 0)
+
+    def test_poll_fails_reservation_on_deleted_server(self):
+        res = self._start(3)
+        self.poller.poll()
+
+        self.nova.servers.delete(self.nova.servers.list()[0])
+        self.poller.poll()
+        self.assertEquals(Reservation.objects.get(pk=res.pk).state,
+                          res.TERMINATED)
+        self.assertEquals(self.nova.servers.list(), [])
+
+
+class SSHPoolTests(TestCase):
+    def _connect(self):
+        ssh = mock.MagicMock()
+        ssh.get_transport.return_value.is_active.return_value = True
+        return ssh
+
+    def test_connection_is_reused(self):
+        pool = sshpool.SSHPool()
+        connect = mock.Mock(side_effect=self._connect)
+        ssh = pool.get('slave1', connect)
+        self.assertEquals(pool.get('slave1', connect), ssh)
+        self.assertEquals(connect.call_count, 1)
+        ssh.get_transport.return_value.set_keepalive.assert_called_with(30)
+
+    def test_dead_connection_is_replaced(self):
+        pool = sshpool.SSHPool()
+        connect = mock.Mock(side_effect=self._connect)
+        ssh = pool.get('slave1', connect)
+        ssh.get_transport.return_value.is_active.return_value = False
+        self.assertNotEquals(pool.get('slave1', connect), ssh)
+        self.assertTrue(ssh.close.called)
+        self.assertEquals(connect.call_count, 2)
+
+    def test_idle_connection_is_evicted(self):
+        pool = sshpool.SSHPool(idle_timeout=60)
+        with mock.patch('time.time') as time_mock:
+            time_mock.return_value = 1000
+            ssh = pool.get('slave1', self._connect)
+            pool.release('slave1', ssh)
+            time_mock.return_value = 1060
+            pool.get('slave2', self._connect)
+            self.assertTrue(ssh.close.called)
+
+    def test_busy_connection_is_not_evicted_when_idle(self):
+        pool = sshpool.SSHPool(idle_timeout=60)
+        with mock.patch('time.time') as time_mock:
+            time_mock.return_value = 1000
+            ssh = pool.get('slave1', self._connect)
+            time_mock.return_value = 1060
+            pool.get('slave2', self._connect)
+            self.assertFalse(ssh.close.called)
+
+    def test_max_connections(self):
+        pool = sshpool.SSHPool(max_connections=2)
+        with mock.patch('time.time') as time_mock:
+            time_mock.return_value = 1000
+            ssh1 = pool.get('slave1', self._connect)
+            pool.release('slave1', ssh1)
+            time_mock.return_value = 1001
+            ssh2 = pool.get('slave2', self._connect)
+            pool.release('slave2', ssh2)
+            time_mock.return_value = 1002
+            pool.release('slave1', pool.get('slave1', self._connect))
+            time_mock.return_value = 1003
+            ssh3 = pool.get('slave3', self._connect)
+            self.assertFalse(ssh2.close.called)
+            pool.release('slave3', ssh3)
+            self.assertFalse(ssh1.close.called)
+            self.assertTrue(ssh2.close.called)
+            self.assertFalse(ssh3.close.called)
+
+    def test_busy_connections_go_over_max_connections(self):
+        pool = sshpool.SSHPool(max_connections=2)
+        connections = [pool.get('slave%d' % (x,), self._connect)
+                       for x in range(3)]
+        for ssh in connections:
+            self.assertFalse(ssh.close.called)
+
+        pool.release('slave1', connections[1])
+        self.assertTrue(connections[1].close.called)
+        pool.release('slave0', connections[0])
+        pool.release('slave2', connections[2])
+        self.assertFalse(connections[0].close.called)
+        self.assertFalse(connections[2].close.called)
+
+    def test_shared_connection_stays_checked_out(self):
+        pool = sshpool.SSHPool(max_connections=1)
+        connect = mock.Mock(side_effect=self._connect)
+        ssh = pool.get('slave1', connect)
+        self.assertEquals(pool.get('slave1', connect), ssh)
+        pool.release('slave1', ssh)
+        other = pool.get('slave2', connect)
+        pool.release('slave2', other)
+        self.assertFalse(ssh.close.called)
+        self.assertTrue(other.close.called)
+
+    def test_release_after_discard(self):
+        pool = sshpool.SSHPool(max_connections=1)
+        ssh = pool.get('slave1', self._connect)
+        pool.discard('slave1')
+        fresh = pool.get('slave1', self._connect)
+        pool.release('slave1', ssh)
+        pool.release('slave1', fresh)
+        self.assertFalse(fresh.close.called)
+        self.assertEquals(pool.get('slave1', self._connect), fresh)
+
+    def test_probe(self):
+        listening = socket.socket()
+        listening.bind(('127.0.0.1', 0))
+        listening.listen(1)
+        self.addCleanup(listening.close)
+        closed = socket.socket()
+        closed.bind(('127.0.0.2', 0))
+        self.addCleanup(closed.close)
+
+        self.assertEquals(sshpool.probe(['127.0.0.1'],
+                                        port=listening.getsockname()[1]),
+                          set(['127.0.0.1']))
+        self.assertEquals(sshpool.probe(['127.0.0.2'],
+                                        port=closed.getsockname()[1]),
+                          set())
+
+    def test_probe_without_poll(self):
+        listening = socket.socket()
+        listening.bind(('127.0.0.1', 0))
+        listening.listen(1)
+        self.addCleanup(listening.close)
+        no_poll = mock.Mock(spec=['select'],
+                            select=mock.Mock(wraps=sshpool.select.select))
+        with mock.patch.object(sshpool, 'select', no_poll):
+            self.assertEquals(sshpool.probe(['127.0.0.1'],
+                                            port=listening.getsockname()[1]),
+                              set(['127.0.0.1']))
+        self.assertTrue(no_poll.select.called)
+
+    def test_discard(self):
+        pool = sshpool.SSHPool()
+        connect = mock.Mock(side_effect=self._connect)
+        ssh = pool.get('slave1', connect)
+        pool.discard('slave1')
+        self.assertTrue(ssh.close.called)
+        pool.get('slave1', connect)
+        self.assertEquals(connect.call_count, 2)
+
+    def test_discard_leaves_replacement_alone(self):
+        pool = sshpool.SSHPool()
+        dead = pool.get('slave1', self._connect)
+        pool.discard('slave1')
+        fresh = pool.get('slave1', self._connect)
+        pool.discard('slave1', dead)
+        self.assertFalse(fresh.close.called)
+        self.assertEquals(pool.get('slave1', self._connect), fresh)
+
+    def test_discard_connection(self):
+        pool = sshpool.SSHPool()
+        ssh = pool.get('slave1', self._connect)
+        pool.discard('slave1', ssh)
+        self.assertTrue(ssh.close.called)
+        self.assertNotEqual(pool.get('slave1', self._connect), ssh)
+
+
+class ReservationDriverTests(TestCase):
+    fixtures = ['test_cloud.yaml']
+
+    def setUp(self):
+        # The reservations are never saved, as the workers can't get at the
+        # test database. Leases are handed out from here instead.
+        self.reservations = {}
+        self.leased_elsewhere = set()
+        patch = mock.patch.object(Reservation, 'leased',
+                                  staticmethod(self._leased))
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.driver = ReservationDriver(max_workers=4, max_per_cloud=2,
+                                        poll_interval=0.01)
+        self.driver.start()
+        self.addCleanup(self.driver.stop)
+
+    @contextlib.contextmanager
+    def _leased(self, owner, ids, ttl=None, limit=None):
+        yield [self.reservations[pk] for pk in ids
+               if pk not in self.leased_elsewhere]
+
+    def _reservation(self, states):
+        res = Reservation(cloud=Cloud.objects.get(), number_of_slaves=1,
+                          state=Reservation.BOOTING)
+        res.pk = len(self.reservations) + 1
+        self.reservations[res.pk] = res
+        states = list(states)
+
+        def update_state():
+            res.state = states.pop(0)
+            return res.state
+        res.update_state = update_state
+        return res
+
+    def test_wait_until_ready(self):
+        res = self._reservation([Reservation.BOOTING] * 3 +
+                                [Reservation.READY])
+        self.assertEquals(self.driver.submit(res).result(timeout=5), res)
+
+    def test_failed_reservation(self):
+        res = self._reservation([Reservation.BOOTING,
+                                 Reservation.TERMINATED])
+        future = self.driver.submit(res)
+        self.assertRaises(exc.ReservationFailed, future.result, 5)
+
+    def test_partly_torn_down_reservation_fails(self):
+        res = self._reservation([Reservation.BOOTING,
+                                 Reservation.SHUTTING_DOWN])
+        future = self.driver.submit(res)
+        self.assertRaises(exc.ReservationFailed, future.result, 5)
+
+    def test_error_is_passed_on(self):
+        res = self._reservation([])
+        future = self.driver.submit(res)
+        self.assertRaises(IndexError, future.result, 5)
+
+    def test_timeout(self):
+        res = self._reservation([Reservation.BOOTING] * 1000)
+        future = self.driver.submit(res)
+        self.assertRaises(exc.WaitTimeout, future.result, 0)
+
+    def test_new_reservation_is_started(self):
+        res = self._reservation([Reservation.READY])
+        res.state = Reservation.NEW
+        res.start = mock.Mock()
+        self.driver.submit(res).result(timeout=5)
+        res.start.assert_called_once_with()
+
+    def test_per_cloud_limit(self):
+        lock = threading.Lock()
+        running = []
+        seen = []
+
+        def reservation():
+            res = self._reservation([])
+
+            def update_state():
+                with lock:
+                    running.append(res)
+                    seen.append(len(running))
+                time.sleep(0.02)
+                with lock:
+                    running.remove(res)
+                res.state = Reservation.READY
+                return res.state
+            res.update_state = update_state
+            return res
+
+        futures = [self.driver.submit(reservation()) for x in range(6)]
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEquals(max(seen), 2)
+
+    def test_reservation_leased_elsewhere_waits(self):
+        res = self._reservation([Reservation.READY])
+        self.leased_elsewhere.add(res.pk)
+        future = self.driver.submit(res)
+        self.assertFalse(future.wait(0.05))
+        self.assertEquals(res.state, Reservation.BOOTING)
+        self.leased_elsewhere.clear()
+        self.assertEquals(future.result(timeout=5), res)
+
+
+class WarmPoolTests(FakeCloudMixin, TestCase):
+    cloud_fields = {'warm_pool_size': 5, 'warm_pool_floor': 2}
+
+    def _fill_pool(self, count):
+        res = self.cloud.create_reservation(count, pool=True)
+        res.start()
+        for srv in self.nova.servers.list():
+            self.nova.servers.set_status(srv, 'ACTIVE',
+                                         {'private': ['10.0.0.1']})
+        res.update_state()
+        self.assertEquals(res.state, res.READY)
+        return res
+
+    def test_start_claims_from_pool(self):
+        pool = self._fill_pool(3)
+        res = self.cloud.create_reservation(2)
+        with mock.patch.object(self.nova.servers, 'create') as create:
+            with mock.patch.object(cloudslave.models.boot_stats,
+                                   'record_ready') as record_ready:
+                res.start()
+                self.assertFalse(record_ready.called)
+            self.assertFalse(create.called)
+        self.assertEquals(res.state, res.READY)
+        self.assertEquals(res.slave_set.count(), 2)
+        self.assertEquals(pool.slave_set.count(), 1)
+
+    def test_start_boots_what_the_pool_lacks(self):
+        self._fill_pool(3)
+        res = self.cloud.create_reservation(5)
+        res.start()
+        self.assertEquals(res.state, res.BOOTING)
+        self.assertEquals(res.slave_set.count(), 5)
+        self.assertEquals(len(self.nova.servers.list()), 5)
+
+    def test_booting_pool_slaves_are_not_claimed(self):
+        pool = self.cloud.create_reservation(3, pool=True)
+        pool.start()
+        res = self.cloud.create_reservation(2)
+        self.assertEquals(self.cloud.claim_slaves(res, 2), [])
+
+    def test_slaves_are_claimed_only_once(self):
+        self._fill_pool(3)
+        res1 = self.cloud.create_reservation(3)
+        res2 = self.cloud.create_reservation(3)
+        self.assertEquals(len(self.cloud.claim_slaves(res1, 3)), 3)
+        self.assertEquals(self.cloud.claim_slaves(res2, 3), [])
+
+    def test_failed_start_returns_claimed_slaves(self):
+        self._fill_pool(3)
+        self.cloud.invalidate_catalog()
+        res = self.cloud.create_reservation(5)
+        with mock.patch.object(self.nova.images, 'list', side_effect=
+                novaclient.exceptions.ClientException('Did not work')):
+            self.assertRaises(novaclient.exceptions.ClientException,
+                              res.start)
+        self.assertEquals(res.state, res.FAILED_TO_START)
+        self.assertEquals(res.slave_set.count(), 0)
+        self.assertEquals(self.cloud._pooled_slaves().filter(
+            reservation__state=Reservation.READY).count(), 3)
+        self.assertEquals(len(self.nova.servers.list()), 3)
+
+    def test_missing_image_returns_claimed_slaves(self):
+        self._fill_pool(3)
+        res = self.cloud.create_reservation(5)
+        with mock.patch.object(Cloud, 'image', new_callable=mock.PropertyMock,
+                               side_effect=exc.NoMatchingImage('foo')):
+            self.assertRaises(exc.NoMatchingImage, res.start)
+        self.assertEquals(res.state, res.FAILED_TO_START)
+        self.assertEquals(res.slave_set.count(), 0)
+        self.assertEquals(self.cloud._pooled_slaves().filter(
+            reservation__state=Reservation.READY).count(), 3)
+
+    def test_restart_counts_slaves_already_claimed(self):
+        self._fill_pool(3)
+        res = self.cloud.create_reservation(5)
+        self.assertEquals(len(self.cloud.claim_slaves(res, 2)), 2)
+        res.start()
+        self.assertEquals(res.state, res.BOOTING)
+        self.assertEquals(res.slave_set.count(), 5)
+        self.assertEquals(self.cloud._pooled_slaves().count(), 0)
+        self.assertEquals(len(self.nova.servers.list()), 5)
+
+    def test_failed_group_start_returns_claimed_slaves(self):
+        self._fill_pool(3)
+        self.cloud.invalidate_catalog()
+        group = ReservationGroup.create_across([self.cloud], 5)
+        with mock.patch.object(self.nova.images, 'list', side_effect=
+                novaclient.exceptions.ClientException('Did not work')):
+            with mock.patch.object(self.nova.servers, 'create') as create:
+                self.assertRaises(novaclient.exceptions.ClientException,
+                                  group.start)
+                self.assertFalse(create.called)
+        self.assertEquals(group.state, Reservation.TERMINATED)
+        self.assertEquals(group.slaves.count(), 0)
+        self.assertEquals(self.cloud._pooled_slaves().filter(
+            reservation__state=Reservation.READY).count(), 3)
+        self.assertEquals(len(self.nova.servers.list()), 3)
+
+    def test_pool_is_not_used_when_disabled(self):
+        self._fill_pool(3)
+        self.cloud.warm_pool_size = 0
+        res = self.cloud.create_reservation(2)
+        res.start()
+        self.assertEquals(res.state, res.BOOTING)
+
+    def test_target_follows_demand(self):
+        self.assertEquals(self.cloud.warm_pool_target(), 2)
+        self.cloud.create_reservation(3)
+        self.assertEquals(self.cloud.warm_pool_target(), 3)
+        self.cloud.create_reservation(3)
+        self.assertEquals(self.cloud.warm_pool_target(), 5)
+
+    def test_maintain_fills_pool(self):
+        self.cloud.maintain_warm_pool()
+        self.assertEquals(len(self.nova.servers.list()), 2)
+        pool = Reservation.objects.get(pool=True)
+        self.assertEquals(pool.state, pool.BOOTING)
+
+        for srv in self.nova.servers.list():
+            self.nova.servers.set_status(srv, 'ACTIVE',
+                                         {'private': ['10.0.0.1']})
+        self.cloud.maintain_warm_pool()
+        self.assertEquals(Reservation.objects.get(pool=True).state,
+                          pool.READY)
+        self.assertEquals(len(self.nova.servers.list()), 2)
+
+    def test_maintain_shrinks_pool(self):
+        self._fill_pool(4)
+        self.cloud.maintain_warm_pool()
+        self.assertEquals(len(self.nova.servers.list()), 2)
+        self.assertEquals(Slave.objects.count(), 2)
+
+    def test_maintain_removes_empty_pool_reservations(self):
+        self._fill_pool(2)
+        res = self.cloud.create_reservation(2)
+        res.start()
+        # The demand for 2 slaves refills the pool
+        self.cloud.maintain_warm_pool()
+        self.assertEquals(Reservation.objects.filter(pool=True).count(), 1)
+        self.assertEquals(Reservation.objects.get(pool=True).state,
+                          Reservation.BOOTING)
+
+    def test_maintain_skips_leased_pool_reservations(self):
+        pool = self.cloud.create_reservation(2, pool=True)
+        Reservation.acquire_leases('someone else', [pool.pk], 60)
+        with mock.patch.object(Reservation, 'update_state') as update_state:
+            self.cloud.maintain_warm_pool()
+            self.assertFalse(update_state.called)
+
+    def test_reconciler_leaves_new_pool_reservation_alone(self):
+        reconciler = Reconciler()
+        real_start = Reservation.start
+        started = []
+
+        def start(res):
+            started.append(res.pk)
+            # A reconciler pass while the pool reservation is being started
+            self.assertEquals(reconciler.pending(), [])
+            real_start(res)
+
+        with mock.patch.object(Reservation, 'start', start):
+            self.cloud.maintain_warm_pool()
+        pool = Reservation.objects.get(pool=True)
+        self.assertEquals(started, [pool.pk])
+        self.assertEquals(pool.lease_owner, None)
+        self.assertEquals(len(self.nova.servers.list()), 2)
+
+    def test_maintainer(self):
+        with mock.patch.object(Cloud, 'maintain_warm_pool') as maintain:
+            maintain.side_effect = Exception('Keep going')
+            WarmPoolMaintainer().maintain_all()
+            self.assertEquals(maintain.call_count, 1)
+
+
+class FloatingIPPoolTests(FakeCloudMixin, TestCase):
+    cloud_fields = {'floating_ip_mode': Cloud.NEEDS_FLOATING_IP_ASSIGNED,
+                    'floating_ip_pool_size': 2}
+
+    def test_released_ip_is_reused(self):
+        ip = self.cloud.acquire_floating_ip()
+        self.cloud.release_floating_ip(ip)
+        self.assertEquals(self.cloud.acquire_floating_ip(), ip)
+        self.assertEquals(len(self.nova.floating_ips.list()), 1)
+        self.assertTrue(FloatingIP.objects.get(ip=ip).in_use)
+
+    def test_pool_size_is_capped(self):
+        ips = [self.cloud.acquire_floating_ip() for x in range(3)]
+        for ip in ips:
+            self.cloud.release_floating_ip(ip)
+        self.assertEquals(FloatingIP.objects.filter(in_use=False).count(), 2)
+        self.assertEquals(len(self.nova.floating_ips.list()), 2)
+
+    def test_no_pool(self):
+        self.cloud.floating_ip_pool_size = 0
+        ip = self.cloud.acquire_floating_ip()
+        self.assertEquals(FloatingIP.objects.count(), 0)
+        self.cloud.release_floating_ip(ip)
+        self.assertEquals(self.nova.floating_ips.list(), [])
+
+    def test_pooled_ip_gone_from_nova_is_skipped(self):
+        ip = self.cloud.acquire_floating_ip()
+        self.cloud.release_floating_ip(ip)
+        self.nova.floating_ips.delete(self.nova.floating_ips.list()[0])
+
+        fresh = self.cloud.acquire_floating_ip()
+        self.assertNotEquals(fresh, None)
+        self.assertEquals([fip.ip for fip in self.nova.floating_ips.list()],
+                          [fresh])
+        self.assertEquals(list(FloatingIP.objects.values_list('ip', 'in_use')),
+                          [(fresh, True)])
+
+    def test_pooled_ip_attached_elsewhere_is_skipped(self):
+        ip = self.cloud.acquire_floating_ip()
+        self.cloud.release_floating_ip(ip)
+        self.nova.floating_ips.list()[0].instance_id = 'someone-elses'
+
+        self.assertNotEquals(self.cloud.acquire_floating_ip(), ip)
+        self.assertFalse(FloatingIP.objects.filter(ip=ip).exists())
+
+    def test_slave_lifecycle(self):
+        res = self.cloud.create_reservation(1)
+        server = self.nova.servers.create('slave-0', None, None)
+        slave = Slave(name='slave-0', reservation=res,
+                      cloud_node_id=server.id)
+        slave.save()
+        self.nova.servers.set_status(server, 'ACTIVE',
+                                     {'private': ['10.0.0.1']})
+        slave.update_state()
+        self.assertEquals(server.networks['private'][-1], slave.floating_ip)
+
+        slave.delete()
+        self.assertEquals(FloatingIP.objects.get().in_use, False)
+        self.assertEquals(len(self.nova.floating_ips.list()), 1)
+
+    def test_terminate_returns_ips_to_pool(self):
+        self.nova.images.add(name='foo')
+        self.nova.flavors.add(name='bar')
+        res = self.cloud.create_reservation(3)
+        res.start()
+        for slave in res.slave_set.all():
+            self.nova.servers.set_status(slave.cloud_node_id, 'ACTIVE',
+                                         {'private': ['10.0.0.1']})
+            slave.update_state()
+
+        self.assertEquals(res.terminate(), {})
+        self.assertEquals(FloatingIP.objects.filter(in_use=False).count(), 2)
+        self.assertEquals(len(self.nova.floating_ips.list()), 2)
+
+    def test_reconcile(self):
+        gone = FloatingIP.objects.create(cloud=self.cloud, ip='10.1.1.1',
+                                         nova_id='gone', in_use=False)
+        leaked = self.nova.floating_ips.create()
+        FloatingIP.objects.create(cloud=self.cloud, ip=leaked.ip,
+                                  nova_id=leaked.id, in_use=True)
+        used = self.nova.floating_ips.create()
+        FloatingIP.objects.create(cloud=self.cloud, ip=used.ip,
+                                  nova_id=used.id, in_use=True)
+        res = self.cloud.create_reservation(1)
+        Slave(name='slave-0', reservation=res, cloud_node_id='slave-0',
+              floating_ip=used.ip).save()
+        stolen = self.nova.floating_ips.create()
+        stolen.instance_id = 'someone-elses'
+        FloatingIP.objects.create(cloud=self.cloud, ip=stolen.ip,
+                                  nova_id=stolen.id, in_use=False)
+
+        self.cloud.reconcile_floating_ips()
+        self.assertEquals(sorted(FloatingIP.objects.values_list('ip', 'in_use')),
+                          sorted([(leaked.ip, False), (used.ip, True)]))
+
+    def test_reconcile_trims_pool(self):
+        for x in range(4):
+            fip = self.nova.floating_ips.create()
+            FloatingIP.objects.create(cloud=self.cloud, ip=fip.ip,
+                                      nova_id=fip.id, in_use=False)
+        self.cloud.reconcile_floating_ips()
+        self.assertEquals(FloatingIP.objects.count(), 2)
+        self.assertEquals(len(self.nova.floating_ips.list()), 2)
+
+
+class ReservationGroupTests(FakeCloudMixin, TestCase):
+    def setUp(self):
+        super(ReservationGroupTests, self).setUp()
+        other = Cloud.objects.get(pk='test_cloud')
+        other.pk = 'other_cloud'
+        other.save()
+        self.clouds = list(Cloud.objects.order_by('name'))
+        self.novas = {'test_cloud': self.nova,
+                      'other_cloud': self._fake_nova(other)}
+
+    def _activate(self, nova):
+        for srv in nova.servers.list():
+            nova.servers.set_status(srv, 'ACTIVE', {'private': ['10.0.0.1']})
+
+    def test_create_across(self):
+        group = ReservationGroup.create_across(self.clouds, 5)
+        self.assertEquals(
+            sorted(res.number_of_slaves for res in group.reservation_set.all()),
+            [2, 3])
+
+    def test_start_boots_on_every_cloud(self):
+        group = ReservationGroup.create_across(self.clouds, 5)
+        group.start()
+        self.assertEquals(group.state, Reservation.BOOTING)
+        self.assertEquals(group.slaves.count(), 5)
+        self.assertEquals(len(self.novas['other_cloud'].servers.list()), 3)
+        self.assertEquals(len(self.novas['test_cloud'].servers.list()), 2)
+
+    def test_update_state(self):
+        group = ReservationGroup.create_across(self.clouds, 4)
+        group.start()
+        self._activate(self.novas['test_cloud'])
+        self.assertEquals(group.update_state(), Reservation.BOOTING)
+        self._activate(self.novas['other_cloud'])
+        self.assertEquals(group.update_state(), Reservation.READY)
+
+    def test_failure_on_one_cloud_terminates_all(self):
+        group = ReservationGroup.create_across(self.clouds, 4)
+        group.start()
+        self._activate(self.novas['test_cloud'])
+        for srv in self.novas['other_cloud'].servers.list():
+            self.novas['other_cloud'].servers.set_status(srv, 'ERROR')
+        group.update_state()
+        self.assertEquals(group.state, Reservation.TERMINATED)
+        self.assertEquals(group.slaves.count(), 0)
+        for nova in self.novas.values():
+            self.assertEquals(nova.servers.list(), [])
+
+    def test_failed_boot_terminates_all(self):
+        group = ReservationGroup.create_across(self.clouds, 4)
+        nova = self.novas['other_cloud']
+        with mock.patch.object(nova.servers, 'create') as create:
+            create.side_effect = novaclient.exceptions.ClientException(
+                                     'Quota exceeded')
+            self.assertRaises(novaclient.exceptions.ClientException,
+                              group.start)
+        self.assertEquals(group.state, Reservation.TERMINATED)
+        self.assertEquals(self.novas['test_cloud'].servers.list(), [])
+
+    def test_incomplete_boot_deletes_leftovers(self):
+        group = ReservationGroup.create_across(self.clouds, 5)
+        nova = self.novas['other_cloud']
+        list_servers = nova.servers.list
+        listings = []
+
+        def short_listing(*args, **kwargs):
+            # Nova lags behind on all but one of the new servers until
+            # it's too late
+            listings.append(1)
+            servers = list_servers(*args, **kwargs)
+            if len(listings) <= 2:
+                return servers[:1]
+            return servers
+
+        with mock.patch.object(nova.servers, 'list',
+                               side_effect=short_listing):
+            self.assertRaises(exc.IncompleteBoot, group.start)
+        self.assertEquals(group.state, Reservation.TERMINATED)
+        for nova in self.novas.values():
+            self.assertEquals(nova.servers.list(), [])
+
+    def test_create_across_no_clouds(self):
+        self.assertRaises(exc.NoCapacity,
+                          ReservationGroup.create_across, [], 3)
+        self.assertEquals(ReservationGroup.objects.count(), 0)
+
+    def test_run_cmd_all(self):
+        group = ReservationGroup.create_across(self.clouds, 4)
+        group.start()
+        for nova in self.novas.values():
+            self._activate(nova)
+        with mock.patch('cloudslave.fanout.run_cmd_all') as run_cmd_all:
+            with mock.patch.object(KeyPair, 'paramiko_key', 'pkey'):
+                group.run_cmd_all('hostname')
+            slaves = run_cmd_all.call_args[0][0]
+            self.assertEquals(len(slaves), 4)
+            self.assertEquals(set(s.reservation.cloud_id for s in slaves),
+                              set(['test_cloud', 'other_cloud']))
+
+    def test_run_cmd_all_uses_stored_addresses(self):
+        group = ReservationGroup.create_across(self.clouds, 4)
+        group.start()
+        for nova in self.novas.values():
+            self._activate(nova)
+        self.assertEquals(group.update_state(), Reservation.READY)
+        for nova in self.novas.values():
+            nova.calls.clear()
+        with mock.patch('cloudslave.fanout.run_cmd_all') as run_cmd_all:
+            with mock.patch.object(KeyPair, 'paramiko_key', 'pkey'):
+                group.run_cmd_all('hostname')
+            slaves = run_cmd_all.call_args[0][0]
+            self.assertEquals(sorted(s.external_ip for s in slaves),
+                              ['10.0.0.1'] * 4)
+        for nova in self.novas.values():
+            self.assertEquals(nova.call_count, 0)
+
+
+class MetricsTests(FakeCloudMixin, TestCase):
+
+    def test_histogram(self):
+        histogram = metrics.Histogram()
+        for value in [0.001, 0.02, 0.02, 0.3, 7]:
+            histogram.add(value)
+        self.assertEquals(histogram.count, 5)
+        self.assertEquals(histogram.min, 0.001)
+        self.assertEquals(histogram.max, 7)
+        self.assertAlmostEquals(histogram.mean, 7.341 / 5)
+        self.assertEquals(histogram.percentile(50), 0.025)
+        self.assertEquals(histogram.percentile(100), 7)
+
+    def test_series_are_kept_per_tags(self):
+        metrics.record('op', 1, cloud='a')
+        metrics.record('op', 2, cloud='a')
+        metrics.record('op', 3, cloud='b')
+        collector = metrics.default_collector
+        self.assertEquals(collector.histogram('op', cloud='a').count, 2)
+        self.assertEquals(collector.histogram('op', cloud='b').total, 3)
+        self.assertEquals(collector.histogram('op', cloud='c'), None)
+
+    def test_timed(self):
+        with mock.patch('time.time') as time_:
+            time_.side_effect = [10, 12.5]
+            with metrics.timed('op', cloud='a'):
+                pass
+        self.assertEquals(
+            metrics.default_collector.histogram('op', cloud='a').total, 2.5)
+
+    def test_custom_collector(self):
+        collector = mock.Mock()
+        broken = mock.Mock()
+        broken.record.side_effect = Exception('Broken')
+        metrics.add_collector(broken)
+        metrics.add_collector(collector)
+        try:
+            with mock.patch.object(metrics.logger, 'error') as error:
+                metrics.record('op', 1, cloud='a')
+                self.assertEquals(error.call_count, 1)
+        finally:
+            metrics.remove_collector(broken)
+            metrics.remove_collector(collector)
+        collector.record.assert_called_once_with('op', 1, {'cloud': 'a'})
+
+    def test_reservation_is_instrumented(self):
+        res = self.cloud.create_reservation(3)
+        res.start()
+        for srv in self.nova.servers.list():
+            self.nova.servers.set_status(srv, 'ACTIVE',
+                                         {'private': ['10.0.0.1']})
+        res.update_state()
+        self.assertEquals(res.state, res.READY)
+        res.terminate()
+
+        collector = metrics.default_collector
+        for name, count in [('reservation.start', 1),
+                            ('nova.servers.create', 1),
+                            ('nova.servers.delete', 3),
+                            ('slave.boot_to_active', 3),
+                            ('reservation.boot_to_active', 1),
+                            ('reservation.active_to_ready', 1)]:
+            self.assertEquals(
+                collector.histogram(name, cloud='test_cloud').count, count)
+        calls = collector.calls()
+        self.assertEquals(calls.keys(), ['test_cloud'])
+        self.assertTrue(calls['test_cloud'] >= 6)
+
+    def test_every_nova_call_is_counted(self):
+        self.cloud.keypair
+        ip = self.cloud.acquire_floating_ip()
+        self.cloud.release_floating_ip(ip)
+        self.cloud.floating_ip_pool_size = 1
+        self.cloud.reconcile_floating_ips()
+        ChangesSincePoller(self.cloud).changed_servers()
+        self.assertEquals(metrics.default_collector.calls(),
+                          {'test_cloud': self.nova.call_count})
+        self.assertEquals(self.nova.calls['floating_ips.find'], 1)
+        self.assertEquals(self.nova.calls['floating_ips.delete'], 1)
+
+    def test_active_to_ready_survives_another_process(self):
+        res = self.cloud.create_reservation(2)
+        res.start()
+        for srv in self.nova.servers.list():
+            self.nova.servers.set_status(srv, 'ACTIVE',
+                                         {'private': ['10.0.0.1']})
+        with mock.patch.object(Reservation, '_ssh_ready', return_value=[]):
+            res.update_state()
+        self.assertEquals(res.state, res.BOOTING)
+        self.assertNotEqual(res.active_since, None)
+
+        # Whoever advances it next only has what's in the database
+        clear_caches()
+        res = Reservation.objects.get(pk=res.pk)
+        res.cloud._client = self.nova
+        res.update_state()
+        self.assertEquals(res.state, res.READY)
+        self.assertEquals(metrics.default_collector.histogram(
+            'reservation.active_to_ready', cloud='test_cloud').count, 1)
+
+
+class FakeNovaTests(TestCase):
+    def test_calls_are_counted(self):
+        nova = fakes.FakeNovaClient(images=['foo'])
+        nova.images.list()
+        nova.images.list()
+        nova.servers.create('srv', 'foo', 'bar')
+        self.assertEquals(nova.calls, {'images.list': 2, 'servers.create': 1})
+        self.assertEquals(nova.call_count, 3)
+
+    def test_failure_injection(self):
+        nova = fakes.FakeNovaClient(failure_rate=1)
+        self.assertRaises(novaclient.exceptions.ClientException,
+                          nova.servers.list)
+
+    def test_boot_delay(self):
+        nova = fakes.FakeNovaClient(boot_delay=0)
+        nova.servers.create('srv', 'foo', 'bar', min_count=2)
+        self.assertEquals([(srv.status, srv.networks)
+                           for srv in nova.servers.list()],
+                          [('ACTIVE', {'private': ['10.0.0.1']}),
+                           ('ACTIVE', {'private': ['10.0.0.2']})])
+
+    def test_boot_errors(self):
+        nova = fakes.FakeNovaClient(boot_delay=0, error_rate=1)
+        srv = nova.servers.create('srv', 'foo', 'bar')
+        self.assertEquals(nova.servers.get(srv.id).status, 'ERROR')
+
+
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        clear_caches()
+
+    def test_run(self):
+        bench = benchmark.Benchmark(poll_interval=0)
+        bench.setup()
+        try:
+            bench.run(2)
+        finally:
+            bench.teardown()
+        self.assertEquals([(m.operation, m.slaves, m.error)
+                           for m in bench.results],
+                          [('start', 2, None),
+                           ('update_state', 2, None),
+                           ('run_cmd', 2, None),
+                           ('run_cmd_all', 2, None),
+                           ('terminate', 2, None)])
+        # Two readiness checks, run_cmd and two from run_cmd_all
+        self.assertEquals(bench.ssh_server.commands, 5)
+        self.assertEquals(bench.results[-1].api_calls, 4)
+        out = StringIO.StringIO()
+        bench.report(out)
+        self.assertEquals(len(out.getvalue().splitlines()), 6)
+
+
+def run_serially(func, items, max_workers):
+    errors = {}
+    for item in items:
+        try:
+            func(item)
+        except Exception, e:
+            errors[item] = e
+    return errors
+
+
+class ReconcilerTests(FakeCloudMixin, TestCase):
+    def setUp(self):
+        super(ReconcilerTests, self).setUp()
+        # The test database can't be shared between threads
+        patch = mock.patch('cloudslave.fanout.run_concurrently',
+                           side_effect=run_serially)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.reconciler = Reconciler()
+
+    def _activate(self):
+        for srv in self.nova.servers.list():
+            self.nova.servers.set_status(srv, 'ACTIVE',
+                                         {'private': ['10.0.0.1']})
+
+    def _reload(self, res):
+        return Reservation.objects.get(pk=res.pk)
+
+    def test_new_reservation_is_started_and_advanced(self):
+        res = self.cloud.create_reservation(2)
+        self.reconciler.run_once()
+        self.assertEquals(self._reload(res).state, Reservation.BOOTING)
+        self._activate()
+        self.reconciler.run_once()
+        self.assertEquals(self._reload(res).state, Reservation.READY)
+        self.assertEquals(self.reconciler.run_once(), 0)
+
+    def test_new_reservations_can_be_left_alone(self):
+        res = self.cloud.create_reservation(2)
+        Reconciler(start_new=False).run_once()
+        self.assertEquals(self._reload(res).state, Reservation.NEW)
+
+    def test_one_listing_per_cloud(self):
+        for x in range(3):
+            self.cloud.create_reservation(2)
+        self.reconciler.run_once()
+        self.nova.calls.clear()
+        self.reconciler.run_once()
+        self.assertEquals(self.nova.calls, {'servers.list': 1})
+
+    def test_timeout_is_enforced(self):
+        res = self.cloud.create_reservation(2)
+        self.reconciler.run_once()
+        self._activate()
+        with mock.patch.object(Reservation, '_ssh_ready', return_value=[]):
+            self.reconciler.run_once()
+            self.assertEquals(self._reload(res).state, Reservation.BOOTING)
+            Reservation.objects.filter(pk=res.pk).update(
+                timeout=datetime.datetime.now())
+            self.reconciler.run_once()
+        res = self._reload(res)
+        self.assertEquals(res.state, Reservation.TERMINATED)
+        self.assertEquals(res.slave_set.count(), 0)
+        self.assertEquals(self.nova.servers.list(), [])
+
+    def test_timeout_sweep_is_one_query(self):
+        for x in range(3):
+            self.cloud.create_reservation(1)
+        Reservation.objects.update(timeout=datetime.datetime.now())
+        with mock.patch.object(Reconciler, '_fail') as fail:
+            with mock.patch.object(Reservation.objects, 'expired',
+                                   wraps=Reservation.objects.expired) as exp:
+                self.reconciler.run_once()
+                self.assertEquals(exp.call_count, 1)
+            self.assertEquals(fail.call_count, 3)
+
+    def test_failed_leftovers_are_cleaned_up(self):
+        res = self.cloud.create_reservation(2)
+        res.start()
+        res.set_state(Reservation.FAILED_TO_START)
+        self.reconciler.run_once()
+        res = self._reload(res)
+        self.assertEquals(res.state, Reservation.TERMINATED)
+        self.assertEquals(self.nova.servers.list(), [])
+
+    def test_failing_reservation_does_not_stop_others(self):
+        broken = self.cloud.create_reservation(1)
+        res = self.cloud.create_reservation(1)
+        real_start = Reservation.start
+
+        def start(self):
+            if self.pk == broken.pk:
+                raise Exception('Broken')
+            real_start(self)
+
+        with mock.patch.object(Reservation, 'start', start):
+            with mock.patch.object(cloudslave.reconciler.logger, 'error'):
+                self.reconciler.run_once()
+        self.assertEquals(self._reload(res).state, Reservation.BOOTING)
+
+    def test_wait(self):
+        res = self.cloud.create_reservation(1)
+        self.assertRaises(exc.WaitTimeout, res.wait, timeout=0)
+        Reservation.objects.filter(pk=res.pk).update(state=Reservation.READY)
+        self.assertEquals(res.wait(timeout=0), Reservation.READY)
+
+    def test_command(self):
+        with mock.patch.object(Reconciler, 'run_once') as run_once:
+            run_once.return_value = 3
+            out = StringIO.StringIO()
+            call_command('reconcile_reservations', once=True, stdout=out)
+            self.assertEquals(out.getvalue().strip(),
+                              'Reconciled 3 reservations')
+
+    def test_reconcilers_share_the_work(self):
+        for x in range(4):
+            self.cloud.create_reservation(1)
+        seen = []
+        other_handled = []
+
+        def reconcile(self, res, servers=None, expired=None):
+            # Both workers are mid-pass at the same time
+            if self is first and not other_handled:
+                other_handled.append(other.run_once())
+            seen.append(res.pk)
+
+        first = Reconciler(owner='first', batch_size=2)
+        other = Reconciler(owner='other', batch_size=2)
+        with mock.patch.object(Reconciler, 'reconcile', reconcile):
+            self.assertEquals(first.run_once(), 2)
+        # The other worker handled the two reservations first had not
+        # leased, and nobody handled one twice.
+        self.assertEquals(other_handled, [2])
+        self.assertEquals(sorted(seen),
+                          sorted(Reservation.objects.values_list('pk',
+                                                                 flat=True)))
+        self.assertEquals(
+            Reservation.objects.exclude(lease_owner=None).count(), 0)
+
+    def test_leased_reservations_are_skipped(self):
+        res = self.cloud.create_reservation(2)
+        Reservation.acquire_leases('someone else', [res.pk], 60)
+        self.assertEquals(self.reconciler.run_once(), 0)
+        self.assertEquals(self._reload(res).state, Reservation.NEW)
+
+    def test_floating_ips_are_reconciled_once(self):
+        self.cloud.floating_ip_pool_size = 2
+        self.cloud.save()
+        with mock.patch.object(Cloud, 'reconcile_floating_ips') as reconcile:
+            self.reconciler.run_once()
+            self.reconciler.run_once()
+            self.assertEquals(reconcile.call_count, 1)
+
+    def test_batch_is_bounded_per_cloud(self):
+        other = Cloud.objects.get(pk='test_cloud')
+        other.pk = 'other_cloud'
+        other.save()
+        for x in range(6):
+            self.cloud.create_reservation(1)
+            other.create_reservation(1)
+        reconciler = Reconciler(max_per_cloud=1)
+        pending = reconciler.pending()
+        self.assertEquals(sorted(res.cloud_id for res in pending),
+                          ['other_cloud'] * 4 + ['test_cloud'] * 4)
+        # Another worker gets a share of what's left on each cloud
+        pending = Reconciler(batch_size=1).pending()
+        self.assertEquals(sorted(res.cloud_id for res in pending),
+                          ['other_cloud', 'test_cloud'])
+
+    def test_leases_are_renewed_during_a_pass(self):
+        self.cloud.create_reservation(1)
+        renewers = []
+        real_renewer = cloudslave.reconciler.LeaseRenewer
+
+        def renewer(*args):
+            renewers.append(real_renewer(*args))
+            return renewers[-1]
+
+        with mock.patch('cloudslave.reconciler.LeaseRenewer', renewer):
+            self.reconciler.run_once()
+        self.assertEquals(len(renewers), 1)
+        self.assertEquals(renewers[0].owner, self.reconciler.owner)
+        self.assertEquals(len(renewers[0].ids), 1)
+        self.assertFalse(renewers[0].is_alive())
+
+    def _create_group(self):
+        other = Cloud.objects.get(pk='test_cloud')
+        other.pk = 'other_cloud'
+        other.save()
+        other_nova = fakes.FakeNovaClient(images=['foo'], flavors=['bar'])
+        cloudslave.models.nova_clients.set(other, other_nova)
+        return ReservationGroup.create_across([self.cloud, other], 4)
+
+    def test_group_follows_its_reservations(self):
+        group = self._create_group()
+        self.reconciler.run_once()
+        self.assertEquals(ReservationGroup.objects.get(pk=group.pk).state,
+                          Reservation.BOOTING)
+
+    def test_failed_part_terminates_group(self):
+        group = self._create_group()
+        self.reconciler.run_once()
+        failed, other = group._reservations()
+        for srv in self.nova.servers.list():
+            self.nova.servers.set_status(srv, 'ERROR')
+        self.reconciler.run_once()
+
+        group = ReservationGroup.objects.get(pk=group.pk)
+        self.assertEquals(group.state, Reservation.TERMINATED)
+        self.assertEquals(self._reload(failed).state, Reservation.TERMINATED)
+        self.assertEquals(self._reload(other).state, Reservation.TERMINATED)
+        self.assertEquals(group.slaves.count(), 0)
+        self.assertEquals(
+            Reservation.objects.exclude(lease_owner=None).count(), 0)
+
+    def test_group_is_left_alone_while_a_part_is_leased(self):
+        group = self._create_group()
+        self.reconciler.run_once()
+        failed, other = group._reservations()
+        Reservation.acquire_leases('someone else', [other.pk], 60)
+        for srv in self.nova.servers.list():
+            self.nova.servers.set_status(srv, 'ERROR')
+        self.reconciler.run_once()
+
+        self.assertEquals(ReservationGroup.objects.get(pk=group.pk).state,
+                          Reservation.BOOTING)
+        self.assertEquals(self._reload(other).state, Reservation.BOOTING)
+
+
+class LeaseTests(TestCase):
+    fixtures = ['test_cloud.yaml']
+
+    def setUp(self):
+        cloud = Cloud.objects.get(pk='test_cloud')
+        self.ids = [cloud.create_reservation(1).pk for x in range(4)]
+
+    def test_leases_are_exclusive(self):
+        mine = Reservation.acquire_leases('a', self.ids, 60, 3)
+        theirs = Reservation.acquire_leases('b', self.ids, 60)
+        self.assertEquals([res.pk for res in mine], self.ids[:3])
+        self.assertEquals([res.pk for res in theirs], self.ids[3:])
+        self.assertEquals(Reservation.acquire_leases('c', self.ids, 60), [])
+
+    def test_owner_keeps_its_leases(self):
+        Reservation.acquire_leases('a', self.ids, 60)
+        self.assertEquals(len(Reservation.acquire_leases('a', self.ids, 60)),
+                          4)
+
+    def test_expired_leases_are_taken_over(self):
+        Reservation.acquire_leases('a', self.ids, -1)
+        self.assertEquals(len(Reservation.acquire_leases('b', self.ids, 60)),
+                          4)
+
+    def test_renew(self):
+        Reservation.acquire_leases('a', self.ids, -1)
+        Reservation.renew_leases('a', self.ids[:2], 60)
+        self.assertEquals(len(Reservation.acquire_leases('b', self.ids, 60)),
+                          2)
+
+    def test_renewer(self):
+        with mock.patch.object(Reservation, 'renew_leases') as renew_leases:
+            renewer = cloudslave.models.LeaseRenewer('a', self.ids, 0.03)
+            renewer.start()
+            time.sleep(0.1)
+            renewer.stop()
+        self.assertTrue(renew_leases.call_count >= 2)
+        renew_leases.assert_called_with('a', self.ids, 0.03)
+
+    def test_leased(self):
+        Reservation.acquire_leases('b', self.ids[:1], 60)
+        with Reservation.leased('a', self.ids) as reservations:
+            self.assertEquals([res.pk for res in reservations], self.ids[1:])
+        self.assertEquals(len(Reservation.acquire_leases('c', self.ids, 60)),
+                          3)
+
+    def test_release(self):
+        Reservation.acquire_leases('a', self.ids, 60)
+        Reservation.release_leases('b', self.ids)
+        self.assertEquals(Reservation.acquire_leases('b', self.ids, 60), [])
+        Reservation.release_leases('a', self.ids[:2])
+        self.assertEquals(len(Reservation.acquire_leases('b', self.ids, 60)),
+                          2)
+
+
+class ManagerTests(TestCase):
+    fixtures = ['test_cloud.yaml']
+
+    def setUp(self):
+        self.cloud = Cloud.objects.get(pk='test_cloud')
+        self.reservations = {}
+        for state, _ in Reservation.RESERVATION_STATES:
+            res = self.cloud.create_reservation(1)
+            res.set_state(state)
+            self.reservations[state] = res
+
+    def _pks(self, reservations):
+        return sorted(res.pk for res in reservations)
+
+    def test_active(self):
+        self.assertEquals(self._pks(Reservation.objects.active()),
+                          self._pks([self.reservations[Reservation.NEW],
+                                     self.reservations[Reservation.BOOTING],
+                                     self.reservations[Reservation.READY],
+                                     self.reservations[
+                                         Reservation.SHUTTING_DOWN]]))
+
+    def test_expired(self):
+        self.assertEquals(list(Reservation.objects.expired()), [])
+        later = datetime.datetime.now() + datetime.timedelta(days=1)
+        self.assertEquals(self._pks(Reservation.objects.expired(later)),
+                          self._pks([self.reservations[Reservation.NEW],
+                                     self.reservations[Reservation.BOOTING]]))
+
+    def test_by_node_ids(self):
+        res = self.reservations[Reservation.READY]
+        for x in range(3):
+            Slave.objects.create(name='slave-%d' % (x,), reservation=res,
+                                 cloud_node_id='node-%d' % (x,))
+        self.assertEquals(
+            sorted(Slave.objects.by_node_ids(['node-0', 'node-2'],
+                                             self.cloud)
+                                .values_list('name', flat=True)),
+            ['slave-0', 'slave-2'])
+
+    def test_by_node_id(self):
+        other = Cloud.objects.get(pk='test_cloud')
+        other.pk = 'other_cloud'
+        other.save()
+        res = self.reservations[Reservation.READY]
+        Slave.objects.create(name='slave-1', reservation=res,
+                             cloud_node_id='node-1')
+        res = other.create_reservation(1)
+        Slave.objects.create(name='slave-2', reservation=res,
+                             cloud_node_id='node-1')
+        self.assertEquals(
+            sorted(s.name for s in Slave.objects.by_node_id('node-1')),
+            ['slave-1', 'slave-2'])
+        self.assertEquals(
+            [s.name for s in Slave.objects.by_node_id('node-1', other)],
+            ['slave-2'])
+        self.assertEquals(list(Slave.objects.by_node_id('node-2')), [])
@@ -0,0 +1,48 @@
+#
+#   Copyright 2013 Cisco Systems
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import threading
+
+from cloudslave.models import Cloud
+
+
+logger = logging.getLogger(__name__)
+
+
+class WarmPoolMaintainer(threading.Thread):
+    # Keeps the warm pools of all clouds topped up in the background.
+    def __init__(self, interval=30):
+        super(WarmPoolMaintainer, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def maintain_all(self):
+        for cloud in Cloud.objects.filter(warm_pool_size__gt=0):
+            try:
+                cloud.maintain_warm_pool()
+            except Exception, e:
+                logger.error('Failed to maintain the warm pool of %s' %
+                             (cloud,), exc_info=e)
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.maintain_all()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()